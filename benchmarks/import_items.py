@@ -0,0 +1,65 @@
+"""Time POST /items/import
+
+Imports a generated CSV of items into an empty database, then imports it again with upsert=true. Run from the
+repository root, the database is emptied afterwards:
+
+    python -m benchmarks.import_items --rows 100000 --database sqlite:////tmp/import.db
+    python -m benchmarks.import_items --database postgresql://pantry@localhost/pantry_bench
+"""
+import argparse
+import os
+import random
+import string
+import time
+
+
+def generate_csv(rows, seed=0):
+    """CSV of rows items with distinct names and product IDs"""
+    generator = random.Random(seed)
+    words = [
+        ''.join(generator.choices(string.ascii_lowercase, k=generator.randint(4, 9))) for _ in range(5000)
+    ]
+    lines = ['name,amount,unit,productId']
+    for i in range(rows):
+        name = ' '.join(generator.choices(words, k=2)).title()
+        lines.append(f'{name} {i},{generator.randint(0, 9)},g,{1000000 + i}')
+    return ('\n'.join(lines) + '\n').encode()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=100000)
+    parser.add_argument('--batch-size', type=int, help='IMPORT_BATCH_SIZE, the configured one by default')
+    parser.add_argument('--database', required=True, help='URL of a database whose tables may be dropped')
+    args = parser.parse_args()
+
+    # read by TestingConfig when imported
+    os.environ['TEST_DATABASE_URL'] = args.database
+    from myopenpantry import create_app
+    from myopenpantry.extensions.database import db
+
+    app = create_app(config_name='testing')
+    if args.batch_size:
+        app.config['IMPORT_BATCH_SIZE'] = args.batch_size
+    client = app.test_client()
+    data = generate_csv(args.rows)
+
+    try:
+        for label, query in (('insert', ''), ('upsert', '?upsert=true')):
+            start = time.perf_counter()
+            response = client.post(f'items/import{query}', data=data, content_type='text/csv')
+            elapsed = time.perf_counter() - start
+
+            result = response.json
+            print(
+                f"{label}: {args.rows} rows in {elapsed:.2f} s ({args.rows / elapsed:.0f} rows/s), "
+                f"inserted {result['inserted']}, updated {result['updated']}, failed {result['failed']}"
+            )
+    finally:
+        with app.app_context():
+            db.session.remove()
+            db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,103 @@
+"""Time concurrent reads and writes against SQLite with and without the SQLITE_PRAGMAS profile
+
+Writer processes post ingredients while reader processes list them, all through the app against one database file,
+first with an empty profile and then with the configured one. Run from the repository root, the database file is
+recreated for every run:
+
+    python -m benchmarks.sqlite_pragmas --writers 4 --readers 4 --seconds 10 --database /tmp/pragmas.db
+"""
+import argparse
+import multiprocessing
+import os
+import time
+
+
+def create_app(database, profile):
+    """App of the testing config on database, with the configured PRAGMA profile or none"""
+    # read by TestingConfig when imported
+    os.environ['TEST_DATABASE_URL'] = f'sqlite:///{database}'
+    from myopenpantry import create_app as create
+    from myopenpantry.config import TestingConfig
+
+    if not profile:
+        TestingConfig.SQLITE_PRAGMAS = {}
+    return create(config_name='testing')
+
+
+def worker(role, number, database, profile, seconds, barrier, results):
+    """Send requests of role for seconds once every worker is ready, then report (role, succeeded, failed)"""
+    client = create_app(database, profile).test_client()
+    succeeded = failed = 0
+
+    barrier.wait()
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        try:
+            if role == 'write':
+                response = client.post('ingredients/', json={'name': f'w{number}-{succeeded + failed}'})
+            else:
+                response = client.get('ingredients/')
+            ok = response.status_code < 400
+        except Exception:  # pylint: disable=broad-except
+            # "database is locked" propagates out of the test client, as the testing config does
+            ok = False
+        succeeded += ok
+        failed += not ok
+
+    results.put((role, succeeded, failed))
+
+
+def run(args, profile):
+    """(writes, reads, failed) of one run on a new database file"""
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(args.database + suffix):
+            os.remove(args.database + suffix)
+    # creates the tables before the workers start
+    create_app(args.database, profile)
+
+    # spawned, so every worker opens its own connections
+    context = multiprocessing.get_context('spawn')
+    barrier = context.Barrier(args.writers + args.readers)
+    results = context.Queue()
+    processes = [
+        context.Process(target=worker, args=(role, number, args.database, profile, args.seconds, barrier, results))
+        for role, count in (('write', args.writers), ('read', args.readers)) for number in range(count)
+    ]
+    for process in processes:
+        process.start()
+    totals = {'write': 0, 'read': 0, 'failed': 0}
+    for _ in processes:
+        role, succeeded, failed = results.get()
+        totals[role] += succeeded
+        totals['failed'] += failed
+    for process in processes:
+        process.join()
+    return totals['write'], totals['read'], totals['failed']
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=4)
+    parser.add_argument('--readers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--runs', type=int, default=2)
+    parser.add_argument('--database', required=True, help='path of a SQLite database file that may be deleted')
+    args = parser.parse_args()
+
+    for label, profile in (('no profile', False), ('profile', True)):
+        writes = reads = failed = 0
+        for _ in range(args.runs):
+            run_writes, run_reads, run_failed = run(args, profile)
+            writes += run_writes
+            reads += run_reads
+            failed += run_failed
+
+        elapsed = args.seconds * args.runs
+        print(
+            f"{label}: {writes / elapsed:.0f} writes/s, {reads / elapsed:.0f} reads/s, "
+            f"{failed} failed requests over {args.runs} runs"
+        )
+
+
+if __name__ == '__main__':
+    main()
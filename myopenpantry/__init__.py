@@ -4,7 +4,9 @@ from datetime import datetime
 import logging
 
 from myopenpantry.config import app_config
-from myopenpantry import extensions, views
+from myopenpantry import commands, extensions, views
+# registers the schema revisions
+from myopenpantry import migrations  # noqa: F401
 
 
 def create_app(config_name):
@@ -17,6 +19,7 @@ def create_app(config_name):
 
     api = extensions.create_api(app)
     views.register_blueprints(api)
+    commands.register_commands(app)
 
     logging.basicConfig(
         filename=f'logs/{datetime.date(datetime.now()).isoformat()}.log',
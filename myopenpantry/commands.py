@@ -0,0 +1,72 @@
+"""Flask CLI commands"""
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from myopenpantry.extensions.database import db, migrations, rebuild_table_stats
+from myopenpantry.models import rebuild_name_index, refresh_availability
+
+
+@click.command('rebuild-availability')
+@with_appcontext
+def rebuild_availability():
+    """Recompute ingredient stock flags and recipe missing ingredient counts"""
+    refresh_availability(db.session.connection())
+    db.session.commit()
+    click.echo('Recipe availability rebuilt')
+
+
+@click.command('rebuild-table-stats')
+@with_appcontext
+def rebuild_table_stats_command():
+    """Recount the rows of every table and invalidate cached counts"""
+    rebuild_table_stats(db.session.connection())
+    db.session.commit()
+    click.echo('Table stats rebuilt')
+
+
+@click.command('rebuild-name-index')
+@with_appcontext
+def rebuild_name_index_command():
+    """Reindex the names searched by the name filter of items, ingredients and tags"""
+    rebuild_name_index(db.session.connection())
+    db.session.commit()
+    click.echo('Name index rebuilt')
+
+
+@click.command('schema-revision')
+@with_appcontext
+def schema_revision():
+    """Print the applied and the latest schema revision, the app applies the missing ones on startup"""
+    current = migrations.current_revision(db.engine)
+    click.echo(f'Schema at revision {current}, latest is {migrations.head()}')
+
+
+@click.command('build-spec')
+@click.option('--output', type=click.Path(dir_okay=False), help='File to write, OPENAPI_SPEC_FILE by default')
+@with_appcontext
+def build_spec(output):
+    """Write the OpenAPI spec, to be served instead of documenting the views on startup"""
+    api = current_app.extensions['flask-smorest']['ext_obj']
+    path = output or api.spec_file()
+    if path is None:
+        raise click.UsageError('OPENAPI_SPEC_FILE is not set, give an --output file')
+
+    with open(path, 'wb') as spec_file:
+        spec_file.write(api.render_spec())
+    click.echo(f'OpenAPI spec written to {path}')
+
+
+COMMANDS = (
+    rebuild_availability,
+    rebuild_table_stats_command,
+    rebuild_name_index_command,
+    schema_revision,
+    build_spec,
+)
+
+
+def register_commands(app):
+    """Register all CLI commands with the application"""
+    for command in COMMANDS:
+        app.cli.add_command(command)
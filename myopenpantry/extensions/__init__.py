@@ -1,6 +1,6 @@
 from flask_cors import CORS
 
-from . import database
+from . import compression, database
 from .api import Api
 
 
@@ -9,7 +9,7 @@ def create_api(app):
     api = Api(app)
     CORS(app, resources={r"/*": {"expose_headers": ['X-Pagination', 'ETag']}})
 
-    for extension in (database,):
+    for extension in (database, compression):
         extension.init_app(app)
 
     return api
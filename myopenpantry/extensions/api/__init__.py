@@ -2,15 +2,243 @@
 
 Override base classes here to allow painless customization in the future.
 """
+import base64
+import binascii
+from copy import deepcopy
+from functools import wraps
+import http
+import json
+import os
+
+from flask import current_app, g, json as flask_json, jsonify, request, stream_with_context
 import marshmallow as ma
 from marshmallow_sqlalchemy import SQLAlchemyAutoSchema
+import sqlalchemy as sa
+from sqlalchemy.orm import Query, load_only
+from sqlalchemy.orm.exc import UnmappedColumnError
+from sqlalchemy.sql import operators
+from werkzeug.wrappers import BaseResponse
+
+from flask_smorest import Api as ApiOrig, Blueprint as BlueprintOrig, Page, abort
+from flask_smorest.etag import _is_etag_enabled
+from flask_smorest.pagination import _pagination_parameters_schema_factory
+from flask_smorest.utils import get_appcontext, set_status_and_headers_in_response, unpack_tuple_response
+
+from myopenpantry.extensions.cache import LRUCache
+from myopenpantry.extensions.compression import Precompressed, available_encodings
+from myopenpantry.extensions.database import db, get_versions, tracked_tables
 
-from flask_smorest import Api as ApiOrig, Blueprint as BlueprintOrig, Page
+from .jsonlib import Parser, get_backend
 
 
 class Blueprint(BlueprintOrig):
     """Blueprint override"""
 
+    # parse bodies with the configured JSON backend
+    ARGUMENTS_PARSER = Parser()
+
+    def paginate(self, pager=None, *, page=None, page_size=None, max_page_size=None):
+        """Pagination decorator override
+
+        Same as flask-smorest's, but pagers defining ``PARAMETERS`` (see SQLCursorPage) get those query
+        parameters as well, and the pagination header is set even when the pager skipped counting.
+        """
+        cursor_schema = getattr(pager, 'PARAMETERS', None)
+        if cursor_schema is None:
+            return super().paginate(pager, page=page, page_size=page_size, max_page_size=max_page_size)
+
+        defaults = self.DEFAULT_PAGINATION_PARAMETERS
+        page_params_schema = _pagination_parameters_schema_factory(
+            page or defaults['page'], page_size or defaults['page_size'], max_page_size or defaults['max_page_size']
+        )
+        error_status_code = self.PAGINATION_ARGUMENTS_PARSER.DEFAULT_VALIDATION_STATUS
+
+        def decorator(func):
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if stream_format() is not None:
+                    # streamed listings return every row, see response
+                    return func(*args, **kwargs)
+
+                page_params = self.PAGINATION_ARGUMENTS_PARSER.parse(page_params_schema, request, location='query')
+                for key, value in self.PAGINATION_ARGUMENTS_PARSER.parse(
+                    cursor_schema, request, location='query'
+                ).items():
+                    setattr(page_params, key, value)
+
+                result, status, headers = unpack_tuple_response(func(*args, **kwargs))
+                result = pager(result, page_params=page_params).items
+
+                if self.PAGINATION_HEADER_FIELD_NAME is not None:
+                    result, headers = self._set_pagination_metadata(page_params, result, headers)
+
+                return result, status, headers
+
+            wrapper._apidoc = deepcopy(getattr(wrapper, '_apidoc', {}))
+            wrapper._apidoc['pagination'] = {
+                'parameters': {'in': 'query', 'schema': page_params_schema},
+                'cursor_parameters': {'in': 'query', 'schema': cursor_schema},
+                'response': {error_status_code: http.HTTPStatus(error_status_code).name},
+            }
+
+            return wrapper
+
+        return decorator
+
+    def response(self, status_code, schema=None, **kwargs):
+        """Response decorator override
+
+        GET responses are dumped with the fields requested with ``?fields=`` only, see sparse_schema.
+
+        Listings, responses with a many schema, can also be streamed row by row: as NDJSON when the client
+        accepts application/x-ndjson, or as a chunked JSON array with ``?stream=true``. Streams skip
+        pagination and read queries with ``yield_per``, so memory use doesn't depend on the number of rows.
+        """
+        if isinstance(schema, type):
+            schema = schema()
+        decorator = super().response(status_code, schema, **kwargs)
+        if schema is None:
+            return decorator
+
+        def sparse_decorator(func):
+            view = decorator(func)
+
+            @wraps(view)
+            def wrapper(*args, **kwargs):
+                fmt = stream_format() if schema.many else None
+                dump_schema = sparse_schema(schema)
+                if fmt is None and dump_schema is schema:
+                    return view(*args, **kwargs)
+
+                result, status, headers = unpack_tuple_response(func(*args, **kwargs))
+                if isinstance(result, BaseResponse):
+                    set_status_and_headers_in_response(result, status, headers)
+                    return result
+
+                if fmt is not None:
+                    response = current_app.response_class(
+                        stream_with_context(_stream_rows(result, dump_schema, fmt)), mimetype=STREAM_MIMETYPES[fmt]
+                    )
+                else:
+                    # same as flask-smorest's response, with the narrowed schema
+                    result_dump = dump_schema.dump(result)
+                    appcontext = get_appcontext()
+                    appcontext['result_raw'] = result
+                    appcontext['result_dump'] = result_dump
+                    response = jsonify(self._prepare_response_content(result_dump))
+                    response.status_code = status_code
+                set_status_and_headers_in_response(response, status, headers)
+                return response
+
+            wrapper._apidoc['sparse_fields'] = True
+            return wrapper
+
+        return sparse_decorator
+
+    def collection_etag(self, *tables):
+        """Decorator computing the ETag of a listing from the write versions of the tables it reads
+
+        Goes under ``etag``. The ETag hashes the endpoint, its normalized arguments and the table versions,
+        so a matching If-None-Match is answered with 304 before the view queries or serializes anything.
+        Tables may be given as models.
+        """
+        names = sorted({getattr(table, '__table__', table).name for table in tables})
+
+        def decorator(func):
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                if request.method in self.METHODS_CHECKING_NOT_MODIFIED and _is_etag_enabled():
+                    # read before the view runs, a concurrent write can only make the response newer than its ETag
+                    self.set_etag({
+                        'endpoint': request.endpoint,
+                        'view_args': request.view_args,
+                        'args': sorted((key, request.args.getlist(key)) for key in request.args),
+                        'format': stream_format(),
+                        'versions': _request_versions(names),
+                    })
+
+                return func(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def cache_response(self, *tables):
+        """Decorator caching the rendered responses of a GET endpoint in process
+
+        Goes above ``etag``. Entries are keyed by endpoint, path and query arguments, and are only served while
+        the versions of the given tables (or models) are those the response was rendered with, so any commit
+        writing to one of them invalidates it. See the RESPONSE_CACHE_* settings.
+        """
+        names = sorted({getattr(table, '__table__', table).name for table in tables})
+
+        def decorator(func):
+
+            @wraps(func)
+            def wrapper(*args, **kwargs):
+                cache = current_app.extensions.get('response_cache')
+                if cache is None or request.method != 'GET' or stream_format() is not None:
+                    return func(*args, **kwargs)
+
+                key = (
+                    request.endpoint,
+                    tuple(sorted(request.view_args.items())),
+                    tuple(sorted((key, tuple(request.args.getlist(key))) for key in request.args)),
+                )
+                versions = _request_versions(names)
+
+                entry = cache.get(key, valid=lambda entry: entry[0] == versions)
+                if entry is not None:
+                    _, body, status, headers = entry
+                    response = current_app.response_class(body, status=status, headers=headers)
+                    return response.make_conditional(request)
+
+                response = func(*args, **kwargs)
+                if response.status_code == 200 and not response.is_streamed:
+                    cache.set(key, (versions, response.get_data(), response.status_code, list(response.headers)))
+
+                return response
+
+            return wrapper
+
+        return decorator
+
+    def _prepare_response_doc(self, doc, doc_info, *, method, **kwargs):
+        doc = super()._prepare_response_doc(doc, doc_info, method=method, **kwargs)
+        if doc_info.get('sparse_fields') and method == 'get':
+            doc.setdefault('parameters', []).append(FIELDS_PARAMETER)
+        return doc
+
+    def _prepare_pagination_doc(self, doc, doc_info, **kwargs):
+        doc = super()._prepare_pagination_doc(doc, doc_info, **kwargs)
+        cursor_parameters = doc_info.get('pagination', {}).get('cursor_parameters')
+        if cursor_parameters:
+            doc['parameters'].append(cursor_parameters)
+        return doc
+
+    def _set_pagination_metadata(self, page_params, result, headers):
+        """Add cursor metadata, and leave out counts when they were skipped"""
+        if not hasattr(page_params, 'next_after'):
+            return super()._set_pagination_metadata(page_params, result, headers)
+
+        if page_params.item_count is None or page_params.after is not None:
+            # page numbers mean nothing when reading after a cursor
+            metadata = {}
+            if page_params.item_count is not None:
+                metadata['total'] = page_params.item_count
+        else:
+            metadata = self._make_pagination_metadata(page_params.page, page_params.page_size, page_params.item_count)
+
+        if page_params.next_after is not None:
+            metadata['next_after'] = page_params.next_after
+
+        if headers is None:
+            headers = {}
+        headers[self.PAGINATION_HEADER_FIELD_NAME] = json.dumps(metadata)
+        return result, headers
+
 # Define custom converter to schema function
 # def customconverter2paramschema(converter):
 #     return {'type': 'custom_type', 'format': 'custom_format'}
@@ -28,6 +256,179 @@ class Api(ApiOrig):
         # Register custom Flask url parameter converters
         # api.register_converter(CustomConverter, customconverter2paramschema)
 
+    def init_app(self, app, *, spec_kwargs=None):
+        # blueprints whose views are not documented yet, see register_blueprint
+        self._undocumented = []
+        # the spec, compressed on first request. See _openapi_json
+        self._spec_payload = None
+        super().init_app(app, spec_kwargs=spec_kwargs)
+
+        app.json_encoder, app.json_decoder = get_backend(app.config['JSON_BACKEND'])
+
+        # listing counts, see SQLCursorPage.item_count
+        app.extensions['count_cache'] = LRUCache(app.config['COUNT_CACHE_SIZE'])
+
+        # schema instances by (class, many, only), see sparse_schema
+        app.extensions['schema_cache'] = LRUCache(app.config['SCHEMA_CACHE_SIZE'])
+
+        # rendered responses, see Blueprint.cache_response
+        if app.config['RESPONSE_CACHE_ENABLED']:
+            app.extensions['response_cache'] = LRUCache(
+                app.config['RESPONSE_CACHE_SIZE'], ttl=app.config['RESPONSE_CACHE_TTL'],
+                maxbytes=app.config['RESPONSE_CACHE_MAX_BYTES'], sizeof=_response_size,
+            )
+
+    def _init_spec(self, **kwargs):
+        super()._init_spec(**kwargs)
+        to_dict = self.spec.to_dict
+
+        def document_and_render():
+            self._document_blueprints()
+            return to_dict()
+
+        # anything rendering the spec, flask-smorest's openapi commands included, documents the views first
+        self.spec.to_dict = document_and_render
+
+    def register_blueprint(self, blp, **options):
+        """Register a blueprint in the application
+
+        Documenting the views introspects every schema they use, so it is deferred until the spec is rendered.
+        Workers serving a pre-generated spec never do it, see OPENAPI_SPEC_FILE.
+        """
+        self._app.register_blueprint(blp, **options)
+        self._undocumented.append(blp)
+
+    def _document_blueprints(self):
+        while self._undocumented:
+            blp = self._undocumented.pop(0)
+            blp.register_views_in_doc(self, self._app, self.spec)
+            self.spec.tag({'name': blp.name, 'description': blp.description})
+
+    def spec_file(self):
+        """Path of the pre-generated spec, None when OPENAPI_SPEC_FILE is not set"""
+        path = self._app.config['OPENAPI_SPEC_FILE']
+        if path is None:
+            return None
+        return os.path.join(self._app.root_path, path)
+
+    def render_spec(self):
+        """The spec documenting the registered views, as served"""
+        return json.dumps(self.spec.to_dict(), indent=2).encode()
+
+    def _openapi_json(self):
+        """Serve the spec, which doesn't change while the app runs, rendered and compressed once
+
+        The pre-generated spec is served when there is one, see the build-spec command.
+        """
+        if self._spec_payload is None:
+            path = self.spec_file()
+            if path is not None and os.path.exists(path):
+                with open(path, 'rb') as spec_file:
+                    data = spec_file.read()
+            else:
+                data = self.render_spec()
+            self._spec_payload = Precompressed(data, 'application/json', available_encodings(current_app))
+        return self._spec_payload.response()
+
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+STREAM_MIMETYPES = {'ndjson': NDJSON_MIMETYPE, 'json': 'application/json'}
+
+
+def stream_format():
+    """'ndjson' or 'json' when the request asks for a streamed listing, None otherwise"""
+    if request.accept_mimetypes.best_match(['application/json', NDJSON_MIMETYPE]) == NDJSON_MIMETYPE:
+        return 'ndjson'
+    if request.args.get('stream', '').lower() in ma.fields.Boolean.truthy:
+        return 'json'
+    return None
+
+
+FIELDS_PARAMETER = {
+    'in': 'query',
+    'name': 'fields',
+    'description': "Comma separated fields to return, all of them by default",
+    'schema': {'type': 'string'},
+}
+
+
+def _schema_instance(cls, many, only=None):
+    # selections are chosen by clients, the cache of the app keeps their number bounded
+    cache = current_app.extensions['schema_cache']
+    key = (cls, many, only)
+    schema = cache.get(key)
+    if schema is None:
+        schema = cls(many=many, only=only)
+        cache.set(key, schema)
+    return schema
+
+
+def sparse_schema(schema):
+    """schema, a class or an instance, narrowed to the fields requested with ``?fields=``
+
+    Only top level fields can be selected, by their names in the representation. Returns schema itself, or an
+    instance of it, when there is no selection. Unknown fields abort with 422.
+    """
+    if isinstance(schema, type):
+        schema = _schema_instance(schema, False)
+
+    fields = request.args.get('fields', '') if request.method in ('GET', 'HEAD') else ''
+    requested = {key.strip() for key in fields.split(',') if key.strip()}
+    if not requested:
+        return schema
+
+    names = {field.data_key or name: name for name, field in schema.dump_fields.items()}
+    unknown = sorted(requested - names.keys())
+    if unknown:
+        abort(422, errors={'query': {'fields': [f"Unknown field: {key}." for key in unknown]}})
+
+    return _schema_instance(type(schema), schema.many, tuple(sorted(names[key] for key in requested)))
+
+
+def query_options(schema):
+    """Loader options for a query read by schema, as narrowed for the request. See AutoSchema.query_options"""
+    return sparse_schema(schema).query_options()
+
+
+def _stream_rows(rows, schema, fmt):
+    """Serialize rows one by one, yielding chunks of STREAM_BATCH_SIZE rows"""
+    batch_size = current_app.config['STREAM_BATCH_SIZE']
+    if isinstance(rows, Query):
+        rows = rows.yield_per(batch_size)
+
+    if fmt == 'json':
+        yield '['
+    chunk = []
+    for index, row in enumerate(rows):
+        data = flask_json.dumps(schema.dump(row, many=False))
+        if fmt == 'ndjson':
+            chunk.append(data + '\n')
+        else:
+            chunk.append(',' + data if index else data)
+        if len(chunk) >= batch_size:
+            yield ''.join(chunk)
+            chunk = []
+    if chunk:
+        yield ''.join(chunk)
+    if fmt == 'json':
+        yield ']'
+
+
+def _request_versions(names):
+    """Versions of the sorted table names, read once per request"""
+    cache = g.setdefault('table_versions', {})
+    key = tuple(names)
+    if key not in cache:
+        versions = get_versions(db.session, names)
+        cache[key] = tuple((name, versions[name][0]) for name in names if name in versions)
+    return cache[key]
+
+
+def _response_size(entry):
+    """Approximate bytes held by a response cache entry"""
+    _, body, _, headers = entry
+    return len(body) + sum(len(name) + len(value) for name, value in headers)
+
 
 # from marshmallow docs for camel casing keys
 def camelcase(s):
@@ -43,7 +444,16 @@ class Schema(ma.Schema):
 
 
 class AutoSchema(SQLAlchemyAutoSchema):
-    """SQLAlchemyAutoSchema override"""
+    """SQLAlchemyAutoSchema override
+
+    Dumps go through a function generated from the fields, see compile_dumper. Set COMPILED_DUMP to False on a
+    subclass to use the generic marshmallow machinery instead.
+    """
+
+    COMPILED_DUMP = True
+
+    # nested field name -> loader option eagerly loading what the field dumps, see query_options
+    LOADERS = {}
 
     def on_bind_field(self, field_name, field_obj):
         field_obj.data_key = camelcase(field_obj.data_key or field_name)
@@ -66,10 +476,304 @@ class AutoSchema(SQLAlchemyAutoSchema):
             key: value for key, value in data.items() if value is not None
         }
 
+    def query_options(self):
+        """Loader options for a query read by this schema
+
+        Eagerly loads what the nested fields dump. When the schema is narrowed with ``only``, see sparse_schema,
+        the other columns are not selected and the other relationships not loaded.
+        """
+        if self.only is None:
+            return tuple(self.LOADERS.values())
+
+        options = [option for name, option in self.LOADERS.items() if name in self.dump_fields]
+        table = self.opts.table
+        attributes = (field.attribute or name for name, field in self.dump_fields.items())
+        columns = [attribute for attribute in attributes if attribute in table.c]
+        if 'version' in table.c:
+            # read by ETags, see VersionEtagSchema
+            columns.append('version')
+        if columns:
+            options.append(load_only(*columns))
+        return tuple(options)
+
+    def dump(self, obj, *, many=None):
+        dumper = self._get_dumper() if self.COMPILED_DUMP else None
+        if dumper is None:
+            return super().dump(obj, many=many)
+
+        many = self.many if many is None else bool(many)
+        if many:
+            objs = obj if isinstance(obj, (list, tuple)) else list(obj)
+            # the generated code reads attributes, anything but model instances, eg dicts, goes the generic way
+            if all(isinstance(item, db.Model) for item in objs):
+                return [dumper(item) for item in objs]
+            return super().dump(objs, many=True)
+        if isinstance(obj, db.Model):
+            return dumper(obj)
+        return super().dump(obj, many=False)
+
+    def _get_dumper(self):
+        # generated once per schema class and field selection, of which the DUMPER_CACHE_SIZE last used are kept
+        dumpers = self.__class__.__dict__.get('_dumpers')
+        if dumpers is None:
+            dumpers = self.__class__._dumpers = LRUCache(DUMPER_CACHE_SIZE)
+
+        key = (tuple(self.dump_fields), frozenset(self.only or ()), frozenset(self.exclude))
+        # False, as compile_dumper returns None for the generic path
+        dumper = dumpers.get(key, False)
+        if dumper is False:
+            dumper = compile_dumper(self)
+            dumpers.set(key, dumper)
+        return dumper
+
+
+# generated dumpers kept per schema class, see AutoSchema._get_dumper
+DUMPER_CACHE_SIZE = 64
+
+# fields whose serialization can be inlined, as the expression applied to a non None value
+_INLINE_SERIALIZERS = {
+    ma.fields.Integer: 'int({})',
+    ma.fields.Float: 'float({})',
+    ma.fields.String: '({0} if type({0}) is str else ensure_text_type({0}))',
+}
+
+
+# compile_dumper reads Schema._hooks and Field._CHECK_ATTRIBUTE, internals of marshmallow 3. Other versions get
+# the generic path, test_schemas fails when these are missing
+MARSHMALLOW_INTERNALS = (
+    ma.__version_info__[0] == 3 and hasattr(ma.Schema, '_hooks') and hasattr(ma.fields.Field, '_CHECK_ATTRIBUTE')
+)
+
+
+def compile_dumper(schema):
+    """Generate a function dumping one model instance like schema.dump would, or None if schema is not supported
+
+    The generated code reads each attribute, serializes it and leaves it out when None, which is what the
+    generic path followed by remove_none_values does, without the per field overhead and second dict.
+    Nested AutoSchemas are compiled as well.
+    """
+    if not MARSHMALLOW_INTERNALS:
+        return None
+
+    hooks = {key: names for key, names in schema._hooks.items() if names and key[0] in ('pre_dump', 'post_dump')}
+    if hooks != {('post_dump', False): ['remove_none_values']}:
+        return None
+
+    lines = ['def dump(obj):', '    data = {}']
+    namespace = {'ensure_text_type': ma.utils.ensure_text_type}
+
+    for index, (name, field) in enumerate(schema.dump_fields.items()):
+        attribute = field.attribute or name
+        if not attribute.isidentifier() or not field._CHECK_ATTRIBUTE:
+            return None
+
+        key = field.data_key or name
+        lines.append(f'    value = obj.{attribute}')
+        lines.append('    if value is not None:')
+
+        inline = _INLINE_SERIALIZERS.get(type(field))
+        if type(field) is ma.fields.Nested:
+            nested = field.schema
+            dumper = nested._get_dumper() if isinstance(nested, AutoSchema) and nested.COMPILED_DUMP else None
+            if dumper is None:
+                return None
+            namespace[f'dump_{index}'] = dumper
+            if field.many or nested.many:
+                lines.append(f'        data[{key!r}] = [dump_{index}(item) for item in value]')
+            else:
+                lines.append(f'        data[{key!r}] = dump_{index}(value)')
+        elif inline is not None and not getattr(field, 'as_string', False):
+            lines.append(f'        data[{key!r}] = {inline.format("value")}')
+        else:
+            # anything else goes through the field, which may still return None
+            namespace[f'field_{index}'] = field
+            lines.append(f'        value = field_{index}._serialize(value, {name!r}, obj)')
+            lines.append('        if value is not None:')
+            lines.append(f'            data[{key!r}] = value')
+
+    lines.append('    return data')
+    exec('\n'.join(lines), namespace)
+    return namespace['dump']
+
+
+class VersionEtagSchema(ma.Schema):
+    """ETag schema for rows with a version column
+
+    Hashing the id and version instead of the whole representation keeps nested data out of precondition
+    checks. See models/row_versions.py for what moves the version.
+    """
+    id = ma.fields.Int()
+    version = ma.fields.Int()
+
+
+def encode_cursor(values):
+    """Encode the sort key of a row into an opaque cursor"""
+    return base64.urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor):
+    """Decode a cursor back into the sort key of a row"""
+    return json.loads(base64.urlsafe_b64decode(cursor.encode()))
+
+
+CURSOR_TYPES = (str, int, float, bool, type(None))
+# bound parameters of SQLite and PostgreSQL BIGINT
+CURSOR_INT_RANGE = range(-2 ** 63, 2 ** 63)
+
+
+def coerce_cursor_value(column, value):
+    """Cursor value as the Python type of column, raises ValueError when it can't be compared with the column"""
+    if value is None:
+        return None
+    try:
+        python_type = column.type.python_type
+    except NotImplementedError:
+        return value
+    if python_type is bool:
+        if not isinstance(value, bool):
+            raise ValueError(value)
+    elif python_type is int:
+        if isinstance(value, bool) or not isinstance(value, int) or value not in CURSOR_INT_RANGE:
+            raise ValueError(value)
+    elif python_type is float:
+        if isinstance(value, bool) or not isinstance(value, (int, float)):
+            raise ValueError(value)
+        return float(value)
+    elif python_type is str:
+        if not isinstance(value, str):
+            raise ValueError(value)
+    return value
+
+
+class Cursor(ma.fields.String):
+    """Opaque cursor deserialized into a list of sort key values"""
+
+    def _deserialize(self, value, attr, data, **kwargs):
+        value = super()._deserialize(value, attr, data, **kwargs)
+        try:
+            values = decode_cursor(value)
+        except (binascii.Error, UnicodeDecodeError, ValueError):
+            raise ma.ValidationError("Invalid cursor.")
+        # encode_cursor only writes scalars, anything else was forged
+        if not isinstance(values, list) or not all(isinstance(value, CURSOR_TYPES) for value in values):
+            raise ma.ValidationError("Invalid cursor.")
+        return values
+
+
+class PagerParametersSchema(ma.Schema):
+    """Extra pagination parameters of SQLCursorPage"""
+
+    class Meta:
+        ordered = True
+        unknown = ma.EXCLUDE
+
+    # next_after of the previous page. Reads the following page with a range scan instead of an offset
+    after = Cursor(missing=None)
+    # skip counting the total number of items
+    count = ma.fields.Boolean(missing=True)
+    # use the maintained row count of the table for unfiltered listings, which may drift from the exact count
+    estimate = ma.fields.Boolean(missing=False)
+    # return every row as a chunked JSON array instead of a page, see Blueprint.response
+    stream = ma.fields.Boolean(missing=False)
+
 
 class SQLCursorPage(Page):
-    """SQL cursor pager"""
+    """SQL cursor pager
+
+    Pages through a query with OFFSET/LIMIT, or with a range scan on the ORDER BY columns of the query when an
+    ``after`` cursor is given. Every page reports the cursor of its last row as ``next_after``.
+    """
+
+    PARAMETERS = PagerParametersSchema
+
+    @property
+    def items(self):
+        page_params = self.page_params
+        ret = self.collection
+        after = getattr(page_params, 'after', None)
+
+        if after is None:
+            ret = ret.offset(page_params.first_item)
+        else:
+            ret = ret.filter(self._after(after))
+
+        # read one more row to know if there is a next page
+        items = ret.limit(page_params.page_size + 1).all()
+        page_params.next_after = None
+        if len(items) > page_params.page_size:
+            items = items[:page_params.page_size]
+            keys = self._sort_keys()
+            if keys is not None:
+                page_params.next_after = encode_cursor([getattr(items[-1], key) for _, key, _ in keys])
+
+        return items
 
     @property
     def item_count(self):
-        return self.collection.count()
+        """Count the items, reusing the last count of the same query while the tables it reads are unchanged"""
+        if not getattr(self.page_params, 'count', True):
+            return None
+
+        # eager loads don't change the count
+        statement = self.collection.enable_eagerloads(False).statement
+        tables = tracked_tables(statement)
+        versions = get_versions(db.session, tables)
+        if len(versions) != len(tables):
+            # tables without stats can't be cached
+            return self.collection.count()
+
+        if getattr(self.page_params, 'estimate', False) and self.collection.whereclause is None and len(tables) == 1:
+            _, row_count = versions[tables[0]]
+            return row_count
+
+        compiled = statement.compile()
+        key = (str(compiled), repr(sorted(compiled.params.items())))
+        cache = current_app.extensions['count_cache']
+
+        cached = cache.get(key)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        count = self.collection.count()
+        cache.set(key, (versions, count))
+        return count
+
+    def _sort_keys(self):
+        """Return (column, attribute, descending) of each ORDER BY clause, None if a cursor can't express them"""
+        descriptions = self.collection.column_descriptions
+        if len(descriptions) != 1 or descriptions[0]['type'] is not descriptions[0]['entity']:
+            return None
+        mapper = sa.inspect(descriptions[0]['entity'])
+
+        keys = []
+        # sqlalchemy has no public accessor for the ORDER BY of a query
+        for clause in self.collection._order_by or ():
+            descending = getattr(clause, 'modifier', None) is operators.desc_op
+            column = clause.element if getattr(clause, 'modifier', None) in (
+                operators.asc_op, operators.desc_op
+            ) else clause
+            try:
+                keys.append((column, mapper.get_property_by_column(column).key, descending))
+            except UnmappedColumnError:
+                return None
+
+        return keys or None
+
+    def _after(self, values):
+        """Build the WHERE clause selecting the rows that sort after the given key"""
+        keys = self._sort_keys()
+        if keys is None:
+            abort(422, errors={'query': {'after': ["Cursor pagination is not supported for this listing."]}})
+        try:
+            if len(values) != len(keys):
+                raise ValueError(values)
+            values = [coerce_cursor_value(column, value) for (column, _, _), value in zip(keys, values)]
+        except ValueError:
+            abort(422, errors={'query': {'after': ["Invalid cursor."]}})
+
+        # (a, b) > (x, y) expands to a > x OR (a = x AND b > y)
+        clauses = []
+        for i, ((column, _, descending), value) in enumerate(zip(keys, values)):
+            equal = [prior == prior_value for (prior, _, _), prior_value in zip(keys[:i], values[:i])]
+            clauses.append(sa.and_(*equal, column < value if descending else column > value))
+        return sa.or_(*clauses)
@@ -0,0 +1,85 @@
+"""JSON backends
+
+Flask renders and parses JSON through ``app.json_encoder`` and ``app.json_decoder``. These classes plug a
+backend into both, see Api.init_app and the JSON_BACKEND setting. orjson is used when installed, stdlib json
+otherwise. Both encode Decimal as a number and dates and times in ISO 8601, like the schemas do.
+"""
+import datetime
+import decimal
+import json
+
+from flask import json as flask_json
+from webargs import core
+from webargs.flaskparser import FlaskParser, is_json_request
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None
+
+
+def default(o):
+    """Encode the types neither backend handles the same way"""
+    if isinstance(o, decimal.Decimal):
+        return float(o)
+    if isinstance(o, (datetime.datetime, datetime.date, datetime.time)):
+        return o.isoformat()
+    raise TypeError(f"Object of type {type(o).__name__} is not JSON serializable")
+
+
+class JSONEncoder(flask_json.JSONEncoder):
+    """stdlib encoder"""
+
+    def default(self, o):
+        try:
+            return default(o)
+        except TypeError:
+            return super().default(o)
+
+
+class JSONDecoder(json.JSONDecoder):
+    """stdlib decoder"""
+
+
+class OrjsonEncoder(JSONEncoder):
+    """orjson encoder, honouring the sort_keys and indent flask passes"""
+
+    def encode(self, o):
+        option = orjson.OPT_PASSTHROUGH_DATETIME | orjson.OPT_NON_STR_KEYS
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        if self.indent:
+            option |= orjson.OPT_INDENT_2
+        return orjson.dumps(o, default=self.default, option=option).decode()
+
+
+class OrjsonDecoder(json.JSONDecoder):
+    """orjson decoder"""
+
+    def decode(self, s, *args, **kwargs):
+        return orjson.loads(s)
+
+
+BACKENDS = {
+    'stdlib': (JSONEncoder, JSONDecoder),
+    'orjson': (OrjsonEncoder, OrjsonDecoder),
+}
+
+
+def get_backend(name):
+    """(encoder, decoder) classes of a backend name, 'auto' picking the fastest installed one"""
+    if name == 'auto':
+        name = 'stdlib' if orjson is None else 'orjson'
+    if name == 'orjson' and orjson is None:
+        raise RuntimeError("JSON_BACKEND is 'orjson' but orjson is not installed")
+    return BACKENDS[name]
+
+
+class Parser(FlaskParser):
+    """webargs parser decoding JSON bodies with the app's decoder"""
+
+    def _raw_load_json(self, req):
+        if not is_json_request(req):
+            return core.missing
+
+        return flask_json.loads(req.get_data(cache=True))
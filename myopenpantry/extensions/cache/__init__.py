@@ -0,0 +1,78 @@
+"""In process caches"""
+from collections import OrderedDict
+from threading import Lock
+from time import monotonic
+
+
+class LRUCache:
+    """Least recently used cache holding at most maxsize entries
+
+    Entries optionally expire ttl seconds after being set. When maxbytes is given, the total of sizeof(value)
+    over the entries is kept under it as well, and values larger than maxbytes are not stored at all.
+    """
+
+    def __init__(self, maxsize, *, ttl=None, maxbytes=None, sizeof=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.nbytes = 0
+        # key -> (expiry time or None, size, value)
+        self._entries = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, key, default=None, valid=None):
+        """Value of key, entries for which valid(value) is false are dropped and count as misses"""
+        with self._lock:
+            try:
+                expires, size, value = self._entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if (expires is not None and expires <= monotonic()) or (valid is not None and not valid(value)):
+                self._remove(key)
+                self.misses += 1
+                return default
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        size = self.sizeof(value) if self.maxbytes is not None else 0
+        expires = monotonic() + self.ttl if self.ttl is not None else None
+
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            if self.maxbytes is not None and size > self.maxbytes:
+                return
+            self._entries[key] = (expires, size, value)
+            self.nbytes += size
+            while len(self._entries) > self.maxsize or (self.maxbytes is not None and self.nbytes > self.maxbytes):
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def _remove(self, key):
+        self.nbytes -= self._entries.pop(key)[1]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        """Counters describing the use of the cache since it was created"""
+        with self._lock:
+            return {
+                'entries': len(self._entries),
+                'bytes': self.nbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+    def __len__(self):
+        return len(self._entries)
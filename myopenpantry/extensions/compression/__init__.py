@@ -0,0 +1,186 @@
+"""Response compression
+
+Responses of the COMPRESS_MIMETYPES of at least COMPRESS_MIN_SIZE bytes are compressed with the preferred
+encoding of COMPRESS_ALGORITHMS the client accepts. gzip is always available, brotli and zstandard when
+installed. Streamed responses are gzipped chunk by chunk, so rows are still sent as they are serialized.
+
+Every encoding is a representation of its own, so the ETag of a compressed response gets the encoding as a
+suffix, eg "abc-gzip". Views compute ETags from the data before encoding, so the suffixes are stripped from
+If-None-Match and If-Match before the views check them, and put back on the ETag of a 304. Payloads known at
+startup, like the API spec, are better served through Precompressed, which encodes them once.
+"""
+import gzip
+import hashlib
+import zlib
+
+from flask import current_app, request
+from werkzeug.http import parse_etags, quote_etag
+
+try:
+    import brotli
+except ImportError:  # pragma: no cover
+    brotli = None
+
+try:
+    import zstandard
+except ImportError:  # pragma: no cover
+    zstandard = None
+
+
+def _gzip(data, level):
+    # no timestamp, so the same data always compresses to the same bytes
+    return gzip.compress(data, compresslevel=min(level, 9), mtime=0)
+
+
+def _brotli(data, level):
+    return brotli.compress(data, quality=min(level, 11))
+
+
+def _zstd(data, level):
+    return zstandard.ZstdCompressor(level=min(level, 19)).compress(data)
+
+
+# encoding -> compress(data, level)
+COMPRESSORS = {'gzip': _gzip}
+if brotli is not None:
+    COMPRESSORS['br'] = _brotli
+if zstandard is not None:
+    COMPRESSORS['zstd'] = _zstd
+
+# level used for payloads compressed once, each compressor caps it to its own maximum
+MAX_LEVEL = 19
+
+
+def available_encodings(app):
+    """Configured encodings that are installed, in order of preference"""
+    if not app.config['COMPRESS_ENABLED']:
+        return []
+    return [encoding for encoding in app.config['COMPRESS_ALGORITHMS'] if encoding in COMPRESSORS]
+
+
+def negotiate(encodings):
+    """Encoding of encodings the request accepts with the highest quality, None for identity"""
+    return request.accept_encodings.best_match(encodings)
+
+
+# request headers whose ETags are stripped of their encoding
+PRECONDITION_HEADERS = ('HTTP_IF_NONE_MATCH', 'HTTP_IF_MATCH')
+# key of request.environ mapping the stripped ETags to their encoding
+ETAG_ENCODINGS = 'myopenpantry.etag_encodings'
+
+
+def encode_etag(response, encoding):
+    """Suffix the ETag of response, if any, with encoding"""
+    etag, weak = response.get_etag()
+    if etag is not None:
+        response.set_etag(f'{etag}-{encoding}', weak)
+
+
+def strip_etag_encodings():
+    """before_request hook stripping the encoding suffixes of the ETags of preconditions"""
+    suffixes = {f'-{encoding}': encoding for encoding in COMPRESSORS}
+    stripped = {}
+    for header in PRECONDITION_HEADERS:
+        value = request.environ.get(header)
+        if not value:
+            continue
+        etags = parse_etags(value)
+        if etags.star_tag:
+            continue
+
+        strong = etags.as_set()
+        tags = []
+        for etag in sorted(etags.as_set(include_weak=True)):
+            weak = etag not in strong
+            for suffix, encoding in suffixes.items():
+                if etag.endswith(suffix):
+                    etag = etag[:-len(suffix)]
+                    stripped[etag] = encoding
+                    break
+            tags.append(quote_etag(etag, weak))
+        request.environ[header] = ', '.join(tags)
+    request.environ[ETAG_ENCODINGS] = stripped
+
+
+class Precompressed:
+    """Payload compressed once in every available encoding, served with a strong ETag per encoding"""
+
+    def __init__(self, data, mimetype, encodings):
+        self.data = data
+        self.mimetype = mimetype
+        self.etag = hashlib.sha1(data).hexdigest()
+        self.encoded = {encoding: COMPRESSORS[encoding](data, MAX_LEVEL) for encoding in encodings}
+
+    def response(self):
+        """Response of the representation the request accepts, answering conditional requests"""
+        encoding = negotiate(list(self.encoded))
+        response = current_app.response_class(self.encoded.get(encoding, self.data), mimetype=self.mimetype)
+        response.vary.add('Accept-Encoding')
+        # preconditions are stripped of their encoding, see strip_etag_encodings
+        response.set_etag(self.etag)
+        response = response.make_conditional(request)
+        if encoding is not None:
+            response.headers['Content-Encoding'] = encoding
+            encode_etag(response, encoding)
+        return response
+
+
+def _gzip_stream(chunks, level):
+    """gzip an iterable of chunks, flushing after every chunk"""
+    compressor = zlib.compressobj(min(level, 9), zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, str):
+            chunk = chunk.encode()
+        data = compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """after_request hook compressing the response when the client accepts it"""
+    config = current_app.config
+    if response.status_code == 304:
+        # the client holds the representation in the encoding of the ETag it sent
+        etag, _ = response.get_etag()
+        encoding = request.environ.get(ETAG_ENCODINGS, {}).get(etag)
+        if encoding is not None:
+            response.vary.add('Accept-Encoding')
+            encode_etag(response, encoding)
+        return response
+    if (
+        response.mimetype not in config['COMPRESS_MIMETYPES'] or response.direct_passthrough
+        or 'Content-Encoding' in response.headers or response.status_code < 200 or response.status_code in (204, 304)
+    ):
+        return response
+
+    response.vary.add('Accept-Encoding')
+    level = config['COMPRESS_LEVEL']
+
+    if response.is_streamed:
+        # only gzip is compressed incrementally
+        if negotiate([encoding for encoding in available_encodings(current_app) if encoding == 'gzip']) is None:
+            return response
+        response.response = _gzip_stream(response.response, level)
+        response.headers['Content-Encoding'] = 'gzip'
+        response.headers.pop('Content-Length', None)
+        encode_etag(response, 'gzip')
+        return response
+
+    if response.content_length is None or response.content_length < config['COMPRESS_MIN_SIZE']:
+        return response
+    encoding = negotiate(available_encodings(current_app))
+    if encoding is None:
+        return response
+
+    response.set_data(COMPRESSORS[encoding](response.get_data(), level))
+    response.headers['Content-Encoding'] = encoding
+    encode_etag(response, encoding)
+    return response
+
+
+def init_app(app):
+    """Initialize response compression"""
+    if app.config['COMPRESS_ENABLED']:
+        app.before_request(strip_etag_encodings)
+        app.after_request(compress_response)
@@ -1,23 +1,90 @@
 """Relational database"""
 
-from flask_sqlalchemy import SQLAlchemy
+from flask import current_app
 
-from sqlalchemy.engine import Engine
+import sqlalchemy as sa
 from sqlalchemy import event
 
+from .routing import READ_ENGINES, RoutingSQLAlchemy, replica_bind, set_read_only
 
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
+
+def set_sqlite_pragmas(dbapi_connection, pragmas):
+    """Enable foreign keys and run the PRAGMAs of the profile on a new connection"""
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
+    for name, value in pragmas.items():
+        cursor.execute(f"PRAGMA {name}={value}")
     cursor.close()
 
 
-db = SQLAlchemy()  # pylint: disable=invalid-name
+def sqlite_pragmas(connection):
+    """Current value of foreign_keys and of the PRAGMAs of the profile on a connection"""
+    names = ['foreign_keys', *current_app.config['SQLITE_PRAGMAS']]
+    return {name: connection.execute(f"PRAGMA {name}").scalar() for name in names}
+
+
+# names of the constraints created, which errors.integrity_errors maps to request fields
+NAMING_CONVENTION = {
+    'ix': 'ix_%(column_0_label)s',
+    'uq': 'uq_%(table_name)s_%(column_0_name)s',
+    'fk': 'fk_%(table_name)s_%(column_0_name)s_%(referred_table_name)s',
+    'pk': 'pk_%(table_name)s',
+}
+
+db = RoutingSQLAlchemy(metadata=sa.MetaData(naming_convention=NAMING_CONVENTION))  # pylint: disable=invalid-name
+
+
+def _on_connect(engine, app, read_only=False):
+    """Set up the new connections of engine"""
+    dialect_name = engine.dialect.name
+    pragmas = dict(app.config['SQLITE_PRAGMAS'])
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):
+        if dialect_name == 'sqlite':
+            set_sqlite_pragmas(dbapi_connection, pragmas)
+        if read_only:
+            set_read_only(dbapi_connection, dialect_name)
 
 
 def init_app(app):
     """Initialize relational database extension"""
+    url = sa.engine.url.make_url(app.config['SQLALCHEMY_DATABASE_URI'])
+    if url.get_backend_name() != 'sqlite':
+        # SQLite connections aren't pooled the same way, the pool settings only apply to client/server databases
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'pool_size': app.config['DATABASE_POOL_SIZE'],
+            'max_overflow': app.config['DATABASE_POOL_MAX_OVERFLOW'],
+            'pool_timeout': app.config['DATABASE_POOL_TIMEOUT'],
+            'pool_recycle': app.config['DATABASE_POOL_RECYCLE'],
+            'pool_pre_ping': app.config['DATABASE_POOL_PRE_PING'],
+            **app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}),
+        }
+    if url.get_dialect().driver == 'psycopg2':
+        app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+            'executemany_mode': app.config['DATABASE_EXECUTEMANY_MODE'],
+            **app.config['SQLALCHEMY_ENGINE_OPTIONS'],
+        }
+
+    replicas = app.config['DATABASE_REPLICA_URLS']
+    if replicas:
+        app.config['SQLALCHEMY_BINDS'] = {
+            **(app.config.get('SQLALCHEMY_BINDS') or {}),
+            **{replica_bind(index): replica for index, replica in enumerate(replicas)},
+        }
+
     db.init_app(app)
 
-    db.create_all(app=app)
+    engine = db.get_engine(app)
+    _on_connect(engine, app)
+    read_engines = [db.get_engine(app, bind=replica_bind(index)) for index in range(len(replicas))]
+    for read_engine in read_engines:
+        _on_connect(read_engine, app, read_only=True)
+    app.extensions[READ_ENGINES] = read_engines
+
+    upgrade(engine)
+
+
+from .errors import abort_on_stale_data, integrity_errors  # noqa: E402,F401
+from .migrations import add_missing_columns, create_indexes, revision, upgrade  # noqa: E402,F401
+from .versions import bump_versions, get_versions, rebuild_table_stats, tracked_tables  # noqa: E402,F401
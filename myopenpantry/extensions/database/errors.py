@@ -0,0 +1,80 @@
+"""Integrity errors and concurrent modifications
+
+Maps the constraint an IntegrityError violated to the request field it concerns. Constraints are named by
+NAMING_CONVENTION. PostgreSQL reports the name of the violated constraint. SQLite only reports the columns of a
+unique constraint, which are matched against the constraints of the table, and nothing at all about a foreign key.
+"""
+from contextlib import contextmanager
+import re
+
+from flask_smorest import abort
+import sqlalchemy as sa
+from sqlalchemy.orm.exc import StaleDataError
+
+from . import db
+
+# SQLite's message for unique constraints and unique indexes
+SQLITE_UNIQUE = re.compile(r'UNIQUE constraint failed: (?P<columns>[\w.]+(?:, [\w.]+)*)')
+SQLITE_FOREIGN_KEY = 'FOREIGN KEY constraint failed'
+
+
+def _unique_names(table, columns):
+    """Names of the unique constraints and indexes of table over exactly columns, the primary key included"""
+    candidates = [
+        constraint for constraint in table.constraints
+        if isinstance(constraint, (sa.UniqueConstraint, sa.PrimaryKeyConstraint))
+    ]
+    candidates += [index for index in table.indexes if index.unique]
+    return [
+        candidate.name for candidate in candidates if {column.name for column in candidate.columns} == columns
+    ]
+
+
+def violated_constraints(error):
+    """Names of the constraints an IntegrityError may have violated
+
+    The single violated one when the database reports it. SQLite doesn't tell which foreign key failed, so every
+    foreign key is a candidate then.
+    """
+    diag = getattr(error.orig, 'diag', None)
+    if diag is not None:
+        # psycopg2
+        return [diag.constraint_name] if diag.constraint_name else []
+
+    message = str(error.orig)
+    match = SQLITE_UNIQUE.search(message)
+    if match is not None:
+        columns = [column.split('.') for column in match.group('columns').split(', ')]
+        table = db.Model.metadata.tables.get(columns[0][0])
+        if table is None:
+            return []
+        return _unique_names(table, {name for _, name in columns})
+
+    if SQLITE_FOREIGN_KEY in message:
+        tables = db.Model.metadata.tables.values()
+        return [constraint.name for table in tables for constraint in table.foreign_key_constraints]
+
+    return []
+
+
+def integrity_errors(error, fields):
+    """Field errors of an IntegrityError, fields maps constraint names to a (field, message) pair"""
+    errors = {}
+    for name in violated_constraints(error):
+        if name in fields:
+            field, message = fields[name]
+            errors.setdefault(field, []).append(message)
+    return errors
+
+
+@contextmanager
+def abort_on_stale_data():
+    """Roll back and abort with 412 when a row written was modified by another request since it was read
+
+    The version_id_col of the models makes the UPDATE or DELETE match no row then, see models/row_versions.py.
+    """
+    try:
+        yield
+    except StaleDataError:
+        db.session.rollback()
+        abort(412, message="The resource was modified by another request.")
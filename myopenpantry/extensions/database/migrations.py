@@ -0,0 +1,111 @@
+"""Schema migrations
+
+Revisions are numbered functions upgrading the schema, registered with the revision decorator and recorded in
+schema_revisions once applied. An empty database gets the current schema from the models at once and is stamped
+with every revision. Databases created before revisions were recorded start from revision 1.
+
+Starting an app only reads the latest applied revision. The schema is introspected and written only when that
+revision is behind, so workers don't issue DDL or catalog queries once it is current.
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy import exc
+from sqlalchemy.schema import CreateColumn, CreateIndex
+
+from . import db
+
+schema_revisions = db.Table(
+    'schema_revisions', db.Model.metadata,
+    db.Column('revision', db.Integer, primary_key=True),
+    db.Column('description', db.Text, nullable=False),
+    db.Column('applied_at', db.DateTime, nullable=False, default=datetime.now),
+)
+
+# number -> (description, upgrade(connection))
+REVISIONS = {}
+
+
+def revision(number, description):
+    """Register the decorated function as the upgrade of revision number"""
+    def decorator(upgrade):
+        if number in REVISIONS:
+            raise ValueError(f'Revision {number} is already registered')
+        REVISIONS[number] = (description, upgrade)
+        return upgrade
+    return decorator
+
+
+def head():
+    """Number of the latest revision"""
+    return max(REVISIONS, default=0)
+
+
+def current_revision(engine):
+    """Latest applied revision, None when the database doesn't record them"""
+    # its own connection, a failed statement aborts the transaction on PostgreSQL
+    with engine.connect() as connection:
+        try:
+            return connection.execute(sa.select([sa.func.coalesce(sa.func.max(schema_revisions.c.revision), 0)]))\
+                .scalar()
+        except exc.DBAPIError:
+            return None
+
+
+def _stamp(connection, numbers):
+    if numbers:
+        connection.execute(schema_revisions.insert(), [
+            {'revision': number, 'description': REVISIONS[number][0]} for number in numbers
+        ])
+
+
+def upgrade(engine):
+    """Apply the revisions the database is missing, returns their numbers"""
+    current = current_revision(engine)
+    if current is not None and current >= head():
+        return []
+
+    try:
+        return _upgrade(engine, current)
+    except exc.DBAPIError:
+        # another worker may have applied them meanwhile
+        if (current_revision(engine) or 0) >= head():
+            return []
+        raise
+
+
+def _upgrade(engine, current):
+    with engine.begin() as connection:
+        if current is None:
+            tables = set(sa.inspect(connection).get_table_names())
+            if not tables & set(db.Model.metadata.tables):
+                # empty database, the models already describe the latest revision
+                db.Model.metadata.create_all(connection)
+                _stamp(connection, sorted(REVISIONS))
+                return sorted(REVISIONS)
+            schema_revisions.create(connection)
+            current = 0
+
+        pending = sorted(number for number in REVISIONS if number > current)
+        for number in pending:
+            REVISIONS[number][1](connection)
+        _stamp(connection, pending)
+    return pending
+
+
+def add_missing_columns(connection, table):
+    """Add the columns of table the database doesn't have, which must be nullable or have a server default"""
+    existing = {column['name'] for column in sa.inspect(connection).get_columns(table.name)}
+    for column in table.columns:
+        if column.name not in existing:
+            definition = CreateColumn(column).compile(dialect=connection.dialect)
+            connection.execute(f'ALTER TABLE {table.name} ADD COLUMN {definition}')
+
+
+def create_indexes(connection, *names):
+    """Create the indexes of the models with the given names, skipping those that exist"""
+    indexes = {index.name: index for table in db.Model.metadata.tables.values() for index in table.indexes}
+    for name in names:
+        # CreateIndex has no IF NOT EXISTS option yet, both SQLite and PostgreSQL support it
+        ddl = str(CreateIndex(indexes[name]).compile(dialect=connection.dialect))
+        connection.execute(ddl.replace('INDEX', 'INDEX IF NOT EXISTS', 1))
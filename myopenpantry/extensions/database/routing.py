@@ -0,0 +1,62 @@
+"""Read/write routing
+
+The reads of GET and HEAD requests go to one of the read engines of DATABASE_REPLICA_URLS when there are any, so
+read-heavy traffic doesn't contend with the writer. Everything else goes to the primary, as do the reads of a
+session once it has flushed, so a request keeps reading its own writes after committing them. Requests that
+write are routed to the primary from the start, a replica lagging behind never answers them.
+"""
+import random
+
+from flask import has_request_context, request
+from flask_sqlalchemy import SignallingSession, SQLAlchemy
+
+import sqlalchemy as sa
+
+READ_METHODS = ('GET', 'HEAD')
+# key of the read engines of an app in app.extensions
+READ_ENGINES = 'database_read_engines'
+
+
+def replica_bind(index):
+    """Bind key of the read engine of the index-th replica URL"""
+    return f'replica_{index}'
+
+
+class RoutingSession(SignallingSession):
+    """Session sending the reads of GET and HEAD requests to a read engine, see the module docstring"""
+
+    def __init__(self, db, **options):
+        # a session sticks to the read engine it picked, its reads share one connection and snapshot
+        self.read_engine = None
+        self.wrote = False
+        super().__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        if self._flushing:
+            self.wrote = True
+        elif not self.wrote and has_request_context() and request.method in READ_METHODS:
+            engines = self.app.extensions.get(READ_ENGINES)
+            if engines:
+                if self.read_engine is None:
+                    self.read_engine = random.choice(engines)
+                return self.read_engine
+        return super().get_bind(mapper, clause)
+
+
+class RoutingSQLAlchemy(SQLAlchemy):
+    """Flask-SQLAlchemy creating RoutingSessions"""
+
+    def create_session(self, options):
+        return sa.orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+def set_read_only(dbapi_connection, dialect_name):
+    """Make a new connection of a read engine refuse writes, in case one is routed to it by mistake"""
+    cursor = dbapi_connection.cursor()
+    if dialect_name == 'sqlite':
+        cursor.execute("PRAGMA query_only=ON")
+    elif dialect_name == 'postgresql':
+        cursor.execute("SET SESSION CHARACTERISTICS AS TRANSACTION READ ONLY")
+        # psycopg2 ran it in a transaction of its own
+        dbapi_connection.commit()
+    cursor.close()
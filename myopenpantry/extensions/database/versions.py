@@ -0,0 +1,180 @@
+"""Per table write versions and row counts
+
+Every flush bumps the version of the tables it wrote to and adjusts their row counts in the same transaction.
+Caches compare these versions to know if an entry is still valid, which holds across worker processes since the
+versions live in the database. Writes that bypass the ORM must call bump_versions themselves.
+
+All the writers of a table update its table_stats row, which stays locked until they commit. So the bumps of a
+transaction are only summed up on its connection as it goes, and written right before it commits, in the order
+of the table names. Writers then only wait on each other for the duration of a commit, and can't deadlock by
+bumping the same tables in different orders.
+"""
+from itertools import chain
+
+import sqlalchemy as sa
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session, object_mapper, scoped_session
+from sqlalchemy.pool import Pool
+from sqlalchemy.sql.util import find_tables
+
+from . import db
+
+table_stats = db.Table(
+    'table_stats', db.Model.metadata,
+    db.Column('name', db.String(64), primary_key=True),
+    db.Column('version', db.Integer, nullable=False, default=0),
+    db.Column('row_count', db.Integer, nullable=False, default=0),
+)
+
+
+def tracked_tables(clause=None):
+    """Sorted names of the tables with versions, only those referenced by clause if given"""
+    if clause is None:
+        tables = db.Model.metadata.tables.values()
+    else:
+        tables = find_tables(clause, include_aliases=True, include_joins=True)
+
+    return sorted({
+        table.name for table in tables
+        if isinstance(table, sa.Table) and table.name in db.Model.metadata.tables and table is not table_stats
+    })
+
+
+# key of Connection.info summing the row count deltas of the tables written by its transaction
+PENDING_BUMPS = 'pending_table_bumps'
+
+
+def _connection(bind):
+    # the connection of a session's transaction
+    if isinstance(bind, (Session, scoped_session)):
+        return bind.connection()
+    return bind
+
+
+def get_versions(connection, names):
+    """Map each table name to its (version, row_count)
+
+    Tables the transaction of connection wrote to are left out, like tables without stats, since their new
+    version isn't known until it commits.
+    """
+    if not names:
+        return {}
+
+    connection = _connection(connection)
+    pending = connection.info.get(PENDING_BUMPS, {})
+    rows = connection.execute(sa.select([table_stats]).where(table_stats.c.name.in_(names)))
+    return {row.name: (row.version, row.row_count) for row in rows if row.name not in pending}
+
+
+def bump_versions(connection, row_counts):
+    """Bump the version of each table name in row_counts once the transaction commits, adjusting its row count by
+    the mapped delta"""
+    if not row_counts:
+        return
+
+    pending = _connection(connection).info.setdefault(PENDING_BUMPS, {})
+    for name, delta in row_counts.items():
+        pending[name] = pending.get(name, 0) + delta
+
+
+@event.listens_for(Engine, 'commit')
+def write_pending_bumps(connection):
+    """Write the bumps of the committing transaction, in a fixed order"""
+    pending = connection.info.pop(PENDING_BUMPS, None)
+    if pending:
+        connection.execute(
+            table_stats.update().where(table_stats.c.name == sa.bindparam('table_name')).values(
+                version=table_stats.c.version + 1, row_count=table_stats.c.row_count + sa.bindparam('delta')
+            ),
+            [{'table_name': name, 'delta': delta} for name, delta in sorted(pending.items())]
+        )
+
+
+@event.listens_for(Engine, 'rollback')
+def discard_pending_bumps(connection):
+    connection.info.pop(PENDING_BUMPS, None)
+
+
+@event.listens_for(Pool, 'reset')
+def discard_returned_bumps(dbapi_connection, connection_record):
+    # connections returned without ending their transaction are rolled back
+    connection_record.info.pop(PENDING_BUMPS, None)
+
+
+def rebuild_table_stats(connection):
+    """Add missing rows to table_stats and recount the rows of every table"""
+    existing = {row.name for row in connection.execute(sa.select([table_stats.c.name]))}
+
+    for name in tracked_tables():
+        count = connection.execute(
+            sa.select([sa.func.count()]).select_from(db.Model.metadata.tables[name])
+        ).scalar()
+        if name in existing:
+            connection.execute(
+                table_stats.update().where(table_stats.c.name == name).values(
+                    version=table_stats.c.version + 1, row_count=count
+                )
+            )
+        else:
+            connection.execute(table_stats.insert().values(name=name, version=0, row_count=count))
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def seed_table_stats(target, connection, **kw):
+    """Add rows for tables created since the last start"""
+    existing = {row.name for row in connection.execute(sa.select([table_stats.c.name]))}
+
+    for name in tracked_tables():
+        if name not in existing:
+            count = connection.execute(sa.select([sa.func.count()]).select_from(target.tables[name])).scalar()
+            connection.execute(table_stats.insert().values(name=name, version=0, row_count=count))
+
+
+@event.listens_for(db.session, 'after_flush')
+def bump_flushed_versions(session, flush_context):
+    """Bump the versions of the tables written by this flush"""
+    row_counts = {}
+    # many to many rows, as {table: {frozenset of both ends}}, since both sides of the relationship report them
+    added_pairs = {}
+    removed_pairs = {}
+
+    def touch(table, delta=0):
+        row_counts[table.name] = row_counts.get(table.name, 0) + delta
+
+    for obj in session.new:
+        for table in object_mapper(obj).tables:
+            touch(table, 1)
+
+    for obj in session.deleted:
+        for table in object_mapper(obj).tables:
+            touch(table, -1)
+
+    for obj in session.dirty:
+        if session.is_modified(obj, include_collections=False):
+            for table in object_mapper(obj).tables:
+                touch(table)
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        attrs = sa.inspect(obj).attrs
+        deleted = obj in session.deleted
+        for relationship in object_mapper(obj).relationships:
+            if not isinstance(relationship.secondary, sa.Table):
+                continue
+            history = attrs[relationship.key].history
+            added = history.added or ()
+            removed = list(history.deleted or ())
+            if deleted:
+                # the rows of a deleted object are removed as well
+                removed += history.unchanged or ()
+                touch(relationship.secondary)
+            for pairs, children in ((added_pairs, added), (removed_pairs, removed)):
+                if children:
+                    pairs.setdefault(relationship.secondary, set()).update(
+                        frozenset((id(obj), id(child))) for child in children
+                    )
+
+    for table in added_pairs.keys() | removed_pairs.keys():
+        touch(table, len(added_pairs.get(table, ())) - len(removed_pairs.get(table, ())))
+
+    bump_versions(session.connection(), row_counts)
@@ -0,0 +1,6 @@
+"""Schema revisions, applied in order on startup by extensions/database/migrations.py
+
+Add a module for every change the models make to existing tables, such as a new column or index, and import it
+here. New tables don't need one, revision 1 creates the tables the database is missing.
+"""
+from . import v001_unversioned, v002_foreign_key_indexes, v003_lower_name_collation  # noqa
@@ -0,0 +1,32 @@
+"""Bring databases created by create_all before revisions were recorded up to date"""
+import sqlalchemy as sa
+
+from myopenpantry.extensions.database import add_missing_columns, create_indexes, db, revision
+from myopenpantry.models import RECIPES_FTS_DDL, refresh_availability, units
+
+
+@revision(1, 'Add the tables, columns and indexes create_all left out')
+def upgrade(connection):
+    metadata = db.Model.metadata
+    existing = set(sa.inspect(connection).get_table_names())
+
+    # create_all skips the tables that exist, even when their model gained columns since
+    for table in metadata.sorted_tables:
+        if table.name in existing:
+            add_missing_columns(connection, table)
+    metadata.create_all(connection, tables=[table for table in metadata.sorted_tables if table.name not in existing])
+
+    create_indexes(
+        connection,
+        'ix_recipes_missing_ingredient_count',
+        'ix_items_lower_name',
+        'ix_ingredients_lower_name',
+        'ix_tags_lower_name',
+    )
+    if connection.dialect.name == 'sqlite':
+        for statement in RECIPES_FTS_DDL:
+            connection.execute(statement)
+
+    # the canonical quantities and availability counters were added empty or with their defaults
+    units.backfill_quantities(connection)
+    refresh_availability(connection)
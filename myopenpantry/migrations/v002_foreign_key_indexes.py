@@ -0,0 +1,16 @@
+"""Index the foreign keys looked up in reverse
+
+Ingredient.items, Ingredient.recipes and Tag.recipes filter on foreign keys that aren't the leading column of an
+index, which scanned the whole table.
+"""
+from myopenpantry.extensions.database import create_indexes, revision
+
+
+@revision(2, 'Index items.ingredient_id, recipe_ingredients.ingredient_id and recipe_tags.tag_id')
+def upgrade(connection):
+    create_indexes(
+        connection,
+        'ix_items_ingredient_id',
+        'ix_recipe_ingredients_ingredient_id_recipe_id',
+        'ix_recipe_tags_tag_id_recipe_id',
+    )
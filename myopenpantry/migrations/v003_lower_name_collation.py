@@ -0,0 +1,17 @@
+"""Compare lowercased names byte by byte on PostgreSQL
+
+The lower(name) indexes of name_startswith used the collation of the database, whose order the prefix ranges
+don't follow when it isn't C. SQLite's indexes are unchanged.
+"""
+from myopenpantry.extensions.database import create_indexes, revision
+
+LOWER_NAME_INDEXES = ('ix_items_lower_name', 'ix_ingredients_lower_name', 'ix_tags_lower_name')
+
+
+@revision(3, 'Recreate the lower(name) indexes with the C collation on PostgreSQL')
+def upgrade(connection):
+    if connection.dialect.name != 'postgresql':
+        return
+    for name in LOWER_NAME_INDEXES:
+        connection.execute(f'DROP INDEX IF EXISTS {name}')
+    create_indexes(connection, *LOWER_NAME_INDEXES)
@@ -1,5 +1,9 @@
 from .associations import RecipeIngredient, recipe_tags # noqa
 from .ingredients import Ingredient # noqa
-from .recipes import Recipe # noqa
+from .recipes import Recipe, RECIPES_FTS_DDL, recipes_document, recipes_fts # noqa
 from .items import Item # noqa
 from .tags import Tag # noqa
+from .availability import refresh_availability # noqa
+from .row_versions import touch_rows, touch_nesting_rows # noqa
+from .name_index import index_names, name_contains, name_startswith, rebuild_name_index # noqa
+from . import units # noqa
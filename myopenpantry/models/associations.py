@@ -9,7 +9,9 @@ Base = declarative_base()
 recipe_tags = db.Table(
     'recipe_tags', db.Model.metadata,
     db.Column('recipe_id', db.Integer, db.ForeignKey('recipes.id'), primary_key=True),
-    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'), primary_key=True)
+    db.Column('tag_id', db.Integer, db.ForeignKey('tags.id'), primary_key=True),
+    # covering index for finding the recipes of tags, the primary key covers the other direction
+    db.Index('ix_recipe_tags_tag_id_recipe_id', 'tag_id', 'recipe_id'),
 )
 
 
@@ -21,10 +23,19 @@ class RecipeIngredient(db.Model):
     recipe_id = sa.Column(sa.Integer, sa.ForeignKey('recipes.id'), primary_key=True)
     ingredient_id = sa.Column(sa.Integer, sa.ForeignKey('ingredients.id'), primary_key=True)
 
-    # The 5 is arbitrary and I've never seen a recipe need more than 3 decimal places
-    amount = sa.Column(sa.Numeric(5, 3))
+    # The 10 is arbitrary, it only needs to fit amounts like 500 g. I've never seen a recipe need more than 3 decimal
+    # places
+    amount = sa.Column(sa.Numeric(10, 3))
     # setting this to text is easier than enumerating all possible units and potential abbreviations
     unit = sa.Column(sa.Text)
+    # amount converted to the base unit of its dimension. See models/units.py
+    quantity = sa.Column(sa.Float)
+    dimension = sa.Column(sa.String(16))
 
     ingredient = relationship("Ingredient", back_populates="recipes")
     recipe = relationship("Recipe", back_populates="ingredients")
+
+    __table_args__ = (
+        # covering index for finding the recipes of ingredients, the primary key covers the other direction
+        sa.Index('ix_recipe_ingredients_ingredient_id_recipe_id', 'ingredient_id', 'recipe_id'),
+    )
@@ -0,0 +1,110 @@
+"""Denormalized recipe availability
+
+Ingredient.in_stock and Recipe.missing_ingredient_count are kept current by a session listener,
+so that filtering the recipes that can be made is an indexed equality check instead of a join.
+"""
+from itertools import chain
+
+import sqlalchemy as sa
+from sqlalchemy import event, inspect
+
+from myopenpantry.extensions.database import db, bump_versions
+
+from .associations import RecipeIngredient
+from .ingredients import Ingredient
+from .items import Item
+from .recipes import Recipe
+from .row_versions import touch_rows, versions_bumped
+
+
+def _recount(missing):
+    # keep updated_at untouched, the counters are not user visible edits of the recipe. They are part of its
+    # representation though, so the version moves
+    recipes = Recipe.__table__
+    return {'missing_ingredient_count': missing, 'updated_at': recipes.c.updated_at, 'version': recipes.c.version + 1}
+
+
+def refresh_availability(connection, ingredient_ids=None, recipe_ids=None):
+    """Recompute availability counters
+
+    Recipes are only recounted when listed in recipe_ids or when they use an ingredient whose stock
+    status changed. Calling without any ids rebuilds every counter from scratch to repair drift. Returns the
+    (model, ids) whose versions may have been bumped, ids being a collection or a select of ids.
+    """
+    ingredients = Ingredient.__table__
+    items = Item.__table__
+    recipe_ingredients = RecipeIngredient.__table__
+    recipes = Recipe.__table__
+
+    in_stock = sa.exists().where(sa.and_(items.c.ingredient_id == ingredients.c.id, items.c.amount > 0))
+    missing = sa.select([sa.func.count()]).select_from(
+        recipe_ingredients.join(ingredients, recipe_ingredients.c.ingredient_id == ingredients.c.id)
+    ).where(sa.and_(recipe_ingredients.c.recipe_id == recipes.c.id, ~ingredients.c.in_stock)).as_scalar()
+
+    rebuild = ingredient_ids is None and recipe_ids is None
+
+    touched = []
+    flipped = []
+    if ingredient_ids or rebuild:
+        changed = ingredients.c.in_stock != in_stock
+        if not rebuild:
+            changed = sa.and_(ingredients.c.id.in_(ingredient_ids), changed)
+        flipped = [row.id for row in connection.execute(sa.select([ingredients.c.id]).where(changed))]
+
+    if flipped:
+        connection.execute(ingredients.update().where(ingredients.c.id.in_(flipped)).values(
+            in_stock=in_stock, version=ingredients.c.version + 1
+        ))
+        bump_versions(connection, {ingredients.name: 0})
+        # items nest their ingredient, recipes are versioned by the recount below
+        nesting_items = sa.select([items.c.id]).where(items.c.ingredient_id.in_(flipped))
+        touch_rows(connection, Item, nesting_items)
+        touched += [(Ingredient, flipped), (Item, nesting_items)]
+
+    affected = []
+    if recipe_ids:
+        affected.append(recipes.c.id.in_(recipe_ids))
+    if flipped:
+        affected.append(recipes.c.id.in_(
+            sa.select([recipe_ingredients.c.recipe_id]).where(recipe_ingredients.c.ingredient_id.in_(flipped))
+        ))
+
+    if affected or rebuild:
+        # only write the counters that changed
+        changed = recipes.c.missing_ingredient_count != missing
+        if not rebuild:
+            changed = sa.and_(sa.or_(*affected), changed)
+        connection.execute(recipes.update().where(changed).values(**_recount(missing)))
+        bump_versions(connection, {recipes.name: 0})
+        # the recounted recipes are among those affected
+        recounted = sa.select([recipes.c.id])
+        if not rebuild:
+            recounted = recounted.where(sa.or_(*affected))
+        touched.append((Recipe, recounted))
+
+    return touched
+
+
+def _history_values(obj, key):
+    return {value for value in inspect(obj).attrs[key].history.sum() if value is not None}
+
+
+@event.listens_for(db.session, 'after_flush')
+def update_availability(session, flush_context):
+    """Refresh the counters touched by the items and recipe ingredients in this flush"""
+    ingredient_ids = set()
+    recipe_ids = set()
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, Item):
+            attrs = inspect(obj).attrs
+            if obj in session.dirty and not (
+                attrs.amount.history.has_changes() or attrs.ingredient_id.history.has_changes()
+            ):
+                continue
+            ingredient_ids.update(_history_values(obj, 'ingredient_id'))
+        elif isinstance(obj, RecipeIngredient):
+            recipe_ids.update(_history_values(obj, 'recipe_id'))
+
+    if ingredient_ids or recipe_ids:
+        versions_bumped(session, refresh_availability(session.connection(), ingredient_ids, recipe_ids))
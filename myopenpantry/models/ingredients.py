@@ -10,8 +10,17 @@ class Ingredient(db.Model):
 
     id = sa.Column(sa.Integer, primary_key=True)
     name = sa.Column(sa.String(128), nullable=False, unique=True)
+    # denormalized, true when any item of this ingredient has amount > 0. See models/availability.py
+    in_stock = sa.Column(sa.Boolean, nullable=False, default=False, server_default=sa.false())
+    # optional overrides to convert between mass, volume and counts. See models/units.py
+    density = sa.Column(sa.Float)  # grams per milliliter
+    piece_weight = sa.Column(sa.Float)  # grams per piece
+    # incremented on every change, see models/row_versions.py
+    version = sa.Column(sa.Integer, nullable=False, server_default='1')
 
     # many to one, with Ingredient being the one
     items = relationship('Item', back_populates="ingredient")
     # many to many
     recipes = relationship("RecipeIngredient", back_populates="ingredient")
+
+    __mapper_args__ = {'version_id_col': version}
@@ -12,10 +12,19 @@ class Item(db.Model):
     id = sa.Column(sa.Integer, primary_key=True)
     name = sa.Column(sa.Text, nullable=False, unique=True)
     # is nullable, specifically for produce since not everyone will want to use PLUS
-    product_id = sa.Column(sa.Integer, unique=True)
+    product_id = sa.Column(sa.BigInteger, unique=True)
     amount = sa.Column(sa.Integer, nullable=False, default=0)
+    # unit of the amount, a count of the item when not set
+    unit = sa.Column(sa.Text)
+    # amount converted to the base unit of its dimension. See models/units.py
+    quantity = sa.Column(sa.Float)
+    dimension = sa.Column(sa.String(16))
     updated_at = sa.Column(sa.DateTime, default=datetime.now, onupdate=datetime.now)
+    # incremented on every change, see models/row_versions.py
+    version = sa.Column(sa.Integer, nullable=False, server_default='1')
 
     # Many to one, each Item is one type of ingredient (eg Item('Kroger Large Eggs') -> Ingredient('Eggs'))
-    ingredient_id = sa.Column(sa.Integer, sa.ForeignKey('ingredients.id'))
+    ingredient_id = sa.Column(sa.Integer, sa.ForeignKey('ingredients.id'), index=True)
     ingredient = relationship("Ingredient", back_populates="items")
+
+    __mapper_args__ = {'version_id_col': version}
@@ -0,0 +1,234 @@
+"""Name index
+
+``name LIKE '%x%'`` can't use an index, so item, ingredient and tag names are also split into lowercase trigrams
+kept in name_trigrams. A row whose name contains x has every trigram of x, which narrows the rows to check to
+those with all of them before the LIKE verifies the match. Prefix searches use an index on lower(name), compared
+byte by byte.
+"""
+from collections import defaultdict
+
+import sqlalchemy as sa
+from sqlalchemy import event, inspect
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+
+from myopenpantry.extensions.database import db, bump_versions
+
+from .ingredients import Ingredient
+from .items import Item
+from .tags import Tag
+
+NAME_INDEXED = (Item, Ingredient, Tag)
+# rows indexed per statement
+BATCH_SIZE = 500
+# trigrams of a search looked up at most
+MAX_TRIGRAMS = 8
+
+name_trigrams = db.Table(
+    'name_trigrams', db.Model.metadata,
+    # name of the table of the row
+    db.Column('table_name', db.String(32), primary_key=True),
+    db.Column('trigram', db.String(3), primary_key=True),
+    db.Column('row_id', db.Integer, primary_key=True),
+    # the primary key answers the searches, don't store it twice
+    sqlite_with_rowid=False,
+)
+# finds the trigrams of a row to replace
+sa.Index('ix_name_trigrams_row', name_trigrams.c.table_name, name_trigrams.c.row_id)
+
+
+class lower_bytes(FunctionElement):  # pylint: disable=invalid-name
+    """lower() of a text, compared byte by byte as the ranges of name_startswith require
+
+    SQLite compares text that way unless told otherwise. PostgreSQL uses the collation of the database, which may
+    ignore punctuation like en_US does, so the C collation is given explicitly.
+    """
+    name = 'lower_bytes'
+    type = sa.Text()
+
+
+@compiles(lower_bytes)
+def _compile_lower_bytes(element, compiler, **kw):
+    return f'lower({compiler.process(element.clauses, **kw)})'
+
+
+@compiles(lower_bytes, 'postgresql')
+def _compile_lower_bytes_postgresql(element, compiler, **kw):
+    # in parentheses, as index expressions other than function calls must be
+    return f'(lower({compiler.process(element.clauses, **kw)}) COLLATE "C")'
+
+
+class lower_successor(FunctionElement):  # pylint: disable=invalid-name
+    """lower() of head followed by the character after lower() of last, the end of the range of name_startswith
+
+    Greater, byte by byte, than any text starting with lower() of head and last. last is a single character.
+    """
+    name = 'lower_successor'
+    type = sa.Text()
+
+
+@compiles(lower_successor)
+def _compile_lower_successor(element, compiler, **kw):
+    head, last = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f'(lower({head}) || char(unicode(lower({last})) + 1))'
+
+
+@compiles(lower_successor, 'postgresql')
+def _compile_lower_successor_postgresql(element, compiler, **kw):
+    head, last = (compiler.process(clause, **kw) for clause in element.clauses)
+    return f'((lower({head}) || chr(ascii(lower({last})) + 1)) COLLATE "C")'
+
+
+# answer name_startswith
+for model in NAME_INDEXED:
+    sa.Index(f'ix_{model.__tablename__}_lower_name', lower_bytes(model.name))
+
+
+def trigrams(name):
+    """Distinct lowercase trigrams of a name"""
+    name = name.lower()
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+
+def _split_names(dialect, table, longest):
+    """Select the table name, trigrams and id of the rows of table with the ids of the expanding bindparam ids
+
+    Their names must be ASCII, the only characters SQL's lower() and Python's lower() agree on everywhere.
+    """
+    positions = sa.select([sa.literal(1).label('position')]).cte('positions', recursive=True)
+    positions = positions.union_all(sa.select([positions.c.position + 1]).where(positions.c.position < longest - 2))
+    name = sa.func.lower(table.c.name)
+    trigram = sa.func.substr(name, positions.c.position, 3)
+    # the first occurrence of each trigram only, cheaper than a DISTINCT
+    first = (sa.func.strpos if dialect.name == 'postgresql' else sa.func.instr)(name, trigram)
+    return sa.select([sa.literal(table.name), trigram, table.c.id]).where(sa.and_(
+        table.c.id.in_(sa.bindparam('ids', expanding=True)),
+        positions.c.position <= sa.func.length(name) - 2,
+        first == positions.c.position,
+    )).order_by(trigram, table.c.id)
+
+
+def index_names(connection, model, names, new=False):
+    """Replace the trigrams of the rows of model, names maps their ids to their new name or None once deleted
+
+    The rows must have been written already, ASCII names are split by the database from the rows. new rows have
+    no trigrams to replace yet.
+    """
+    table = model.__table__
+    ids = sorted(names)
+    delta = 0
+    # keep the number of bound parameters under SQLite's limit
+    for start in range(0, len(ids), BATCH_SIZE):
+        batch = ids[start:start + BATCH_SIZE]
+        if not new:
+            delta -= connection.execute(name_trigrams.delete().where(sa.and_(
+                name_trigrams.c.table_name == table.name,
+                name_trigrams.c.row_id.in_(sa.bindparam('ids', expanding=True)),
+            )), ids=batch).rowcount
+
+        split = [row_id for row_id in batch if names[row_id] is not None and names[row_id].isascii()]
+        longest = max((len(names[row_id]) for row_id in split), default=0)
+        if longest >= 3:
+            # one statement instead of a bound row per trigram
+            delta += connection.execute(name_trigrams.insert().from_select(
+                ['table_name', 'trigram', 'row_id'], _split_names(connection.dialect, table, longest)
+            ), ids=split).rowcount
+
+        # in primary key order, consecutive rows land on the same pages
+        rows = [
+            {'trigram': trigram, 'row_id': row_id}
+            for trigram, row_id in sorted(
+                (trigram, row_id)
+                for row_id in batch if names[row_id] is not None and not names[row_id].isascii()
+                for trigram in trigrams(names[row_id])
+            )
+        ]
+        if rows:
+            # the table name is rendered once instead of bound per row
+            connection.execute(name_trigrams.insert().values(table_name=table.name), rows)
+        delta += len(rows)
+    bump_versions(connection, {name_trigrams.name: delta})
+
+
+def rebuild_name_index(connection):
+    """Index the names of every row"""
+    connection.execute(name_trigrams.delete())
+    for model in NAME_INDEXED:
+        table = model.__table__
+        # BATCH_SIZE rows at a time after the last id indexed, so memory doesn't grow with the table
+        after = None
+        while True:
+            query = sa.select([table.c.id, table.c.name]).order_by(table.c.id).limit(BATCH_SIZE)
+            if after is not None:
+                query = query.where(table.c.id > after)
+            rows = connection.execute(query).fetchall()
+            if not rows:
+                break
+            index_names(connection, model, dict(rows), new=True)
+            after = rows[-1].id
+
+
+def _escape_like(text):
+    return text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+
+def name_contains(model, text):
+    """Filter clause for the rows of model whose name contains text, ignoring case"""
+    verify = model.name.ilike(f'%{_escape_like(text)}%', escape='\\')
+    grams = sorted(trigrams(text))
+    if not grams:
+        # shorter than a trigram, nothing to narrow the rows with
+        return verify
+
+    # rows having every trigram, each looked up through the primary key. The LIKE verifies the match, so a few of
+    # them narrow the rows enough
+    candidates = [
+        sa.select([name_trigrams.c.row_id]).where(sa.and_(
+            name_trigrams.c.table_name == model.__tablename__, name_trigrams.c.trigram == gram
+        ))
+        for gram in grams[:MAX_TRIGRAMS]
+    ]
+    if len(candidates) > 1:
+        candidates = [sa.intersect(*candidates)]
+    return sa.and_(model.id.in_(candidates[0]), verify)
+
+
+def name_startswith(model, prefix):
+    """Filter clause for the rows of model whose name starts with prefix, ignoring case
+
+    A range over lower(name), which its index answers. The prefix is lowered by the database as well, SQLite's
+    lower() only folds ASCII letters and PostgreSQL's depends on the locale.
+    """
+    lower = lower_bytes(model.name)
+    clause = lower >= lower_bytes(sa.literal(prefix, sa.Text))
+    if prefix and prefix[-1] != '\U0010ffff':
+        clause = sa.and_(clause, lower < lower_successor(prefix[:-1], prefix[-1]))
+    return clause
+
+
+@event.listens_for(db.session, 'after_flush')
+def index_flushed_names(session, flush_context):
+    """Index the names this flush added, changed or removed"""
+    changes = defaultdict(dict)
+
+    for obj in session.new:
+        if isinstance(obj, NAME_INDEXED):
+            changes[type(obj)][obj.id] = obj.name
+    for obj in session.dirty:
+        if isinstance(obj, NAME_INDEXED) and inspect(obj).attrs.name.history.has_changes():
+            changes[type(obj)][obj.id] = obj.name
+    for obj in session.deleted:
+        if isinstance(obj, NAME_INDEXED):
+            changes[type(obj)][obj.id] = None
+
+    if changes:
+        connection = session.connection()
+        for model, names in changes.items():
+            index_names(connection, model, names)
+
+
+@event.listens_for(db.Model.metadata, 'after_create')
+def index_existing_names(target, connection, tables=(), **kw):
+    """Index the rows that existed before name_trigrams was created"""
+    if name_trigrams in tables:
+        rebuild_name_index(connection)
@@ -1,4 +1,5 @@
 import sqlalchemy as sa
+from sqlalchemy import event
 from myopenpantry.extensions.database import db
 
 from datetime import datetime
@@ -14,9 +15,62 @@ class Recipe(db.Model):
     rating = db.Column(sa.Integer)
     created_at = db.Column(sa.DateTime, default=datetime.now)
     updated_at = db.Column(sa.DateTime, default=datetime.now, onupdate=datetime.now)
+    # denormalized, number of ingredients without an item in stock. See models/availability.py
+    missing_ingredient_count = db.Column(sa.Integer, nullable=False, default=0, server_default='0', index=True)
+    # incremented on every change, see models/row_versions.py
+    version = db.Column(sa.Integer, nullable=False, server_default='1')
 
-    # many to many
-    ingredients = db.relationship("RecipeIngredient", back_populates="recipe")
+    # many to many. The association rows belong to the recipe, replacing or deleting them removes the rows
+    ingredients = db.relationship("RecipeIngredient", back_populates="recipe", cascade="all, delete-orphan")
 
     # many to many to allow filtering recipes by tags such
     tags = db.relationship('Tag', secondary='recipe_tags', back_populates="recipes")
+
+    __mapper_args__ = {'version_id_col': version}
+
+
+# full text index over the recipe text, kept in sync with recipes by triggers. Only created on SQLite, see
+# recipes_document for PostgreSQL
+recipes_fts = sa.Table(
+    'recipes_fts', sa.MetaData(),
+    sa.Column('rowid', sa.Integer, primary_key=True),
+    sa.Column('name', sa.Text),
+    sa.Column('steps', sa.Text),
+    sa.Column('notes', sa.Text),
+    # bm25 score of the row for the current MATCH, lower is better
+    sa.Column('rank', sa.Float),
+)
+
+RECIPES_FTS_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipes_fts USING fts5("
+    "name, steps, notes, content='recipes', content_rowid='id', tokenize='porter unicode61')",
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_insert AFTER INSERT ON recipes BEGIN "
+    "INSERT INTO recipes_fts(rowid, name, steps, notes) VALUES (new.id, new.name, new.steps, new.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_delete AFTER DELETE ON recipes BEGIN "
+    "INSERT INTO recipes_fts(recipes_fts, rowid, name, steps, notes) "
+    "VALUES ('delete', old.id, old.name, old.steps, old.notes); END",
+    "CREATE TRIGGER IF NOT EXISTS recipes_fts_update AFTER UPDATE OF name, steps, notes ON recipes BEGIN "
+    "INSERT INTO recipes_fts(recipes_fts, rowid, name, steps, notes) "
+    "VALUES ('delete', old.id, old.name, old.steps, old.notes); "
+    "INSERT INTO recipes_fts(rowid, name, steps, notes) VALUES (new.id, new.name, new.steps, new.notes); END",
+    # index any recipes that existed before the table was created
+    "INSERT INTO recipes_fts(recipes_fts) VALUES ('rebuild')",
+)
+
+for statement in RECIPES_FTS_DDL:
+    event.listen(Recipe.__table__, 'after_create', sa.DDL(statement).execute_if(dialect='sqlite'))
+
+event.listen(Recipe.__table__, 'before_drop', sa.DDL("DROP TABLE IF EXISTS recipes_fts").execute_if(dialect='sqlite'))
+
+# searched text of recipes on PostgreSQL, which has an expression index over it. The simple configuration neither
+# stems words nor drops stop words, the porter stemmer of recipes_fts has no exact equivalent
+recipes_document = sa.func.to_tsvector(
+    sa.literal_column("'simple'"),
+    sa.func.coalesce(Recipe.name, '') + ' ' + sa.func.coalesce(Recipe.steps, '') + ' '
+    + sa.func.coalesce(Recipe.notes, ''),
+)
+
+event.listen(Recipe.__table__, 'after_create', sa.DDL(
+    "CREATE INDEX IF NOT EXISTS ix_recipes_document ON recipes USING gin "
+    "(to_tsvector('simple', coalesce(name, '') || ' ' || coalesce(steps, '') || ' ' || coalesce(notes, '')))"
+).execute_if(dialect='postgresql'))
@@ -0,0 +1,120 @@
+"""Row versions
+
+Items, ingredients, recipes and tags have a version column. The ORM increments it on every update and adds
+``WHERE version = ?`` to the UPDATE and DELETE statements, so a concurrent change makes them fail instead of
+silently overwriting it. ETags are derived from the version alone (see VersionEtagSchema), which means it must
+also move when something the row's representation nests changes: a recipe's ingredients and tags, or the
+ingredient of an item. This module bumps those versions.
+"""
+from itertools import chain
+
+import sqlalchemy as sa
+from sqlalchemy import event, inspect
+from sqlalchemy.orm.util import identity_key
+
+from myopenpantry.extensions.database import db, bump_versions
+
+from .associations import RecipeIngredient, recipe_tags
+from .ingredients import Ingredient
+from .items import Item
+from .recipes import Recipe
+from .tags import Tag
+
+
+# key of session.info listing the (model, ids) whose versions the flush listeners bumped
+BUMPED_VERSIONS = 'bumped_versions'
+
+
+def touch_rows(connection, model, ids):
+    """Bump the version of the rows of model with the given ids, either a collection or a select of ids"""
+    table = model.__table__
+    values = {'version': table.c.version + 1}
+    if 'updated_at' in table.c:
+        # a new version of the representation, not an edit of the row, keep updated_at from its onupdate
+        values['updated_at'] = table.c.updated_at
+    connection.execute(table.update().where(table.c.id.in_(ids)).values(**values))
+    bump_versions(connection, {table.name: 0})
+
+
+def touch_nesting_rows(connection, ingredient_ids=(), tag_ids=()):
+    """Bump the version of the items and recipes nesting the given ingredients or tags, returns their (model, ids)"""
+    recipe_ingredients = RecipeIngredient.__table__
+    touched = []
+
+    if ingredient_ids:
+        ingredient_ids = sorted(ingredient_ids)
+        touched.append((Item, sa.select([Item.__table__.c.id]).where(
+            Item.__table__.c.ingredient_id.in_(ingredient_ids)
+        )))
+        touched.append((Recipe, sa.select([recipe_ingredients.c.recipe_id]).where(
+            recipe_ingredients.c.ingredient_id.in_(ingredient_ids)
+        )))
+
+    if tag_ids:
+        touched.append((Recipe, sa.select([recipe_tags.c.recipe_id]).where(
+            recipe_tags.c.tag_id.in_(sorted(tag_ids))
+        )))
+
+    for model, ids in touched:
+        touch_rows(connection, model, ids)
+    return touched
+
+
+def versions_bumped(session, touched):
+    """Have the versions of the (model, ids) in touched reloaded once the flush is over, see expire_versions"""
+    session.info.setdefault(BUMPED_VERSIONS, []).extend(touched)
+
+
+@event.listens_for(db.session, 'after_flush')
+def touch_changed_nested_rows(session, flush_context):
+    """Bump the versions of the rows nesting what this flush changed"""
+    recipe_ids = set()
+    ingredient_ids = set()
+    tag_ids = set()
+
+    for obj in chain(session.new, session.dirty, session.deleted):
+        if isinstance(obj, RecipeIngredient):
+            recipe_ids.update(value for value in inspect(obj).attrs.recipe_id.history.sum() if value is not None)
+        elif isinstance(obj, Recipe):
+            history = inspect(obj).attrs.tags.history
+            if history.added or history.deleted:
+                recipe_ids.add(obj.id)
+        elif isinstance(obj, Tag):
+            history = inspect(obj).attrs.recipes.history
+            recipe_ids.update(recipe.id for recipe in chain(history.added or (), history.deleted or ()))
+            if obj in session.deleted:
+                # the rows of a deleted tag are removed from all of its recipes
+                recipe_ids.update(recipe.id for recipe in history.unchanged or ())
+            if obj in session.dirty and session.is_modified(obj, include_collections=False):
+                tag_ids.add(obj.id)
+        elif isinstance(obj, Ingredient):
+            if obj in session.dirty and session.is_modified(obj, include_collections=False):
+                ingredient_ids.add(obj.id)
+
+    # new recipes start at their first version and deleted ones have nothing left to version
+    recipe_ids.difference_update(
+        obj.id for obj in chain(session.new, session.deleted) if isinstance(obj, Recipe)
+    )
+    recipe_ids.discard(None)
+
+    connection = session.connection()
+    if recipe_ids:
+        touch_rows(connection, Recipe, sorted(recipe_ids))
+        versions_bumped(session, [(Recipe, recipe_ids)])
+    versions_bumped(session, touch_nesting_rows(connection, ingredient_ids, tag_ids))
+
+
+@event.listens_for(db.session, 'after_flush_postexec')
+def expire_versions(session, flush_context):
+    """Reload the versions bumped behind the ORM's back before they are compared again
+
+    Only the loaded rows among those bumped are expired, the select of ids of a nesting change is run once to find
+    them.
+    """
+    for model, ids in session.info.pop(BUMPED_VERSIONS, ()):
+        if isinstance(ids, sa.sql.Select):
+            ids = [row_id for row_id, in session.connection().execute(ids)]
+        for row_id in ids:
+            obj = session.identity_map.get(identity_key(model, row_id))
+            if obj is not None:
+                session.expire(obj, ['version'])
@@ -8,5 +8,9 @@ class Tag(db.Model):
 
     id = db.Column(sa.Integer, primary_key=True)
     name = db.Column(sa.Text,  nullable=False, unique=True)
+    # incremented on every change, see models/row_versions.py
+    version = db.Column(sa.Integer, nullable=False, server_default='1')
 
     recipes = db.relationship('Recipe', secondary='recipe_tags', back_populates="tags")
+
+    __mapper_args__ = {'version_id_col': version}
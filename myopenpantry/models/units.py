@@ -0,0 +1,111 @@
+"""Unit normalization
+
+Amounts are stored in whatever unit the user typed. To compare them, every Item and RecipeIngredient also keeps
+a canonical quantity expressed in the base unit of its dimension: grams for mass, milliliters for volume and
+pieces for counts. Ingredients may define a density (grams per milliliter) and a piece weight (grams per piece)
+so quantities can be converted between dimensions.
+"""
+import sqlalchemy as sa
+from sqlalchemy import event
+
+from .associations import RecipeIngredient
+from .ingredients import Ingredient
+from .items import Item
+
+MASS = 'mass'
+VOLUME = 'volume'
+COUNT = 'count'
+
+# unit name -> (dimension, factor to the base unit of the dimension)
+UNITS = {}
+
+
+def register_unit(dimension, factor, *names):
+    """Register one or more names for a unit"""
+    for name in names:
+        UNITS[name] = (dimension, factor)
+
+
+register_unit(MASS, 1.0, 'g', 'gram')
+register_unit(MASS, 0.001, 'mg', 'milligram')
+register_unit(MASS, 1000.0, 'kg', 'kilogram')
+register_unit(MASS, 28.349523125, 'oz', 'ounce')
+register_unit(MASS, 453.59237, 'lb', 'pound')
+
+register_unit(VOLUME, 1.0, 'ml', 'milliliter', 'millilitre')
+register_unit(VOLUME, 1000.0, 'l', 'liter', 'litre')
+register_unit(VOLUME, 4.92892159375, 'tsp', 'teaspoon')
+register_unit(VOLUME, 14.78676478125, 'tbsp', 'tablespoon')
+register_unit(VOLUME, 29.5735295625, 'fl oz', 'fluid ounce')
+register_unit(VOLUME, 236.5882365, 'cup')
+register_unit(VOLUME, 473.176473, 'pint')
+register_unit(VOLUME, 946.352946, 'quart')
+register_unit(VOLUME, 3785.411784, 'gallon')
+
+register_unit(COUNT, 1.0, 'each', 'ea', 'piece')
+
+
+def lookup_unit(unit):
+    """Find the dimension and factor of a unit
+
+    Unknown units, such as '15oz cans' or 'tomato', are treated as counts of that thing.
+    """
+    name = (unit or '').strip().lower().rstrip('.')
+    if name in UNITS:
+        return UNITS[name]
+    if name.endswith('s') and name[:-1] in UNITS:
+        return UNITS[name[:-1]]
+    return UNITS['each']
+
+
+def normalize(amount, unit):
+    """Convert an amount in a user defined unit to a (quantity, dimension) pair"""
+    if amount is None:
+        return None, None
+    dimension, factor = lookup_unit(unit)
+    return float(amount) * factor, dimension
+
+
+def grams_per(dimension, ingredient=Ingredient.__table__):
+    """SQL expression for the grams in one base unit of dimension, NULL if the ingredient can't convert it"""
+    return sa.case(
+        [
+            (dimension == MASS, sa.literal(1.0)),
+            (dimension == VOLUME, ingredient.c.density),
+            (dimension == COUNT, ingredient.c.piece_weight),
+        ],
+    )
+
+
+def convert(quantity, from_dimension, to_dimension, ingredient=Ingredient.__table__):
+    """SQL expression converting a canonical quantity between dimensions, NULL if not convertible"""
+    return sa.case(
+        [(from_dimension == to_dimension, quantity)],
+        else_=quantity * grams_per(from_dimension, ingredient) / grams_per(to_dimension, ingredient),
+    )
+
+
+def backfill_quantities(connection):
+    """Set the canonical quantity of the items and recipe ingredients that have none, eg written before it existed"""
+    for model in (Item, RecipeIngredient):
+        table = model.__table__
+        missing = sa.and_(table.c.quantity.is_(None), table.c.amount.isnot(None))
+        # one UPDATE per distinct unit, lookup_unit can't be expressed in SQL
+        units = [unit for unit, in connection.execute(sa.select([table.c.unit]).where(missing).distinct())]
+        # the rows didn't change for their users, keep updated_at from its onupdate
+        unchanged = {'updated_at': table.c.updated_at} if 'updated_at' in table.c else {}
+        for unit in units:
+            dimension, factor = lookup_unit(unit)
+            connection.execute(
+                table.update().where(sa.and_(
+                    missing, table.c.unit.is_(None) if unit is None else table.c.unit == unit
+                )).values(quantity=sa.cast(table.c.amount, sa.Float) * factor, dimension=dimension, **unchanged)
+            )
+
+
+@event.listens_for(Item, 'before_insert')
+@event.listens_for(Item, 'before_update')
+@event.listens_for(RecipeIngredient, 'before_insert')
+@event.listens_for(RecipeIngredient, 'before_update')
+def set_canonical_quantity(mapper, connection, target):
+    target.quantity, target.dimension = normalize(target.amount, target.unit)
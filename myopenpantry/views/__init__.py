@@ -1,9 +1,11 @@
+from . import diagnostics
 from . import ingredients
 from . import items
 from . import recipes
 from . import tags
 
 MODULES = (
+    diagnostics,
     ingredients,
     items,
     recipes,
@@ -0,0 +1,39 @@
+from flask import current_app
+from flask.views import MethodView
+
+from myopenpantry.extensions.api import Blueprint
+from myopenpantry.extensions.database import db, sqlite_pragmas
+
+from .schemas import DiagnosticsSchema
+
+blp = Blueprint(
+    'Diagnostics',
+    __name__,
+    url_prefix='/diagnostics',
+    description="Runtime settings and statistics"
+)
+
+# app.extensions keys of the caches reported, by name
+CACHES = {
+    'counts': 'count_cache',
+    'responses': 'response_cache',
+    'schemas': 'schema_cache',
+}
+
+
+@blp.route('/')
+class Diagnostics(MethodView):
+
+    @blp.response(200, DiagnosticsSchema)
+    def get(self):
+        """Report the database settings in effect and the cache statistics of this worker"""
+        connection = db.session.connection()
+        database = {'dialect': connection.dialect.name}
+        if connection.dialect.name == 'sqlite':
+            database['pragmas'] = sqlite_pragmas(connection)
+
+        caches = {
+            name: current_app.extensions[key].stats() for name, key in CACHES.items() if key in current_app.extensions
+        }
+
+        return {'database': database, 'caches': caches}
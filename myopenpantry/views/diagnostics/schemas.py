@@ -0,0 +1,23 @@
+import marshmallow as ma
+
+from myopenpantry.extensions.api import Schema
+
+
+class DatabaseSchema(Schema):
+    dialect = ma.fields.Str()
+    # current value of each PRAGMA of the SQLITE_PRAGMAS profile, SQLite only
+    pragmas = ma.fields.Dict(keys=ma.fields.Str(), values=ma.fields.Raw())
+
+
+class CacheStatsSchema(Schema):
+    entries = ma.fields.Int()
+    bytes = ma.fields.Int()
+    hits = ma.fields.Int()
+    misses = ma.fields.Int()
+    evictions = ma.fields.Int()
+
+
+class DiagnosticsSchema(Schema):
+    database = ma.fields.Nested(DatabaseSchema)
+    # stats of the in process caches of the worker that answered, by cache name
+    caches = ma.fields.Dict(keys=ma.fields.Str(), values=ma.fields.Nested(CacheStatsSchema))
@@ -3,13 +3,13 @@ from flask_smorest import abort
 
 from sqlalchemy import exc
 
-from myopenpantry.extensions.api import Blueprint, SQLCursorPage
-from myopenpantry.extensions.database import db
-from myopenpantry.models import Ingredient
+from myopenpantry.extensions.api import Blueprint, SQLCursorPage, VersionEtagSchema, query_options
+from myopenpantry.extensions.database import db, abort_on_stale_data, integrity_errors
+from myopenpantry.models import Ingredient, Item, Recipe, RecipeIngredient, name_contains, name_startswith
 
-from .schemas import IngredientSchema, IngredientQueryArgsSchema
-from ..recipes.schemas import RecipeSchema
-from ..items.schemas import ItemSchema
+from .schemas import IngredientSchema, IngredientQueryArgsSchema, INGREDIENT_TABLES
+from ..recipes.schemas import RecipeSchema, RECIPE_TABLES
+from ..items.schemas import ItemSchema, ITEM_TABLES
 
 blp = Blueprint(
     'Ingredients',
@@ -19,7 +19,12 @@ blp = Blueprint(
 )
 
 
-# TODO this is duplicated in each view. Create a controller to move all backend logic to
+# request field and message of each constraint violation, see extensions/database/errors.py
+INTEGRITY_ERRORS = {
+    'uq_ingredients_name': ('name', "Ingredient with that name already exists"),
+}
+
+
 # Trying to stay consistent with other error stuctures, eg:
 # "errors": {
 #   "json": {
@@ -29,35 +34,34 @@ blp = Blueprint(
 #   }
 # }, which is returned when by the Schema validation
 def handle_integrity_error_and_abort(e):
-    # TODO surely there is a better way to figure out what the error type is?
     # TODO log the error
-    e = repr(e)
-    errors = {'json': {}}
-    if e.find('UNIQUE constraint failed: ingredients.name') != -1:
-        errors['json']['name'] = ["Ingredient with that name already exists"]
-
-    abort(422, errors=errors)
+    abort(422, errors={'json': integrity_errors(e, INTEGRITY_ERRORS)})
 
 
 @blp.route('/')
 class Ingredients(MethodView):
 
+    @blp.cache_response(*INGREDIENT_TABLES)
     @blp.etag
+    @blp.collection_etag(*INGREDIENT_TABLES)
     @blp.arguments(IngredientQueryArgsSchema, location='query')
     @blp.response(200, IngredientSchema(many=True))
     @blp.paginate(SQLCursorPage)
     def get(self, args):
         """List all ingredients or filter by args"""
         name = args.pop('name', None)
+        name_prefix = args.pop('name_prefix', None)
 
-        ret = Ingredient.query.filter_by(**args)
+        ret = Ingredient.query.options(*query_options(IngredientSchema)).filter_by(**args)
 
         if name is not None:
-            ret = ret.filter(Ingredient.name.like(f"%{name}%"))
+            ret = ret.filter(name_contains(Ingredient, name))
+        if name_prefix is not None:
+            ret = ret.filter(name_startswith(Ingredient, name_prefix))
 
         return ret.order_by(Ingredient.id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(IngredientSchema)
     @blp.response(201, IngredientSchema)
     def post(self, new_item):
@@ -79,65 +83,78 @@ class Ingredients(MethodView):
 @blp.route('/<int:ingredient_id>')
 class IngredientsById(MethodView):
 
-    @blp.etag
+    @blp.cache_response(*INGREDIENT_TABLES)
+    @blp.etag(VersionEtagSchema)
     @blp.response(200, IngredientSchema)
     def get(self, ingredient_id):
         """Get ingredient by ID"""
-        return Ingredient.query.get_or_404(ingredient_id)
+        return Ingredient.query.options(*query_options(IngredientSchema)).get_or_404(ingredient_id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(IngredientSchema)
     @blp.response(200, IngredientSchema)
     def put(self, new_ingredient, ingredient_id):
         """Update an existing ingredient"""
         ingredient = Ingredient.query.get_or_404(ingredient_id)
 
-        blp.check_etag(ingredient, IngredientSchema)
+        blp.check_etag(ingredient, VersionEtagSchema)
 
         IngredientSchema().update(ingredient, new_ingredient)
 
-        try:
-            db.session.add(ingredient)
-            db.session.commit()
-        except exc.IntegrityError as e:
-            db.session.rollback()
-            handle_integrity_error_and_abort(e)
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422, message="There was an error. Please try again.")
+        with abort_on_stale_data():
+            try:
+                db.session.add(ingredient)
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                handle_integrity_error_and_abort(e)
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422, message="There was an error. Please try again.")
         return ingredient
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.response(204)
     def delete(self, ingredient_id):
         """Delete an ingredient"""
         ingredient = Ingredient.query.get_or_404(ingredient_id)
 
-        blp.check_etag(ingredient, IngredientSchema)
+        blp.check_etag(ingredient, VersionEtagSchema)
 
-        try:
-            db.session.delete(ingredient)
-            db.session.commit()
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422)
+        with abort_on_stale_data():
+            try:
+                db.session.delete(ingredient)
+                db.session.commit()
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422)
 
 
 @blp.route('/<int:ingredient_id>/recipes')
 class IngredientRecipes(MethodView):
 
+    @blp.cache_response(*RECIPE_TABLES)
     @blp.etag
+    @blp.collection_etag(*RECIPE_TABLES)
     @blp.response(200, RecipeSchema(many=True))
     def get(self, ingredient_id):
         """Get recipes associated with the ingredient"""
-        return Ingredient.query.get_or_404(ingredient_id).recipes
+        ingredient = Ingredient.query.get_or_404(ingredient_id)
+
+        return Recipe.query.join(Recipe.ingredients).filter(
+            RecipeIngredient.ingredient_id == ingredient.id
+        ).options(*query_options(RecipeSchema)).order_by(Recipe.id)
 
 
 @blp.route('/<int:ingredient_id>/items')
 class IngredientItems(MethodView):
 
+    @blp.cache_response(*ITEM_TABLES)
     @blp.etag
+    @blp.collection_etag(*ITEM_TABLES)
     @blp.response(200, ItemSchema(many=True))
     def get(self, ingredient_id):
         """Get items associated with the ingredient"""
-        return Ingredient.query.get_or_404(ingredient_id).items
+        ingredient = Ingredient.query.get_or_404(ingredient_id)
+
+        return Item.query.with_parent(ingredient, 'items').options(*query_options(ItemSchema)).order_by(Item.id)
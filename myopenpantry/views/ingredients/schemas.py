@@ -7,10 +7,21 @@ from myopenpantry.models.ingredients import Ingredient
 
 class IngredientSchema(AutoSchema):
     id = field_for(Ingredient, "id", dump_only=True)
+    in_stock = field_for(Ingredient, "in_stock", dump_only=True)
+    # grams per milliliter and grams per piece, used to convert between units
+    density = field_for(Ingredient, "density", validate=ma.validate.Range(min=0, min_inclusive=False))
+    piece_weight = field_for(Ingredient, "piece_weight", validate=ma.validate.Range(min=0, min_inclusive=False))
 
     class Meta(AutoSchema.Meta):
         table = Ingredient.__table__
+        # the version is exposed through ETags only, see VersionEtagSchema
+        exclude = ('version',)
+
+
+# tables read when dumping ingredients, for listing ETags
+INGREDIENT_TABLES = (Ingredient,)
 
 
 class IngredientQueryArgsSchema(Schema):
     name = ma.fields.Str(validate=ma.validate.Length(min=1))
+    name_prefix = ma.fields.Str(validate=ma.validate.Length(min=1))
@@ -1,13 +1,23 @@
+import csv
+from datetime import datetime
+import io
+from itertools import islice
+
+from flask import current_app, json, request
 from flask.views import MethodView
 from flask_smorest import abort
+import marshmallow as ma
+import sqlalchemy as sa
 from sqlalchemy import exc
 
-from myopenpantry.extensions.api import Blueprint, SQLCursorPage
-from myopenpantry.extensions.database import db
-from myopenpantry.models import Item
+from myopenpantry.extensions.api import Blueprint, SQLCursorPage, VersionEtagSchema, NDJSON_MIMETYPE, query_options
+from myopenpantry.extensions.database import db, abort_on_stale_data, bump_versions, integrity_errors
+from myopenpantry.models import (
+    Ingredient, Item, index_names, name_contains, name_startswith, refresh_availability, units
+)
 
-from .schemas import ItemSchema, ItemQueryArgsSchema
-from ..ingredients.schemas import IngredientSchema
+from .schemas import ItemSchema, ItemQueryArgsSchema, ItemImportArgsSchema, ItemImportSchema, ITEM_TABLES
+from ..ingredients.schemas import IngredientSchema, INGREDIENT_TABLES
 
 blp = Blueprint(
     'Items',
@@ -17,7 +27,14 @@ blp = Blueprint(
 )
 
 
-# TODO this is duplicated in each view. Create a controller to move all backend logic to
+# request field and message of each constraint violation, see extensions/database/errors.py
+INTEGRITY_ERRORS = {
+    'uq_items_name': ('name', "Item with that name already exists"),
+    'uq_items_product_id': ('productId', "Item with that product ID already exists"),
+    'fk_items_ingredient_id_ingredients': ('ingredientId', "No such ingredient with that id"),
+}
+
+
 # Trying to stay consistent with other error stuctures, eg:
 # "errors": {
 #   "json": {
@@ -27,38 +44,209 @@ blp = Blueprint(
 #   }
 # }, which is returned when by the Schema validation
 def handle_integrity_error_and_abort(e):
-    # TODO surely there is a better way to figure out what the error type is?
-    e = repr(e)
-    errors = {'json': {}}
-    if e.find('UNIQUE constraint failed: items.name') != -1:
-        errors['json']['name'] = ["Item with that name already exists"]
-    elif e.find('UNIQUE constraint failed: items.product_id') != -1:
-        errors['json']['productId'] = ["Item with that product ID already exists"]
-    elif e.find('FOREIGN KEY constraint failed') != -1:
-        errors['json']['ingredientId'] = ["No such ingredient with that id"]
+    # TODO log the error
+    abort(422, errors={'json': integrity_errors(e, INTEGRITY_ERRORS)})
+
 
-    abort(422, errors=errors)
+# columns an import writes, besides the version
+IMPORT_COLUMNS = ('name', 'amount', 'unit', 'product_id', 'ingredient_id', 'quantity', 'dimension', 'updated_at')
+
+
+def csv_records(stream):
+    """(record, errors) of each row of a CSV stream with a header, empty cells are left out"""
+    reader = csv.DictReader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    try:
+        for record in reader:
+            if None in record:
+                yield None, {'_schema': ["More values than columns."]}
+            else:
+                yield {key: value for key, value in record.items() if value not in ('', None)}, None
+    except (csv.Error, UnicodeDecodeError) as e:
+        # the rest of the stream can't be read reliably
+        yield None, {'_schema': [f"Invalid CSV: {e}"]}
+
+
+def ndjson_records(stream):
+    """(record, errors) of each non-blank line of an NDJSON stream"""
+    for line in stream:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line), None
+        except ValueError:
+            yield None, {'_schema': ["Invalid JSON."]}
+
+
+IMPORT_READERS = {'text/csv': csv_records, NDJSON_MIMETYPE: ndjson_records}
+
+
+def _integrity_error(constraint):
+    field, message = INTEGRITY_ERRORS[constraint]
+    return {field: [message]}
+
+
+def import_items(connection, batch, upsert):
+    """Validate and write a batch of (row, record, errors), returns (inserted, updated, errors by row)
+
+    Rows conflicting with items or with each other are reported instead of written, so a batch is written with a
+    few executemany statements in a transaction of its own on connection.
+    """
+    errors = {row: error for row, record, error in batch if error is not None}
+    rows = [row for row, record, error in batch if error is None]
+    try:
+        # without upsert, a missing name fails here already
+        loaded = ItemSchema(many=True).load([record for row, record, error in batch if error is None], partial=upsert)
+    except ma.ValidationError as e:
+        loaded = e.valid_data
+        errors.update((rows[index], messages) for index, messages in e.messages.items())
+    valid = [(row, data) for row, data in zip(rows, loaded) if row not in errors]
+
+    try:
+        with connection.begin():
+            inserted, updated = _write_items(connection, valid, upsert, errors)
+    except exc.DatabaseError as e:
+        # the whole batch was rolled back, its rows fail while the batches before stay committed
+        messages = None
+        if isinstance(e, exc.IntegrityError):
+            # a concurrent write took a name or product ID since the checks
+            messages = integrity_errors(e, INTEGRITY_ERRORS)
+        messages = messages or {'_schema': ["There was an error. Please try again."]}
+        errors.update((row, messages) for row, data in valid if row not in errors)
+        return 0, 0, errors
+
+    return inserted, updated, errors
+
+
+def _write_items(connection, valid, upsert, errors):
+    """Check the valid rows of a batch and write those without errors, returns (inserted, updated)
+
+    The writes bypass the ORM, which leaves them the work of its flush listeners: the canonical quantities, the name
+    index, recipe availability and the table versions.
+    """
+    items = Item.__table__
+    ingredients = Ingredient.__table__
+    product_ids = {data['product_id'] for row, data in valid if data.get('product_id') is not None}
+    names = {data['name'] for row, data in valid if 'name' in data}
+    ingredient_ids = {data['ingredient_id'] for row, data in valid if data.get('ingredient_id') is not None}
+    # expanding parameters, rendering a thousand bound parameters per query costs more than running it
+    by_product_id = {
+        item.product_id: item for item in connection.execute(
+            sa.select([items.c.id, *(items.c[name] for name in IMPORT_COLUMNS)]).where(
+                items.c.product_id.in_(sa.bindparam('product_ids', expanding=True))
+            ),
+            product_ids=sorted(product_ids),
+        )
+    } if product_ids else {}
+    by_name = {
+        item.name: item.id for item in connection.execute(
+            sa.select([items.c.id, items.c.name]).where(items.c.name.in_(sa.bindparam('names', expanding=True))),
+            names=sorted(names),
+        )
+    } if names else {}
+    existing_ingredients = {
+        ingredient.id for ingredient in connection.execute(
+            sa.select([ingredients.c.id]).where(ingredients.c.id.in_(sa.bindparam('ids', expanding=True))),
+            ids=sorted(ingredient_ids),
+        )
+    } if ingredient_ids else set()
+
+    now = datetime.now()
+    inserts = []
+    updates = {}
+    seen_names = {}
+    seen_product_ids = {}
+    for row, data in valid:
+        existing = by_product_id.get(data.get('product_id')) if upsert else None
+        # item already named like the row
+        owner = by_name.get(data.get('name'))
+        if data.get('ingredient_id') is not None and data['ingredient_id'] not in existing_ingredients:
+            errors[row] = _integrity_error('fk_items_ingredient_id_ingredients')
+        elif existing is None and 'name' not in data:
+            errors[row] = {'name': ["Missing data for required field."]}
+        elif data.get('name') in seen_names:
+            errors[row] = {'name': [f"Same name as row {seen_names[data['name']]}."]}
+        elif data.get('product_id') in seen_product_ids:
+            errors[row] = {'productId': [f"Same product ID as row {seen_product_ids[data['product_id']]}."]}
+        elif owner is not None and (existing is None or owner != existing.id):
+            errors[row] = _integrity_error('uq_items_name')
+        elif existing is None and data.get('product_id') in by_product_id:
+            errors[row] = _integrity_error('uq_items_product_id')
+        else:
+            if 'name' in data:
+                seen_names[data['name']] = row
+            if data.get('product_id') is not None:
+                seen_product_ids[data['product_id']] = row
+
+            values = {'amount': 0, **(dict(existing) if existing is not None else {}), **data, 'updated_at': now}
+            values['quantity'], values['dimension'] = units.normalize(values['amount'], values.get('unit'))
+            values = {name: values.get(name) for name in IMPORT_COLUMNS}
+            if existing is None:
+                inserts.append(values)
+            else:
+                updates[existing.id] = (values, existing)
+
+    if inserts:
+        # compiled once, psycopg2 sends multi-row INSERTs, see DATABASE_EXECUTEMANY_MODE
+        connection.execute(items.insert(), inserts)
+    if updates:
+        connection.execute(
+            items.update().where(items.c.id == sa.bindparam('item_id')).values(
+                version=items.c.version + 1, **{name: sa.bindparam(f'new_{name}') for name in IMPORT_COLUMNS}
+            ),
+            [
+                {'item_id': item_id, **{f'new_{name}': value for name, value in values.items()}}
+                for item_id, (values, _) in sorted(updates.items())
+            ]
+        )
+
+    # upserts mostly keep their name, those are indexed already
+    renamed = {
+        item_id: values['name'] for item_id, (values, existing) in updates.items() if values['name'] != existing.name
+    }
+    if renamed:
+        index_names(connection, Item, renamed)
+    if inserts:
+        index_names(connection, Item, dict(connection.execute(
+            sa.select([items.c.id, items.c.name]).where(items.c.name.in_(sa.bindparam('names', expanding=True))),
+            names=[values['name'] for values in inserts],
+        ).fetchall()), new=True)
+
+    stocked = {values['ingredient_id'] for values in inserts}
+    for values, existing in updates.values():
+        stocked.update((values['ingredient_id'], existing.ingredient_id))
+    stocked.discard(None)
+    if stocked:
+        refresh_availability(connection, ingredient_ids=stocked)
+
+    if inserts or updates:
+        bump_versions(connection, {items.name: len(inserts)})
+    return len(inserts), len(updates)
 
 
 @blp.route('/')
 class Items(MethodView):
 
+    @blp.cache_response(*ITEM_TABLES)
     @blp.etag
+    @blp.collection_etag(*ITEM_TABLES)
     @blp.arguments(ItemQueryArgsSchema, location='query')
     @blp.response(200, ItemSchema(many=True))
     @blp.paginate(SQLCursorPage)
     def get(self, args):
         """List all items or filter by args"""
         name = args.pop('name', None)
+        name_prefix = args.pop('name_prefix', None)
 
-        ret = Item.query.filter_by(**args)
+        ret = Item.query.options(*query_options(ItemSchema)).filter_by(**args)
 
         if name is not None:
-            ret = ret.filter(Item.name.like(f"%{name}%"))
+            ret = ret.filter(name_contains(Item, name))
+        if name_prefix is not None:
+            ret = ret.filter(name_startswith(Item, name_prefix))
 
         return ret.order_by(Item.id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(ItemSchema)
     @blp.response(201, ItemSchema)
     def post(self, new_item):
@@ -79,57 +267,100 @@ class Items(MethodView):
         return item
 
 
+@blp.route('/import')
+class ItemsImport(MethodView):
+
+    @blp.arguments(ItemImportArgsSchema, location='query')
+    @blp.response(200, ItemImportSchema)
+    @blp.doc(requestBody={'content': {
+        mimetype: {'schema': {'type': 'string'}} for mimetype in IMPORT_READERS
+    }})
+    def post(self, args):
+        """Import items from CSV, with a header row, or NDJSON
+
+        The rows are read, validated and committed IMPORT_BATCH_SIZE at a time, and the rows that fail are
+        reported instead of failing the import.
+        """
+        reader = IMPORT_READERS.get(request.mimetype)
+        if reader is None:
+            abort(415, message=f"Send items as one of {', '.join(IMPORT_READERS)}.")
+
+        config = current_app.config
+        records = ((row, record, error) for row, (record, error) in enumerate(reader(request.stream), 1))
+        result = {'inserted': 0, 'updated': 0, 'failed': 0, 'errors': []}
+
+        # one connection for every batch, NullPool would close and checkpoint an SQLite database after each
+        with db.engine.connect() as connection:
+            while True:
+                batch = list(islice(records, config['IMPORT_BATCH_SIZE']))
+                if not batch:
+                    break
+
+                inserted, updated, errors = import_items(connection, batch, args['upsert'])
+                result['inserted'] += inserted
+                result['updated'] += updated
+                result['failed'] += len(errors)
+                room = config['IMPORT_MAX_ERRORS'] - len(result['errors'])
+                result['errors'].extend({'row': row, 'errors': errors[row]} for row in sorted(errors)[:max(room, 0)])
+
+        return result
+
+
 @blp.route('/<int:item_id>')
 class ItemsById(MethodView):
 
-    @blp.etag
+    @blp.cache_response(*ITEM_TABLES)
+    @blp.etag(VersionEtagSchema)
     @blp.response(200, ItemSchema)
     def get(self, item_id):
         """Get item by ID"""
-        return Item.query.get_or_404(item_id)
+        return Item.query.options(*query_options(ItemSchema)).get_or_404(item_id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(ItemSchema)
     @blp.response(200, ItemSchema)
     def put(self, new_item, item_id):
         """Update an existing item"""
         item = Item.query.get_or_404(item_id)
 
-        blp.check_etag(item, ItemSchema)
+        blp.check_etag(item, VersionEtagSchema)
 
         ItemSchema().update(item, new_item)
 
-        try:
-            db.session.add(item)
-            db.session.commit()
-        except exc.IntegrityError as e:
-            db.session.rollback()
-            handle_integrity_error_and_abort(e)
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422, message="There was an error. Please try again.")
+        with abort_on_stale_data():
+            try:
+                db.session.add(item)
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                handle_integrity_error_and_abort(e)
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422, message="There was an error. Please try again.")
 
         return item
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.response(204)
     def delete(self, item_id):
         """Delete an item"""
         item = Item.query.get_or_404(item_id)
 
-        blp.check_etag(item, ItemSchema)
+        blp.check_etag(item, VersionEtagSchema)
 
-        try:
-            db.session.delete(item)
-            db.session.commit()
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422)
+        with abort_on_stale_data():
+            try:
+                db.session.delete(item)
+                db.session.commit()
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422)
 
 
 @blp.route('/<int:item_id>/ingredient')
 class ItemsIngredient(MethodView):
 
+    @blp.cache_response(Item, *INGREDIENT_TABLES)
     @blp.etag
     @blp.response(200, IngredientSchema)
     def get(self, item_id):
@@ -142,13 +373,14 @@ class ItemsIngredient(MethodView):
         """Delete the association between an item and ingredient"""
         item = Item.query.get_or_404(item_id)
 
-        blp.check_etag(item, ItemSchema)
+        blp.check_etag(item, VersionEtagSchema)
 
         item.ingredient_id = None
 
-        try:
-            db.session.add(item)
-            db.session.commit()
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422)
+        with abort_on_stale_data():
+            try:
+                db.session.add(item)
+                db.session.commit()
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422)
@@ -1,7 +1,9 @@
 import marshmallow as ma
 from marshmallow_sqlalchemy import field_for
+from sqlalchemy.orm import joinedload
 
 from myopenpantry.extensions.api import Schema, AutoSchema
+from myopenpantry.models.ingredients import Ingredient
 from myopenpantry.models.items import Item
 
 from myopenpantry.views.ingredients.schemas import IngredientSchema
@@ -21,8 +23,41 @@ class ItemSchema(AutoSchema):
 
     class Meta(AutoSchema.Meta):
         table = Item.__table__
+        # canonical quantities are internal, see models/units.py. The version is exposed through ETags only
+        exclude = ('quantity', 'dimension', 'version')
+
+    LOADERS = {
+        'ingredient': joinedload(Item.ingredient),
+    }
+
+
+# loader options eagerly loading exactly what ItemSchema nests
+ITEM_LOADERS = ItemSchema().query_options()
+
+# tables read when dumping items, for listing ETags
+ITEM_TABLES = (Item, Ingredient)
 
 
 class ItemQueryArgsSchema(Schema):
     name = ma.fields.Str(validate=ma.validate.Length(min=1))
+    name_prefix = ma.fields.Str(validate=ma.validate.Length(min=1))
     product_id = ma.fields.Int(validate=ma.validate.Range(min=1, max=9999999999999))
+
+
+class ItemImportArgsSchema(Schema):
+    # rows whose productId matches an item update it instead, with the fields they give
+    upsert = ma.fields.Bool(missing=False)
+
+
+class ItemImportErrorSchema(Schema):
+    # position of the record in the import, from 1 and without the CSV header
+    row = ma.fields.Int()
+    errors = ma.fields.Dict(keys=ma.fields.Str())
+
+
+class ItemImportSchema(Schema):
+    inserted = ma.fields.Int()
+    updated = ma.fields.Int()
+    failed = ma.fields.Int()
+    # the first IMPORT_MAX_ERRORS of the failed rows
+    errors = ma.fields.Nested(ItemImportErrorSchema, many=True)
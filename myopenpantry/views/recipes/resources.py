@@ -1,13 +1,23 @@
 from flask.views import MethodView
 from flask_smorest import abort
 
-from myopenpantry.extensions.api import Blueprint, SQLCursorPage
-from myopenpantry.extensions.database import db
-from myopenpantry.models import Recipe, Ingredient, Tag, RecipeIngredient
+from myopenpantry.extensions.api import Blueprint, SQLCursorPage, VersionEtagSchema, query_options
+from myopenpantry.extensions.database import db, abort_on_stale_data, bump_versions, integrity_errors
+from myopenpantry.models import (
+    Recipe, Ingredient, Item, Tag, RecipeIngredient, recipe_tags, recipes_document, recipes_fts, touch_rows
+)
+from myopenpantry.models.units import convert
+
+import re
+from collections import Counter
 
+import sqlalchemy as sa
 from sqlalchemy import and_, exc
 
-from .schemas import RecipeSchema, RecipeQueryArgsSchema, RIngredientSchema, TagSchema, RecipeTagSchema
+from .schemas import (
+    RecipeSchema, RecipeQueryArgsSchema, RIngredientSchema, TagSchema, RecipeTagSchema, RecipeBatchesSchema,
+    BulkRecipeTagSchema, RECIPE_LOADERS, RECIPE_TABLES, RINGREDIENT_TABLES, TAG_TABLES
+)
 
 blp = Blueprint(
     'Recipes',
@@ -17,7 +27,12 @@ blp = Blueprint(
 )
 
 
-# TODO this is duplicated in each view. Create a controller to move all backend logic to
+# request field and message of each constraint violation, see extensions/database/errors.py
+INTEGRITY_ERRORS = {
+    'uq_recipes_name': ('name', "Recipe with that name already exists"),
+}
+
+
 # Trying to stay consistent with other error stuctures, eg:
 # "errors": {
 #   "json": {
@@ -27,20 +42,149 @@ blp = Blueprint(
 #   }
 # }, which is returned when by the Schema validation
 def handle_integrity_error_and_abort(e):
-    # TODO surely there is a better way to figure out what the error type is?
     # TODO log the error
-    e = repr(e)
-    errors = {'json': {}}
-    if e.find('UNIQUE constraint failed: recipes.name') != -1:
-        errors['json']['name'] = ["Recipe with that name already exists"]
+    abort(422, errors={'json': integrity_errors(e, INTEGRITY_ERRORS)})
+
+
+def missing_ids(model, ids):
+    """Return the sorted ids that have no row in the model's table, checked with a single query"""
+    ids = set(ids)
+    if not ids:
+        return []
+
+    known = {row.id for row in db.session.query(model.id).filter(model.id.in_(ids))}
+    return sorted(ids - known)
+
+
+def resolve_recipe_ingredients(ringredients):
+    """Build the association rows for a list of recipe ingredients
+
+    Every ingredient id is checked with a single query, and all unknown or repeated ids are reported at once.
+    """
+    ids = Counter(ringredient['ingredient_id'] for ringredient in ringredients)
+
+    errors = [f"No such ingredient with id {ingredient_id}" for ingredient_id in missing_ids(Ingredient, ids)]
+    errors += [
+        f"Ingredient with id {ingredient_id} is listed more than once"
+        for ingredient_id, count in sorted(ids.items()) if count > 1
+    ]
+    if errors:
+        abort(422, errors={'json': {'ingredientId': errors}})
+
+    return [
+        RecipeIngredient(
+            ingredient_id=ringredient['ingredient_id'], amount=ringredient['amount'], unit=ringredient['unit']
+        )
+        for ringredient in ringredients
+    ]
+
+
+def tag_recipes(recipe_ids, tag_ids):
+    """Add every tag to every recipe with a single INSERT, skipping the pairs that already exist"""
+    recipes = Recipe.__table__
+    tags = Tag.__table__
+
+    existing = sa.exists().where(and_(recipe_tags.c.recipe_id == recipes.c.id, recipe_tags.c.tag_id == tags.c.id))
+    pairs = sa.select([recipes.c.id.label('recipe_id'), tags.c.id.label('tag_id')]).where(
+        and_(recipes.c.id.in_(recipe_ids), tags.c.id.in_(tag_ids), ~existing)
+    )
+
+    result = db.session.execute(recipe_tags.insert().from_select(['recipe_id', 'tag_id'], pairs))
+    bump_versions(db.session, {recipe_tags.name: result.rowcount})
+    if result.rowcount:
+        touch_rows(db.session, Recipe, recipe_ids)
+
+
+def filter_tags(ret, tags_all=None, tags_any=None, tags_none=None):
+    """Filter recipes by the tags they have"""
+    def tagged(tag_ids):
+        return sa.exists().where(and_(recipe_tags.c.recipe_id == Recipe.id, recipe_tags.c.tag_id.in_(tag_ids)))
+
+    if tags_all:
+        tag_ids = set(tags_all)
+        ret = ret.filter(Recipe.id.in_(
+            sa.select([recipe_tags.c.recipe_id]).where(recipe_tags.c.tag_id.in_(tag_ids)).group_by(
+                recipe_tags.c.recipe_id
+            ).having(sa.func.count() == len(tag_ids))
+        ))
+
+    if tags_any:
+        ret = ret.filter(tagged(tags_any))
+
+    if tags_none:
+        ret = ret.filter(~tagged(tags_none))
+
+    return ret
+
+
+def match_expression(q):
+    """Build an FTS5 MATCH expression from user input
 
-    abort(422, errors=errors)
+    Every term is quoted so user input can't produce a syntax error. "quoted phrases" are kept together and a
+    trailing * makes the term a prefix search. All terms must match.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', q):
+        prefix = not phrase and word.endswith('*')
+        term = (phrase or word.rstrip('*')).strip()
+        if term:
+            terms.append('"{}"{}'.format(term.replace('"', '""'), '*' if prefix else ''))
+
+    return ' '.join(terms)
+
+
+def tsquery_expression(q):
+    """Build a PostgreSQL tsquery from user input, the same way as match_expression
+
+    Terms are split into words like FTS5 tokenizes them, and every word is quoted.
+    """
+    terms = []
+    for phrase, word in re.findall(r'"([^"]*)"|(\S+)', q):
+        prefix = not phrase and word.endswith('*')
+        words = ["'{}'".format(word) for word in re.findall(r'\w+', phrase or word.rstrip('*'))]
+        if words:
+            if prefix:
+                words[-1] += ':*'
+            terms.append('({})'.format(' <-> '.join(words)))
+
+    return ' & '.join(terms)
+
+
+def search(ret, q):
+    """Filter recipes by a full text search, best matches first"""
+    dialect = db.engine.dialect.name
+    if dialect == 'postgresql':
+        query = tsquery_expression(q)
+        if not query:
+            return ret.filter(sa.false()).order_by(Recipe.id)
+
+        tsquery = sa.func.to_tsquery(sa.literal_column("'simple'"), query)
+        # normalized by the log of the length, like bm25 shorter documents rank first
+        rank = sa.func.ts_rank(recipes_document, tsquery, 1)
+        return ret.filter(recipes_document.op('@@')(tsquery)).order_by(sa.desc(rank), Recipe.id)
+
+    if dialect != 'sqlite':
+        # no full text index, fall back to a substring search
+        pattern = f"%{q}%"
+        return ret.filter(
+            sa.or_(Recipe.name.ilike(pattern), Recipe.steps.ilike(pattern), Recipe.notes.ilike(pattern))
+        ).order_by(Recipe.id)
+
+    match = match_expression(q)
+    if not match:
+        return ret.filter(sa.false()).order_by(Recipe.id)
+
+    return ret.join(recipes_fts, recipes_fts.c.rowid == Recipe.id).filter(
+        sa.literal_column('recipes_fts').match(match)
+    ).order_by(recipes_fts.c.rank, Recipe.id)
 
 
 @blp.route('/')
 class Recipes(MethodView):
 
+    @blp.cache_response(*RECIPE_TABLES)
     @blp.etag
+    @blp.collection_etag(*RECIPE_TABLES)
     @blp.arguments(RecipeQueryArgsSchema, location='query')
     @blp.response(200, RecipeSchema(many=True))
     @blp.paginate(SQLCursorPage)
@@ -48,44 +192,38 @@ class Recipes(MethodView):
         """List all recipes or filter by args"""
         name = args.pop('name', None)
         can_make = args.pop('can_make', False)
+        q = args.pop('q', None)
+        tags = {key: args.pop(key, None) for key in ('tags_all', 'tags_any', 'tags_none')}
 
-        ret = Recipe.query.filter_by(**args)
+        ret = Recipe.query.options(*query_options(RecipeSchema)).filter_by(**args)
+        ret = filter_tags(ret, **tags)
 
         # TODO does marshmallow have a way to only allow one of these at a time?
         if name is not None:
-            ret = ret.filter(Recipe.name.like(f"%{name}%"))
+            ret = ret.filter(Recipe.name.ilike(f"%{name}%"))
 
         # TODO this doesn't check to see that the amount is enough to make the recipe,
         # which will be difficult given that the units are user defined
         if can_make:
-            # TODO do this with SQL. Need to brush up on how to accomplish this
-            # I can get the number of ingredients a recipe has, and the ingredients with items with amount > 0,
-            # but am having issues connecting all the dots...
-            cant_make = []
-            for recipe in ret.all():
-                has_all = True
-                for ring in recipe.ingredients:
-                    if (len(ring.ingredient.items) == 0) or not any(item.amount > 0 for item in ring.ingredient.items):
-                        has_all = False
-                        break
-
-                if not has_all:
-                    cant_make.append(recipe.id)
-
-            ret = ret.filter(~Recipe.id.in_(cant_make))
+            # missing_ingredient_count is maintained on every item/ingredient change, see models/availability.py
+            ret = ret.filter(Recipe.missing_ingredient_count == 0)
+
+        if q is not None:
+            return search(ret, q)
 
         return ret.order_by(Recipe.id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(RecipeSchema)
     @blp.response(201, RecipeSchema)
     def post(self, new_recipe):
         """Add a new recipe"""
-        # tag_ids are required by the schema, so shouldn't need to check if they are none
-        ingredients = new_recipe.pop('ingredients', None)
+        ingredients = resolve_recipe_ingredients(new_recipe.pop('ingredients', None) or [])
 
         recipe = Recipe(**new_recipe)
+        recipe.ingredients = ingredients
 
+        # the recipe and its ingredients are written in one transaction
         try:
             db.session.add(recipe)
             db.session.commit()
@@ -96,108 +234,107 @@ class Recipes(MethodView):
             db.session.rollback()
             abort(422, message="There was an error. Please try again.")
 
-        if ingredients is not None:
-            for ringredient in ingredients:
-                ingredient = Ingredient.query.get(ringredient['ingredient_id'])
-
-                if ingredient is None:
-                    abort(422)
+        return Recipe.query.options(*RECIPE_LOADERS).filter(Recipe.id == recipe.id).one()
 
-                association = RecipeIngredient(amount=ringredient['amount'], unit=ringredient['unit'])
-                association.ingredient_id = ingredient.id
-                association.ingredient = ingredient
-                association.recipe_id = recipe.id
-                association.recipe = recipe
 
-                ingredient.recipes.append(association)
-                recipe.ingredients.append(association)
+@blp.route('/batches')
+class RecipeBatches(MethodView):
 
-        # TODO is this necessary on each iteration?
-        try:
-            db.session.add(recipe)
-            db.session.commit()
-        except (exc.IntegrityError, exc.DatabaseError):
-            db.session.rollback()
-            abort(422, message="There was an error. Please try again.")
-
-        return recipe
+    @blp.cache_response(Item, *RECIPE_TABLES)
+    @blp.etag
+    @blp.collection_etag(Item, *RECIPE_TABLES)
+    @blp.response(200, RecipeBatchesSchema(many=True))
+    @blp.paginate(SQLCursorPage)
+    def get(self):
+        """Get how many batches of each recipe can be made with the items in stock"""
+        ingredients = Ingredient.__table__
+        items = Item.__table__
+        recipe_ingredients = RecipeIngredient.__table__
+
+        # stock of each recipe ingredient converted to the dimension the recipe asks for, divided by the need
+        available = sa.func.coalesce(
+            sa.func.sum(convert(items.c.quantity, items.c.dimension, recipe_ingredients.c.dimension)), 0.0
+        )
+        ratios = sa.select([
+            recipe_ingredients.c.recipe_id,
+            (available / sa.func.nullif(recipe_ingredients.c.quantity, 0)).label('ratio'),
+        ]).select_from(
+            recipe_ingredients.join(
+                ingredients, recipe_ingredients.c.ingredient_id == ingredients.c.id
+            ).outerjoin(
+                items, and_(items.c.ingredient_id == recipe_ingredients.c.ingredient_id, items.c.amount > 0)
+            )
+        ).group_by(
+            recipe_ingredients.c.recipe_id, recipe_ingredients.c.ingredient_id, recipe_ingredients.c.quantity,
+            recipe_ingredients.c.dimension, ingredients.c.density, ingredients.c.piece_weight,
+        ).alias('ratios')
+
+        # the scarcest ingredient limits the recipe
+        return db.session.query(
+            Recipe.id.label('recipe_id'), sa.func.min(ratios.c.ratio).label('batches')
+        ).outerjoin(ratios, ratios.c.recipe_id == Recipe.id).group_by(Recipe.id).order_by(Recipe.id)
 
 
 @blp.route('/<int:recipe_id>')
 class RecipesbyID(MethodView):
 
-    @blp.etag
+    @blp.cache_response(*RECIPE_TABLES)
+    @blp.etag(VersionEtagSchema)
     @blp.response(200, RecipeSchema)
     def get(self, recipe_id):
         """Get recipe by ID"""
-        return Recipe.query.get_or_404(recipe_id)
+        return Recipe.query.options(*query_options(RecipeSchema)).get_or_404(recipe_id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(RecipeSchema)
     @blp.response(200, RecipeSchema)
     def put(self, new_recipe, recipe_id):
         """Update an existing recipe"""
-        recipe = Recipe.query.get_or_404(recipe_id)
-
-        blp.check_etag(recipe, RecipeSchema)
+        recipe = Recipe.query.options(*RECIPE_LOADERS).get_or_404(recipe_id)
 
-        # grab these to be added back manually
-        ingredients = new_recipe.pop('ingredients', None)
+        blp.check_etag(recipe, VersionEtagSchema)
 
-        # TODO schema complains about 'None is not list-like' if this isnt set
-        # assume its due to ingredients being part of the model?
-        new_recipe.update({'ingredients': []})
+        # the ingredients replace the current ones, rows for ingredients no longer listed are deleted
+        new_recipe['ingredients'] = resolve_recipe_ingredients(new_recipe.get('ingredients') or [])
 
         RecipeSchema().update(recipe, new_recipe)
 
-        if ingredients is not None:
-            for ringredient in ingredients:
-                ingredient = Ingredient.query.get(ringredient['ingredient_id'])
-
-                if ingredient is None:
-                    abort(422)
+        with abort_on_stale_data():
+            try:
+                db.session.add(recipe)
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                handle_integrity_error_and_abort(e)
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422, message="There was an error. Please try again.")
 
-                association = RecipeIngredient(amount=ringredient['amount'], unit=ringredient['unit'])
-                association.ingredient_id = ingredient.id
-                association.ingredient = ingredient
-                association.recipe_id = recipe.id
-                association.recipe = recipe
+        return Recipe.query.options(*RECIPE_LOADERS).filter(Recipe.id == recipe.id).one()
 
-                ingredient.recipes.append(association)
-                recipe.ingredients.append(association)
-
-        try:
-            db.session.add(recipe)
-            db.session.commit()
-        except exc.IntegrityError as e:
-            db.session.rollback()
-            handle_integrity_error_and_abort(e)
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422, message="There was an error. Please try again.")
-
-        return recipe
-
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.response(204)
     def delete(self, recipe_id):
         """Delete a recipe"""
         recipe = Recipe.query.get_or_404(recipe_id)
 
-        blp.check_etag(recipe, RecipeSchema)
+        blp.check_etag(recipe, VersionEtagSchema)
 
-        try:
-            db.session.delete(recipe)
-            db.session.commit()
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422)
+        with abort_on_stale_data():
+            try:
+                db.session.delete(recipe)
+                db.session.commit()
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422)
 
 
 @blp.route('/<int:recipe_id>/tags')
 class RecipeTags(MethodView):
 
+    @blp.cache_response(Recipe, recipe_tags, *TAG_TABLES)
     @blp.etag
+    @blp.collection_etag(Recipe, recipe_tags, *TAG_TABLES)
     @blp.response(200, TagSchema(many=True))
     def get(self, recipe_id):
         """Get tags associated with a recipe"""
@@ -212,22 +349,48 @@ class RecipeTags(MethodView):
 
         # tag_ids are required by the schema, so shouldn't need to check if they are none
         tag_ids = args.pop('tag_ids', None)
-        for tag_id in tag_ids:
-            tag = Tag.query.get(tag_id)
-
-            if tag is None:
-                abort(422)
 
-            recipe.tags.append(tag)
+        missing = missing_ids(Tag, tag_ids)
+        if missing:
+            abort(422, errors={'json': {'tagIds': [f"No such tag with id {tag_id}" for tag_id in missing]}})
 
         try:
-            db.session.add(recipe)
+            tag_recipes([recipe.id], tag_ids)
             db.session.commit()
         except (exc.IntegrityError, exc.DatabaseError):
             db.session.rollback()
             abort(422, message="There was an error. Please try again.")
 
 
+@blp.route('/tags')
+class RecipesTags(MethodView):
+
+    @blp.etag
+    @blp.arguments(BulkRecipeTagSchema)
+    @blp.response(204)
+    def post(self, args):
+        """Add every tag to every recipe, existing associations are left untouched"""
+        errors = {}
+
+        missing = missing_ids(Recipe, args['recipe_ids'])
+        if missing:
+            errors['recipeIds'] = [f"No such recipe with id {recipe_id}" for recipe_id in missing]
+
+        missing = missing_ids(Tag, args['tag_ids'])
+        if missing:
+            errors['tagIds'] = [f"No such tag with id {tag_id}" for tag_id in missing]
+
+        if errors:
+            abort(422, errors={'json': errors})
+
+        try:
+            tag_recipes(args['recipe_ids'], args['tag_ids'])
+            db.session.commit()
+        except exc.DatabaseError:
+            db.session.rollback()
+            abort(422, message="There was an error. Please try again.")
+
+
 @blp.route('/<int:recipe_id>/tags/<int:tag_id>')
 class RecipeTagsDelete(MethodView):
 
@@ -241,7 +404,7 @@ class RecipeTagsDelete(MethodView):
         if tag is None:
             abort(422)
 
-        blp.check_etag(recipe, RecipeSchema)
+        blp.check_etag(recipe, VersionEtagSchema)
 
         recipe.tags.remove(tag)
 
@@ -256,11 +419,15 @@ class RecipeTagsDelete(MethodView):
 @blp.route('/<int:recipe_id>/ingredients')
 class RecipeIngredients(MethodView):
 
+    @blp.cache_response(Recipe, *RINGREDIENT_TABLES)
     @blp.etag
+    @blp.collection_etag(Recipe, *RINGREDIENT_TABLES)
     @blp.response(200, RIngredientSchema(many=True))
     def get(self, recipe_id):
         """Get ingredients associated with a recipe"""
-        return Recipe.query.get_or_404(recipe_id).ingredients
+        recipe = Recipe.query.get_or_404(recipe_id)
+
+        return RecipeIngredient.query.with_parent(recipe, 'ingredients').options(*query_options(RIngredientSchema))
 
     @blp.etag
     @blp.arguments(RIngredientSchema(many=True))
@@ -269,25 +436,12 @@ class RecipeIngredients(MethodView):
         """Add association between a recipe and ingredient"""
         recipe = Recipe.query.get_or_404(recipe_id)
 
-        for ringredient in args:
-            ingredient = Ingredient.query.get(ringredient['ingredient_id'])
-
-            if ingredient is None:
-                abort(422)
-
-            association = RecipeIngredient(amount=ringredient['amount'], unit=ringredient['unit'])
-            association.ingredient_id = ingredient.id
-            association.ingredient = ingredient
-            association.recipe_id = recipe_id
-            association.recipe = recipe
-
-            ingredient.recipes.append(association)
-            recipe.ingredients.append(association)
+        associations = resolve_recipe_ingredients(args)
+        for association in associations:
+            association.recipe_id = recipe.id
 
         try:
-            db.session.add(ingredient)
-            db.session.add(recipe)
-            db.session.add(association)
+            db.session.add_all(associations)
             db.session.commit()
         except (exc.IntegrityError, exc.DatabaseError):
             db.session.rollback()
@@ -312,7 +466,7 @@ class RecipeIngredientsDelete(MethodView):
         if association is None:
             abort(422)
 
-        blp.check_etag(recipe, RecipeSchema)
+        blp.check_etag(recipe, VersionEtagSchema)
 
         try:
             db.session.delete(association)
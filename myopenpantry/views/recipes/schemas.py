@@ -1,10 +1,14 @@
+import math
+
 import marshmallow as ma
 from marshmallow_sqlalchemy import field_for
+from sqlalchemy.orm import joinedload, selectinload
 
 from myopenpantry.extensions.api import Schema, AutoSchema
 from myopenpantry.models.recipes import Recipe
 from myopenpantry.models.tags import Tag
-from myopenpantry.models.associations import RecipeIngredient
+from myopenpantry.models.associations import RecipeIngredient, recipe_tags
+from myopenpantry.models.ingredients import Ingredient
 from myopenpantry.views.ingredients.schemas import IngredientSchema
 
 
@@ -15,10 +19,17 @@ class TagSchema(AutoSchema):
 
     class Meta(AutoSchema.Meta):
         table = Tag.__table__
+        # the version is exposed through ETags only, see VersionEtagSchema
+        exclude = ('version',)
+
+
+# tables read when dumping tags, for listing ETags
+TAG_TABLES = (Tag,)
 
 
 class TagQueryArgsSchema(Schema):
     name = ma.fields.Str(validate=ma.validate.Length(min=1))
+    name_prefix = ma.fields.Str(validate=ma.validate.Length(min=1))
 
 
 # used to nest to make bulk recipe/ingredient associations
@@ -36,6 +47,19 @@ class RIngredientSchema(AutoSchema):
 
     class Meta(AutoSchema.Meta):
         table = RecipeIngredient.__table__
+        # canonical quantities are internal, see models/units.py
+        exclude = ('quantity', 'dimension')
+
+    LOADERS = {
+        'ingredient': joinedload(RecipeIngredient.ingredient),
+    }
+
+
+# loader options eagerly loading exactly what RIngredientSchema nests
+RINGREDIENT_LOADERS = RIngredientSchema().query_options()
+
+# tables read when dumping recipe ingredients, for listing ETags
+RINGREDIENT_TABLES = (RecipeIngredient, Ingredient)
 
 
 class RecipeSchema(AutoSchema):
@@ -43,6 +67,7 @@ class RecipeSchema(AutoSchema):
     created_at = field_for(Recipe, "created_at", dump_only=True)
     updated_at = field_for(Recipe, "updated_at", dump_only=True)
     rating = field_for(Recipe, 'rating', validate=ma.validate.Range(min=0))
+    missing_ingredient_count = field_for(Recipe, 'missing_ingredient_count', dump_only=True)
 
     ingredients = ma.fields.Nested(RIngredientSchema, many=True)
 
@@ -51,15 +76,50 @@ class RecipeSchema(AutoSchema):
 
     class Meta(AutoSchema.Meta):
         table = Recipe.__table__
+        # the version is exposed through ETags only, see VersionEtagSchema
+        exclude = ('version',)
+
+    LOADERS = {
+        'ingredients': selectinload(Recipe.ingredients).joinedload(RecipeIngredient.ingredient),
+        'tags': selectinload(Recipe.tags),
+    }
+
+
+# loader options eagerly loading exactly what RecipeSchema nests, so a page of recipes costs a fixed number of queries
+RECIPE_LOADERS = RecipeSchema().query_options()
+
+# tables read when dumping recipes, for listing ETags
+RECIPE_TABLES = (Recipe, RecipeIngredient, Ingredient, recipe_tags, Tag)
 
 
 class RecipeQueryArgsSchema(Schema):
     name = ma.fields.Str(validate=ma.validate.Length(min=1))
+    # full text search over name, steps and notes. Supports "phrases" and prefix* terms
+    q = ma.fields.Str(validate=ma.validate.Length(min=1))
+    # tag ids the recipes must all have, have at least one of, or have none of
+    tags_all = ma.fields.List(ma.fields.Int(validate=ma.validate.Range(min=1)))
+    tags_any = ma.fields.List(ma.fields.Int(validate=ma.validate.Range(min=1)))
+    tags_none = ma.fields.List(ma.fields.Int(validate=ma.validate.Range(min=1)))
     can_make = ma.fields.Bool(required=False)
 
 
+# ratios are floored here since floor(min(x)) == min(floor(x)), which keeps the SQL dialect neutral
+class RecipeBatchesSchema(Schema):
+    recipe_id = ma.fields.Int()
+    # null when no ingredient limits the recipe, eg it has no ingredients
+    batches = ma.fields.Function(lambda row: None if row.batches is None else math.floor(row.batches + 1e-9))
+
+
 class RecipeTagSchema(Schema):
     tag_ids = ma.fields.List(
         ma.fields.Int(strict=True, validate=ma.validate.Range(min=1)),
         required=True, validate=ma.validate.Length(min=1)
     )
+
+
+# used to tag many recipes at once
+class BulkRecipeTagSchema(RecipeTagSchema):
+    recipe_ids = ma.fields.List(
+        ma.fields.Int(strict=True, validate=ma.validate.Range(min=1)),
+        required=True, validate=ma.validate.Length(min=1)
+    )
@@ -3,10 +3,12 @@ from flask_smorest import abort
 
 from sqlalchemy import exc
 
-from myopenpantry.extensions.api import Blueprint, SQLCursorPage
-from myopenpantry.extensions.database import db
-from myopenpantry.models import Tag
-from ..recipes.schemas import RecipeSchema, TagSchema, TagQueryArgsSchema
+from myopenpantry.extensions.api import Blueprint, SQLCursorPage, VersionEtagSchema, query_options
+from myopenpantry.extensions.database import db, abort_on_stale_data, integrity_errors
+from myopenpantry.models import Recipe, Tag, name_contains, name_startswith
+from ..recipes.schemas import (
+    RecipeSchema, TagSchema, TagQueryArgsSchema, RECIPE_TABLES, TAG_TABLES
+)
 
 blp = Blueprint(
     'Tags',
@@ -16,7 +18,12 @@ blp = Blueprint(
 )
 
 
-# TODO this is duplicated in each view. Create a controller to move all backend logic to
+# request field and message of each constraint violation, see extensions/database/errors.py
+INTEGRITY_ERRORS = {
+    'uq_tags_name': ('name', "Tag with that name already exists"),
+}
+
+
 # Trying to stay consistent with other error stuctures, eg:
 # "errors": {
 #   "json": {
@@ -26,35 +33,34 @@ blp = Blueprint(
 #   }
 # }, which is returned when by the Schema validation
 def handle_integrity_error_and_abort(e):
-    # TODO surely there is a better way to figure out what the error type is?
     # TODO log the error
-    e = repr(e)
-    errors = {'json': {}}
-    if e.find('UNIQUE constraint failed: tags.name') != -1:
-        errors['json']['name'] = ["Tag with that name already exists"]
-
-    abort(422, errors=errors)
+    abort(422, errors={'json': integrity_errors(e, INTEGRITY_ERRORS)})
 
 
 @blp.route('/')
 class Tags(MethodView):
 
+    @blp.cache_response(*TAG_TABLES)
     @blp.etag
+    @blp.collection_etag(*TAG_TABLES)
     @blp.arguments(TagQueryArgsSchema, location='query')
     @blp.response(200, TagSchema(many=True))
     @blp.paginate(SQLCursorPage)
     def get(self, args):
         """List tags"""
         name = args.pop('name', None)
+        name_prefix = args.pop('name_prefix', None)
 
-        ret = Tag.query.filter_by(**args)
+        ret = Tag.query.options(*query_options(TagSchema)).filter_by(**args)
 
         if name is not None:
-            ret = ret.filter(Tag.name.like(f"%{name}%"))
+            ret = ret.filter(name_contains(Tag, name))
+        if name_prefix is not None:
+            ret = ret.filter(name_startswith(Tag, name_prefix))
 
         return ret.order_by(Tag.id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(TagSchema)
     @blp.response(201, TagSchema)
     def post(self, new_tag):
@@ -77,52 +83,63 @@ class Tags(MethodView):
 @blp.route('/<int:tag_id>')
 class TagsbyID(MethodView):
 
-    @blp.etag
+    @blp.cache_response(*TAG_TABLES)
+    @blp.etag(VersionEtagSchema)
     @blp.response(200, TagSchema)
     def get(self, tag_id):
         """Get tag by ID"""
-        return Tag.query.get_or_404(tag_id)
+        return Tag.query.options(*query_options(TagSchema)).get_or_404(tag_id)
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.arguments(TagSchema)
     @blp.response(200, TagSchema)
     def put(self, new_tag, tag_id):
         """Update an existing tag"""
         tag = Tag.query.get_or_404(tag_id)
 
-        blp.check_etag(tag, TagSchema)
+        blp.check_etag(tag, VersionEtagSchema)
 
         TagSchema().update(tag, new_tag)
 
-        try:
-            db.session.add(tag)
-            db.session.commit()
-        except exc.IntegrityError as e:
-            db.session.rollback()
-            handle_integrity_error_and_abort(e)
-        except exc.DatabaseError:
-            db.session.rollback()
-            abort(422, message="There was an error. Please try again.")
+        with abort_on_stale_data():
+            try:
+                db.session.add(tag)
+                db.session.commit()
+            except exc.IntegrityError as e:
+                db.session.rollback()
+                handle_integrity_error_and_abort(e)
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422, message="There was an error. Please try again.")
 
         return tag
 
-    @blp.etag
+    @blp.etag(VersionEtagSchema)
     @blp.response(204)
     def delete(self, tag_id):
         """Delete a tag"""
         tag = Tag.query.get_or_404(tag_id)
 
-        blp.check_etag(tag, TagSchema)
+        blp.check_etag(tag, VersionEtagSchema)
 
-        db.session.delete(tag)
-        db.session.commit()
+        with abort_on_stale_data():
+            try:
+                db.session.delete(tag)
+                db.session.commit()
+            except exc.DatabaseError:
+                db.session.rollback()
+                abort(422)
 
 
 @blp.route('/<int:tag_id>/recipes')
 class TagRecipes(MethodView):
 
+    @blp.cache_response(*RECIPE_TABLES)
     @blp.etag
+    @blp.collection_etag(*RECIPE_TABLES)
     @blp.response(200, RecipeSchema(many=True))
     def get(self, tag_id):
         """Get recipes associated with a tag"""
-        return Tag.query.get_or_404(tag_id).recipes
+        tag = Tag.query.get_or_404(tag_id)
+
+        return Recipe.query.with_parent(tag, 'recipes').options(*query_options(RecipeSchema)).order_by(Recipe.id)
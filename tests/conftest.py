@@ -1,10 +1,32 @@
 import pytest
 
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
 from myopenpantry import create_app
+from myopenpantry.extensions.database import db
 
 
 @pytest.fixture
 def app():
     application = create_app(config_name='testing')
     application.config['TESTING'] = True
-    return application
+    yield application
+
+    # unlike in memory SQLite, other test databases outlive the app
+    with application.app_context():
+        db.session.remove()
+        db.drop_all()
+
+
+@pytest.fixture
+def queries():
+    """List of SQL statements executed during the test, clear it before the calls to measure"""
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        statements.append(statement)
+
+    event.listen(Engine, 'before_cursor_execute', before_cursor_execute)
+    yield statements
+    event.remove(Engine, 'before_cursor_execute', before_cursor_execute)
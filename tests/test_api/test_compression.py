@@ -0,0 +1,84 @@
+import gzip
+import json
+
+
+class TestCompression:
+    def test_compressed_listing(self, app):
+        client = app.test_client()
+
+        for i in range(20):
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'recipe {i}', 'steps': 'mix everything together and bake for an hour ' * 25},
+            )
+
+            assert response.status_code == 201
+
+        plain = client.get('recipes/')
+        response = client.get('recipes/', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'Accept-Encoding' in response.headers['Vary']
+        assert len(response.get_data()) < len(plain.get_data())
+        assert gzip.decompress(response.get_data()) == plain.get_data()
+
+        # the encoding is a representation of its own, with its own ETag
+        assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+
+        response = client.get('recipes/', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']
+        })
+
+        assert response.status_code == 304
+        assert response.headers['ETag'] == plain.headers['ETag'][:-1] + '-gzip"'
+
+        # small responses are sent as they are
+        response = client.get('recipes/?page_size=1&fields=id', headers={'Accept-Encoding': 'gzip'})
+
+        assert 'Content-Encoding' not in response.headers
+
+        # streams are compressed chunk by chunk
+        response = client.get('recipes/', headers={'Accept': 'application/x-ndjson', 'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        lines = gzip.decompress(response.get_data()).decode().splitlines()
+        assert len(lines) == 20
+        assert json.loads(lines[0]) == plain.json[0]
+
+        # preconditions are checked against the ETag before encoding
+        response = client.get('recipes/1', headers={'Accept-Encoding': 'gzip'})
+        etag = response.headers['ETag']
+
+        assert etag.endswith('-gzip"')
+
+        response = client.put(
+            'recipes/1',
+            headers={'If-Match': etag},
+            json={'name': 'recipe 0', 'steps': 'mix everything together and bake for two hours ' * 25},
+        )
+
+        assert response.status_code == 200
+
+    def test_precompressed_spec(self, app):
+        client = app.test_client()
+
+        plain = client.get('api-spec.json')
+
+        assert plain.status_code == 200
+        assert 'Content-Encoding' not in plain.headers
+
+        response = client.get('api-spec.json', headers={'Accept-Encoding': 'gzip'})
+
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert gzip.decompress(response.get_data()) == plain.get_data()
+        # every encoding has its own strong ETag
+        assert response.headers['ETag'] != plain.headers['ETag']
+        assert not response.headers['ETag'].startswith('W/')
+
+        response = client.get('api-spec.json', headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']
+        })
+
+        assert response.status_code == 304
@@ -0,0 +1,16 @@
+class TestDiagnostics:
+    def test_get(self, app):
+        client = app.test_client()
+
+        client.get('recipes/')
+        client.get('recipes/')
+
+        response = client.get('diagnostics/')
+
+        assert response.status_code == 200
+        database = response.json['database']
+        if database['dialect'] == 'sqlite':
+            assert database['pragmas']['foreign_keys'] == 1
+            assert database['pragmas']['busy_timeout'] == app.config['SQLITE_PRAGMAS']['busy_timeout']
+        assert response.json['caches']['responses']['hits'] == 1
+        assert response.json['caches']['responses']['misses'] == 1
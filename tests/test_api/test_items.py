@@ -1,4 +1,18 @@
+import base64
+import json
+
 import dateutil.parser
+import pytest
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.schema import CreateIndex
+from werkzeug.exceptions import HTTPException
+
+from myopenpantry.extensions.database import abort_on_stale_data, db
+from myopenpantry.models import Ingredient, Item, Tag, name_index
+from myopenpantry.views.items import resources
 
 
 class TestItems:
@@ -311,6 +325,76 @@ class TestItems:
             if resp.get('len', None):
                 assert len(response.json) == resp['len']
 
+    def test_name_search(self, app, monkeypatch):
+        client = app.test_client()
+
+        ids = {}
+        for name in ('Kroger Eggs', 'Egg Noodles', 'Eggplant', '100% Juice', 'Éclair'):
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json={'name': name, 'amount': 1},
+            )
+            assert response.status_code == 201
+            ids[name] = (response.json['id'], response.headers['ETag'])
+
+        def names(**query):
+            response = client.get('items/', query_string=query)
+            assert response.status_code == 200
+            return sorted(item['name'] for item in response.json)
+
+        assert names(name='EGG') == ['Egg Noodles', 'Eggplant', 'Kroger Eggs']
+        assert names(name='gg') == ['Egg Noodles', 'Eggplant', 'Kroger Eggs']
+        assert names(name='eggs') == ['Kroger Eggs']
+        assert names(name='0%') == ['100% Juice']
+        assert names(name='o%') == []
+        assert names(namePrefix='egg') == ['Egg Noodles', 'Eggplant']
+        # lowered like the names, SQLite only folds ASCII letters
+        assert names(namePrefix='É') == ['Éclair']
+        assert names(namePrefix='ÉCL') == ['Éclair']
+        assert names(namePrefix='ÉCLAIR') == ['Éclair']
+        assert names(namePrefix='ecl') == []
+
+        # renamed and deleted rows are reindexed
+        id, etag = ids['Eggplant']
+        response = client.put(f'items/{id}', headers={"If-Match": etag}, json={'name': 'Aubergine', 'amount': 1})
+        assert response.status_code == 200
+        id, etag = ids['Kroger Eggs']
+        response = client.delete(f'items/{id}', headers={"If-Match": etag})
+        assert response.status_code == 204
+
+        assert names(name='egg') == ['Egg Noodles']
+        assert names(name='bergi') == ['Aubergine']
+        assert names(namePrefix='AUB') == ['Aubergine']
+
+        with app.app_context():
+            indexed = db.session.execute(
+                "SELECT DISTINCT row_id FROM name_trigrams WHERE table_name = 'items' ORDER BY row_id"
+            ).fetchall()
+        assert [row_id for row_id, in indexed] == sorted(
+            id for name, (id, _) in ids.items() if name != 'Kroger Eggs'
+        )
+
+        # rebuilt a batch at a time
+        monkeypatch.setattr(name_index, 'BATCH_SIZE', 1)
+        with app.app_context():
+            name_index.rebuild_name_index(db.session.connection())
+            db.session.commit()
+        assert names(name='egg') == ['Egg Noodles']
+        assert names(name='0%') == ['100% Juice']
+        assert names(name='bergi') == ['Aubergine']
+
+    def test_name_prefix_collation(self):
+        # prefix ranges follow byte order, which PostgreSQL only uses when told to
+        index = next(index for index in Item.__table__.indexes if index.name == 'ix_items_lower_name')
+        prefix = name_index.name_startswith(Item, 'egg')
+        assert str(CreateIndex(index).compile(dialect=postgresql.dialect())).endswith(
+            '((lower(name) COLLATE "C"))'
+        )
+        assert str(prefix.compile(dialect=postgresql.dialect())).startswith('(lower(items.name) COLLATE "C") >=')
+        assert str(CreateIndex(index).compile(dialect=sqlite.dialect())).endswith('(lower(name))')
+        assert str(prefix.compile(dialect=sqlite.dialect())).startswith('lower(items.name) >=')
+
     def test_delete(self, app):
         client = app.test_client()
 
@@ -381,3 +465,390 @@ class TestItems:
         )
 
         assert response.status_code == 404
+
+    def test_get_query_count(self, app, queries):
+        client = app.test_client()
+
+        for i in range(20):
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'ingredient {i}'},
+            )
+
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'item {i}', 'amount': 1, 'ingredientId': response.json['id']},
+            )
+
+            assert response.status_code == 201
+
+        # the number of queries should not depend on the number of items returned. Warm up the count cache first
+        client.get('items/')
+        counts = []
+        for page_size in (2, 20):
+            queries.clear()
+            response = client.get('items/', query_string={'page_size': page_size})
+
+            assert response.status_code == 200
+            assert all('ingredient' in item for item in response.json)
+            counts.append(len(queries))
+
+        assert counts[0] == counts[1]
+
+    def test_get_cursor(self, app):
+        client = app.test_client()
+
+        for i in range(25):
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'item {i}', 'amount': 1},
+            )
+
+            assert response.status_code == 201
+
+        # page through with cursors, inserting a new item on the way
+        ids = []
+        query = {'page_size': 10}
+        while True:
+            response = client.get('items/', query_string=query)
+
+            assert response.status_code == 200
+
+            ids += [item['id'] for item in response.json]
+            pagination = json.loads(response.headers['X-Pagination'])
+            if 'next_after' not in pagination:
+                break
+
+            query['after'] = pagination['next_after']
+
+            if len(ids) == 10:
+                response = client.post(
+                    'items/',
+                    headers={"Content-Type": "application/json"},
+                    json={'name': 'item 25', 'amount': 1},
+                )
+
+                assert response.status_code == 201
+
+        assert ids == list(range(1, 27))
+        assert pagination == {'total': 26}
+
+        # counting can be skipped
+        response = client.get('items/', query_string={'page_size': 10, 'count': False})
+        pagination = json.loads(response.headers['X-Pagination'])
+
+        assert 'total' not in pagination
+        assert 'next_after' in pagination
+
+        response = client.get('items/', query_string={'after': 'not a cursor'})
+
+        assert response.status_code == 422
+
+        # well formed cursors with values that aren't sort keys
+        for forged in ([{'a': 1}], [[1]], [10 ** 30], ['1'], [1, 2], {'id': 1}):
+            cursor = base64.urlsafe_b64encode(json.dumps(forged).encode()).decode()
+            response = client.get('items/', query_string={'after': cursor})
+
+            assert response.status_code == 422
+            assert response.json['errors']['query']['after'] == ["Invalid cursor."]
+
+    def test_get_count_cache(self, app, queries):
+        client = app.test_client()
+
+        def count_queries():
+            return len([query for query in queries if query.startswith('SELECT count(*)')])
+
+        for i in range(3):
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'item {i}', 'amount': 1},
+            )
+
+            assert response.status_code == 201
+
+        for query, total, counted in (
+            # the second identical listing reuses the count
+            ({'name': 'item'}, 3, 1),
+            ({'name': 'item', 'page': 2}, 3, 0),
+            ({'name': 'item 1'}, 1, 1),
+            # unfiltered estimates use the maintained row count
+            ({'estimate': True}, 3, 0),
+            # filtered estimates fall back to counting
+            ({'name': 'item 2', 'estimate': True}, 1, 1),
+        ):
+            queries.clear()
+            response = client.get('items/', query_string=query)
+
+            assert response.status_code == 200
+            assert json.loads(response.headers['X-Pagination'])['total'] == total
+            assert count_queries() == counted
+
+        # writing to the table invalidates the cached counts
+        response = client.post(
+            'items/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'item 3', 'amount': 1},
+        )
+
+        for query in ({'name': 'item'}, {'estimate': True}):
+            response = client.get('items/', query_string=query)
+
+            assert json.loads(response.headers['X-Pagination'])['total'] == 4
+
+    def test_etag_versions(self, app):
+        client = app.test_client()
+
+        response = client.post(
+            'ingredients/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'eggs'},
+        )
+        ingredient_id = response.json['id']
+
+        response = client.post(
+            'items/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Large Eggs', 'amount': 12, 'ingredientId': ingredient_id},
+        )
+
+        assert response.status_code == 201
+
+        item_id = response.json['id']
+        etag = response.headers['ETag']
+        updated_at = response.json['updatedAt']
+
+        response = client.get(f'items/{item_id}', headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+
+        # stocking the ingredient changed its representation, and so its etag
+        response = client.get(f'ingredients/{ingredient_id}')
+
+        assert response.json['inStock']
+
+        # renaming the nested ingredient changes the item's etag
+        response = client.put(
+            f'ingredients/{ingredient_id}',
+            headers={'If-Match': response.headers['ETag']},
+            json={'name': 'Eggs'},
+        )
+
+        assert response.status_code == 200
+
+        response = client.get(f'items/{item_id}', headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.json['ingredient']['name'] == 'Eggs'
+        # a new version, not an edit of the item
+        assert response.json['updatedAt'] == updated_at
+
+        response = client.put(
+            f'items/{item_id}',
+            headers={'If-Match': etag},
+            json={'name': 'Large Brown Eggs', 'amount': 12},
+        )
+
+        assert response.status_code == 412
+
+        # a write between the precondition check and the update is caught by the version check
+        with app.app_context():
+            item = Item.query.get(item_id)
+            db.session.execute(Item.__table__.update().values(version=Item.__table__.c.version + 1))
+            item.name = 'Large Brown Eggs'
+
+            with pytest.raises(StaleDataError):
+                db.session.commit()
+
+            db.session.rollback()
+
+        # which PUT and DELETE answer with 412, rolled back
+        with app.test_request_context():
+            item = Item.query.get(item_id)
+            db.session.execute(Item.__table__.update().values(version=Item.__table__.c.version + 1))
+            item.name = 'Large Brown Eggs'
+
+            with pytest.raises(HTTPException) as error:
+                with abort_on_stale_data():
+                    db.session.commit()
+
+            assert error.value.code == 412
+            assert Item.query.get(item_id).name != 'Large Brown Eggs'
+
+        # only the loaded rows whose versions a flush bumped are reloaded
+        with app.app_context():
+            item = Item.query.get(item_id)
+            ingredient = Ingredient.query.get(ingredient_id)
+            tag = Tag(name='breakfast')
+            db.session.add(tag)
+            db.session.flush()
+
+            ingredient.name = 'Brown Eggs'
+            db.session.flush()
+
+            assert 'version' not in inspect(item).dict
+            assert 'version' in inspect(tag).dict
+
+            # the reloaded version passes the version check
+            item.amount = 6
+            db.session.commit()
+
+    def test_get_stream(self, app):
+        client = app.test_client()
+        app.config['STREAM_BATCH_SIZE'] = 2
+
+        for i in range(5):
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'item {i}', 'amount': i},
+            )
+
+            assert response.status_code == 201
+
+        # every row, regardless of the page size
+        response = client.get('items/', query_string={'page_size': 2}, headers={'Accept': 'application/x-ndjson'})
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.mimetype == 'application/x-ndjson'
+        assert 'X-Pagination' not in response.headers
+
+        lines = response.get_data(as_text=True).splitlines()
+
+        assert [json.loads(line)['name'] for line in lines] == [f'item {i}' for i in range(5)]
+
+        # filters still apply, and the array is the same as the paginated listing
+        page = client.get('items/', query_string={'name': 'item', 'page_size': 10})
+        response = client.get('items/', query_string={'name': 'item', 'stream': True})
+
+        assert response.status_code == 200
+        assert response.is_streamed
+        assert response.json == page.json
+
+        response = client.get('items/', query_string={'name': 'nothing', 'stream': True})
+
+        assert response.json == []
+
+        # streamed and paginated listings have their own etags
+        assert response.headers['ETag'] != client.get('items/', query_string={'name': 'nothing'}).headers['ETag']
+
+    def test_post_constraint_errors(self, app):
+        client = app.test_client()
+
+        response = client.post(
+            'items/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Kroger Eggs', 'amount': 12, 'productId': 1234567890123},
+        )
+
+        assert response.status_code == 201
+
+        item_errors = (
+            ({'name': 'Kroger Eggs', 'amount': 6}, {'name': ["Item with that name already exists"]}),
+            (
+                {'name': 'Costco Eggs', 'amount': 6, 'productId': 1234567890123},
+                {'productId': ["Item with that product ID already exists"]},
+            ),
+            (
+                {'name': 'Costco Eggs', 'amount': 6, 'ingredientId': 42},
+                {'ingredientId': ["No such ingredient with that id"]},
+            ),
+        )
+
+        for item, errors in item_errors:
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json=item,
+            )
+
+            assert response.status_code == 422
+            assert response.json['errors'] == {'json': errors}
+
+    def test_import(self, app):
+        client = app.test_client()
+        app.config['IMPORT_BATCH_SIZE'] = 2
+
+        response = client.post('ingredients/', json={'name': 'Eggs'})
+        assert response.status_code == 201
+        ingredient_id = response.json['id']
+
+        response = client.post('items/', json={'name': 'Kroger Eggs', 'amount': 0, 'productId': 111})
+        assert response.status_code == 201
+
+        csv = (
+            "name,amount,unit,productId,ingredientId\n"
+            f"Costco Eggs,24,,222,{ingredient_id}\n"
+            "Kroger Eggs,6,,,\n"
+            "Flour,2,kg,,\n"
+            "Sugar,-1,,,\n"
+            "Flour,1,,,\n"
+            "Rice,1,,,99\n"
+        )
+        response = client.post('items/import', data=csv, content_type='text/csv')
+
+        assert response.status_code == 200
+        assert response.json['inserted'] == 2
+        assert response.json['updated'] == 0
+        assert response.json['failed'] == 4
+        assert [error['row'] for error in response.json['errors']] == [2, 4, 5, 6]
+        assert response.json['errors'][0]['errors'] == {'name': ["Item with that name already exists"]}
+        assert response.json['errors'][3]['errors'] == {'ingredientId': ["No such ingredient with that id"]}
+
+        # written rows are searchable and stock their ingredient
+        response = client.get('items/', query_string={'name': 'costco'})
+        assert [item['productId'] for item in response.json] == [222]
+        response = client.get(f'ingredients/{ingredient_id}')
+        assert response.json['inStock'] is True
+
+        # upserts update the item of the product ID with the fields given
+        ndjson = b'{"productId": 111, "amount": 12}\n\n{"productId": 333, "amount": 1}\nnot json\n'
+        response = client.post('items/import?upsert=true', data=ndjson, content_type='application/x-ndjson')
+
+        assert response.status_code == 200
+        assert (response.json['inserted'], response.json['updated'], response.json['failed']) == (0, 1, 2)
+        assert response.json['errors'] == [
+            {'row': 2, 'errors': {'name': ["Missing data for required field."]}},
+            {'row': 3, 'errors': {'_schema': ["Invalid JSON."]}},
+        ]
+
+        response = client.get('items/', query_string={'productId': 111})
+        assert response.json[0]['name'] == 'Kroger Eggs'
+        assert response.json[0]['amount'] == 12
+
+        response = client.post('items/import', data='[]', content_type='application/json')
+
+        assert response.status_code == 415
+
+    def test_import_database_error(self, app, monkeypatch):
+        client = app.test_client()
+        app.config['IMPORT_BATCH_SIZE'] = 2
+        batches = []
+
+        def index_names(connection, model, names, new=False):
+            batches.append(names)
+            if len(batches) == 2:
+                raise OperationalError('INSERT', {}, Exception('disk I/O error'))
+            original_index_names(connection, model, names, new)
+
+        original_index_names = resources.index_names
+        monkeypatch.setattr(resources, 'index_names', index_names)
+
+        csv = "name,amount\nCrème Fraîche,1\nFlour,2\nSugar,3\nRice,4\nSalt,5\n"
+        response = client.post('items/import', data=csv.encode(), content_type='text/csv')
+
+        # the failed batch is reported, the batches around it are written
+        assert response.status_code == 200
+        assert (response.json['inserted'], response.json['updated'], response.json['failed']) == (3, 0, 2)
+        assert response.json['errors'] == [
+            {'row': row, 'errors': {'_schema': ["There was an error. Please try again."]}} for row in (3, 4)
+        ]
+
+        response = client.get('items/', query_string={'name': 'fraîche'})
+        assert [item['name'] for item in response.json] == ['Crème Fraîche']
+        response = client.get('items/', query_string={'name': 'alt'})
+        assert [item['name'] for item in response.json] == ['Salt']
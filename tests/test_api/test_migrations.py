@@ -0,0 +1,72 @@
+import sqlalchemy as sa
+
+from myopenpantry import create_app
+from myopenpantry.config import TestingConfig
+from myopenpantry.extensions.database import db, migrations
+
+# schema of the first release, created by create_all before revisions were recorded
+UNVERSIONED_SCHEMA = (
+    "CREATE TABLE ingredients (id INTEGER NOT NULL, name VARCHAR(128) NOT NULL, PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE recipes (id INTEGER NOT NULL, name TEXT NOT NULL, steps TEXT NOT NULL, notes TEXT, rating INTEGER, "
+    "created_at DATETIME, updated_at DATETIME, PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE tags (id INTEGER NOT NULL, name TEXT NOT NULL, PRIMARY KEY (id), UNIQUE (name))",
+    "CREATE TABLE items (id INTEGER NOT NULL, name TEXT NOT NULL, product_id INTEGER, amount INTEGER NOT NULL, "
+    "updated_at DATETIME, ingredient_id INTEGER, PRIMARY KEY (id), UNIQUE (name), UNIQUE (product_id), "
+    "FOREIGN KEY(ingredient_id) REFERENCES ingredients (id))",
+    "CREATE TABLE recipe_tags (recipe_id INTEGER NOT NULL, tag_id INTEGER NOT NULL, PRIMARY KEY (recipe_id, tag_id), "
+    "FOREIGN KEY(recipe_id) REFERENCES recipes (id), FOREIGN KEY(tag_id) REFERENCES tags (id))",
+    "CREATE TABLE recipe_ingredients (recipe_id INTEGER NOT NULL, ingredient_id INTEGER NOT NULL, "
+    "amount NUMERIC(5, 3), unit TEXT, PRIMARY KEY (recipe_id, ingredient_id), "
+    "FOREIGN KEY(recipe_id) REFERENCES recipes (id), FOREIGN KEY(ingredient_id) REFERENCES ingredients (id))",
+    "INSERT INTO ingredients (id, name) VALUES (1, 'Eggs')",
+    "INSERT INTO items (id, name, amount, ingredient_id) VALUES (1, 'Kroger Eggs', 12, 1)",
+    "INSERT INTO recipes (id, name, steps) VALUES (1, 'Omelette', 'Whisk the eggs')",
+    "INSERT INTO recipe_ingredients (recipe_id, ingredient_id, amount) VALUES (1, 1, 2)",
+)
+
+
+class TestMigrations:
+    def test_upgrade_unversioned(self, monkeypatch, tmp_path, queries):
+        url = f'sqlite:///{tmp_path / "pantry.db"}'
+        monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', url)
+
+        engine = sa.create_engine(url)
+        for statement in UNVERSIONED_SCHEMA:
+            engine.execute(statement)
+
+        app = create_app(config_name='testing')
+
+        with app.app_context():
+            inspector = sa.inspect(db.engine)
+            assert 'version' in {column['name'] for column in inspector.get_columns('items')}
+            assert 'ix_items_ingredient_id' in {index['name'] for index in inspector.get_indexes('items')}
+            assert migrations.current_revision(db.engine) == migrations.head()
+
+        client = app.test_client()
+
+        # existing rows are indexed and counted
+        response = client.get('items/', query_string={'name': 'roger'})
+        assert [item['id'] for item in response.json] == [1]
+        response = client.get('recipes/', query_string={'q': 'whisk'})
+        assert [recipe['id'] for recipe in response.json] == [1]
+        response = client.get('recipes/', query_string={'canMake': True})
+        assert [recipe['id'] for recipe in response.json] == [1]
+        # 12 eggs in stock, 2 per omelette
+        response = client.get('recipes/batches')
+        assert response.json == [{'recipeId': 1, 'batches': 6}]
+        # backfilling and recounting aren't edits
+        response = client.get('items/1')
+        assert 'updatedAt' not in response.json
+
+        # a current schema is only checked, never introspected
+        queries.clear()
+        create_app(config_name='testing')
+
+        assert len(queries) == 1
+        assert 'schema_revisions' in queries[0]
+
+    def test_new_database(self, app):
+        with app.app_context():
+            rows = db.session.execute(sa.select([migrations.schema_revisions.c.revision])).fetchall()
+
+        assert [revision for revision, in rows] == sorted(migrations.REVISIONS)
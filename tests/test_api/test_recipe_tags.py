@@ -1,3 +1,5 @@
+import json
+
 
 class TestRecipeTags:
     def test_link_get(self, app):
@@ -256,3 +258,164 @@ class TestRecipeTags:
 
             assert response.status_code == 200
             assert len(response.json) == 0
+
+    def test_link_existing(self, app):
+        client = app.test_client()
+
+        response = client.post(
+            'recipes/',
+            headers={'Content-Type': 'application/json'},
+            json={'name': 'Arugula Salad', 'steps': 'toss'}
+        )
+
+        recipe_id = response.json['id']
+
+        tag_ids = []
+        for name in ('arugula', 'salad'):
+            response = client.post(
+                'tags/',
+                headers={'Content-Type': 'application/json'},
+                json={'name': name}
+            )
+
+            tag_ids.append(response.json['id'])
+
+        response = client.post(
+            f'recipes/{recipe_id}/tags',
+            headers={'Content-Type': 'application/json'},
+            json={'tagIds': tag_ids[:1]}
+        )
+
+        assert response.status_code == 204
+
+        # tags already on the recipe are skipped instead of failing the whole request
+        response = client.post(
+            f'recipes/{recipe_id}/tags',
+            headers={'Content-Type': 'application/json'},
+            json={'tagIds': tag_ids}
+        )
+
+        assert response.status_code == 204
+
+        response = client.get(f'recipes/{recipe_id}/tags')
+
+        assert sorted(tag['id'] for tag in response.json) == tag_ids
+
+    def test_bulk_link(self, app):
+        client = app.test_client()
+
+        recipe_ids = []
+        for name in ('Arugula Salad', 'Fruit Salad', 'Pasta Salad'):
+            response = client.post(
+                'recipes/',
+                headers={'Content-Type': 'application/json'},
+                json={'name': name, 'steps': 'toss'}
+            )
+
+            recipe_ids.append(response.json['id'])
+
+        tag_ids = []
+        for name in ('salad', 'quick'):
+            response = client.post(
+                'tags/',
+                headers={'Content-Type': 'application/json'},
+                json={'name': name}
+            )
+
+            tag_ids.append(response.json['id'])
+
+        response = client.post(
+            f'recipes/{recipe_ids[0]}/tags',
+            headers={'Content-Type': 'application/json'},
+            json={'tagIds': tag_ids[:1]}
+        )
+
+        assert response.status_code == 204
+
+        # cache the count of the recipes with the tags
+        response = client.get('recipes/', query_string={'tagsAll': tag_ids})
+
+        assert json.loads(response.headers['X-Pagination'])['total'] == 0
+
+        response = client.post(
+            'recipes/tags',
+            headers={'Content-Type': 'application/json'},
+            json={'recipeIds': recipe_ids, 'tagIds': tag_ids}
+        )
+
+        assert response.status_code == 204
+
+        response = client.get('recipes/', query_string={'tagsAll': tag_ids})
+
+        assert json.loads(response.headers['X-Pagination'])['total'] == 3
+
+        for tag_id in tag_ids:
+            response = client.get(f'tags/{tag_id}/recipes')
+
+            assert [recipe['id'] for recipe in response.json] == recipe_ids
+
+        # every unknown id is reported
+        response = client.post(
+            'recipes/tags',
+            headers={'Content-Type': 'application/json'},
+            json={'recipeIds': [recipe_ids[0], 998], 'tagIds': [tag_ids[0], 999]}
+        )
+
+        assert response.status_code == 422
+        assert response.json['errors']['json'] == {
+            'recipeIds': ['No such recipe with id 998'],
+            'tagIds': ['No such tag with id 999'],
+        }
+
+    def test_query(self, app):
+        client = app.test_client()
+
+        tag_ids = dict()
+        for name in ('salad', 'quick', 'vegetarian'):
+            response = client.post(
+                'tags/',
+                headers={'Content-Type': 'application/json'},
+                json={'name': name}
+            )
+
+            tag_ids[name] = response.json['id']
+
+        recipes = [
+            ('Arugula Salad', ['salad', 'quick', 'vegetarian']),
+            ('Chicken Salad', ['salad']),
+            ('Stir Fry', ['quick']),
+            ('Lasagna', []),
+        ]
+
+        for name, tags in recipes:
+            response = client.post(
+                'recipes/',
+                headers={'Content-Type': 'application/json'},
+                json={'name': name, 'steps': 'cook'}
+            )
+
+            assert response.status_code == 201
+
+            if tags:
+                response = client.post(
+                    f"recipes/{response.json['id']}/tags",
+                    headers={'Content-Type': 'application/json'},
+                    json={'tagIds': [tag_ids[tag] for tag in tags]}
+                )
+
+                assert response.status_code == 204
+
+        query_resp = [
+            ({'tagsAll': [tag_ids['salad'], tag_ids['quick']]}, ['Arugula Salad']),
+            ({'tagsAny': [tag_ids['salad'], tag_ids['quick']]}, ['Arugula Salad', 'Chicken Salad', 'Stir Fry']),
+            ({'tagsNone': [tag_ids['salad']]}, ['Stir Fry', 'Lasagna']),
+            ({'tagsAny': [tag_ids['quick']], 'tagsNone': [tag_ids['vegetarian']]}, ['Stir Fry']),
+            ({'tagsAll': [tag_ids['salad']], 'name': 'Chicken'}, ['Chicken Salad']),
+            ({'tagsAll': [tag_ids['salad']], 'canMake': True}, ['Arugula Salad', 'Chicken Salad']),
+        ]
+
+        for query, names in query_resp:
+            response = client.get('recipes/', query_string=query)
+
+            assert response.status_code == 200
+            assert [recipe['name'] for recipe in response.json] == names
@@ -1,3 +1,5 @@
+import json
+
 
 class TestRecipes:
     def test_get_empty(self, app):
@@ -446,3 +448,643 @@ class TestRecipes:
         )
 
         assert response.status_code == 404
+
+    def test_query_can_make(self, app):
+        client = app.test_client()
+
+        ingredient_ids = dict()
+
+        for name in ('Black Beans', 'Pineapple', 'Rice', 'Chicken Breast'):
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json={'name': name}
+            )
+
+            assert response.status_code == 201
+
+            ingredient_ids[name] = response.json['id']
+
+        items = [
+            {'name': 'Canned Black Beans', 'amount': 2, 'ingredientId': ingredient_ids['Black Beans']},
+            {'name': 'Fresh Pineapple', 'amount': 1, 'ingredientId': ingredient_ids['Pineapple']},
+            # an item that is out of stock should not count towards the ingredient
+            {'name': 'Brown Rice', 'amount': 0, 'ingredientId': ingredient_ids['Rice']},
+        ]
+
+        item_etags = dict()
+
+        for item in items:
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json=item,
+            )
+
+            assert response.status_code == 201
+
+            item_etags[item['name']] = (response.json['id'], response.headers['ETag'])
+
+        recipes = [
+            {
+                'name': 'Black Bean Pineapple Salsa',
+                'steps': 'put all ingredients in the bowl and stir',
+                'ingredients': [
+                    {'ingredientId': ingredient_ids['Black Beans'], 'amount': 2, 'unit': 'cans'},
+                    {'ingredientId': ingredient_ids['Pineapple'], 'amount': 1, 'unit': 'pineapple'},
+                ],
+            },
+            {
+                'name': 'Black Beans and Rice',
+                'steps': 'lorem ipsum',
+                'ingredients': [
+                    {'ingredientId': ingredient_ids['Black Beans'], 'amount': 1, 'unit': 'cans'},
+                    {'ingredientId': ingredient_ids['Rice'], 'amount': 2, 'unit': 'cups'},
+                ],
+            },
+            {
+                'name': 'Chicken Salad',
+                'steps': 'nothing.',
+                'ingredients': [
+                    {'ingredientId': ingredient_ids['Chicken Breast'], 'amount': 2, 'unit': 'lbs'},
+                ],
+            },
+            {
+                'name': 'Water',
+                'steps': 'turn on the tap',
+            },
+        ]
+
+        for recipe in recipes:
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json=recipe,
+            )
+
+            assert response.status_code == 201
+
+        query_resp = [
+            ({'canMake': True}, ['Black Bean Pineapple Salsa', 'Water']),
+            ({'canMake': True, 'name': 'Black'}, ['Black Bean Pineapple Salsa']),
+            ({'canMake': False}, [recipe['name'] for recipe in recipes]),
+        ]
+
+        for query, names in query_resp:
+            response = client.get(
+                'recipes/',
+                headers={'Content-Type': 'application/json'},
+                query_string=query
+            )
+
+            assert response.status_code == 200
+            assert [recipe['name'] for recipe in response.json] == names
+
+        # stocking up on rice should make the second recipe available
+        response = client.post(
+            'items/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'White Rice', 'amount': 3, 'ingredientId': ingredient_ids['Rice']},
+        )
+
+        assert response.status_code == 201
+
+        response = client.get('recipes/', query_string={'canMake': True})
+
+        assert [recipe['name'] for recipe in response.json] == [
+            'Black Bean Pineapple Salsa', 'Black Beans and Rice', 'Water'
+        ]
+
+        # deleting the only black bean item should make both black bean recipes unavailable
+        item_id, etag = item_etags['Canned Black Beans']
+        response = client.delete(
+            f'items/{item_id}',
+            headers={'If-Match': etag},
+        )
+
+        assert response.status_code == 204
+
+        response = client.get('recipes/', query_string={'canMake': True})
+
+        assert [recipe['name'] for recipe in response.json] == ['Water']
+        assert response.json[0]['missingIngredientCount'] == 0
+
+        runner = app.test_cli_runner()
+        result = runner.invoke(args=['rebuild-availability'])
+
+        assert result.exit_code == 0
+
+        response = client.get('recipes/', query_string={'name': 'Black'})
+
+        assert [recipe['missingIngredientCount'] for recipe in response.json] == [1, 1]
+
+    def test_batches(self, app):
+        client = app.test_client()
+
+        ingredient_ids = dict()
+
+        ingredients = [
+            {'name': 'Flour', 'density': 0.53},
+            {'name': 'Eggs', 'pieceWeight': 50},
+            {'name': 'Milk'},
+        ]
+
+        for ingredient in ingredients:
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json=ingredient,
+            )
+
+            assert response.status_code == 201
+
+            ingredient_ids[ingredient['name']] = response.json['id']
+
+        items = [
+            {'name': 'Flour Bag', 'amount': 1000, 'unit': 'g', 'ingredientId': ingredient_ids['Flour']},
+            {'name': 'Dozen Eggs', 'amount': 6, 'ingredientId': ingredient_ids['Eggs']},
+            {'name': 'Whole Milk', 'amount': 1, 'unit': 'L', 'ingredientId': ingredient_ids['Milk']},
+        ]
+
+        for item in items:
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json=item,
+            )
+
+            assert response.status_code == 201
+
+        recipes = [
+            # limited by the milk, 1L / 1.5 cups
+            ('Pancakes', [('Flour', 2, 'cups'), ('Eggs', 2, 'eggs'), ('Milk', 1.5, 'cups')], 2),
+            # eggs are converted using their piece weight
+            ('Omelette', [('Eggs', 150, 'g')], 2),
+            # milk has no density, so its volume can't be compared to a mass
+            ('Custard', [('Milk', 200, 'g')], 0),
+            ('Water', [], None),
+        ]
+
+        for name, ringredients, _ in recipes:
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json={
+                    'name': name,
+                    'steps': 'mix',
+                    'ingredients': [
+                        {'ingredientId': ingredient_ids[i_name], 'amount': amount, 'unit': unit}
+                        for i_name, amount, unit in ringredients
+                    ],
+                },
+            )
+
+            assert response.status_code == 201
+
+        response = client.get('recipes/batches')
+
+        assert response.status_code == 200
+        assert [batches['batches'] for batches in response.json] == [batches for _, _, batches in recipes]
+
+    def test_get_query_count(self, app, queries):
+        client = app.test_client()
+
+        ingredient_ids = []
+        for i in range(3):
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'ingredient {i}'},
+            )
+
+            ingredient_ids.append(response.json['id'])
+
+        response = client.post(
+            'tags/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'quick'},
+        )
+
+        tag_id = response.json['id']
+
+        for i in range(20):
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json={
+                    'name': f'recipe {i}',
+                    'steps': 'mix',
+                    'ingredients': [
+                        {'ingredientId': ingredient_id, 'amount': 1, 'unit': 'cup'} for ingredient_id in ingredient_ids
+                    ],
+                },
+            )
+
+            assert response.status_code == 201
+
+            response = client.post(
+                f"recipes/{response.json['id']}/tags",
+                headers={"Content-Type": "application/json"},
+                json={'tagIds': [tag_id]},
+            )
+
+            assert response.status_code == 204
+
+        # the number of queries should not depend on the number of recipes returned. Warm up the count cache first
+        client.get('recipes/')
+        counts = []
+        for url in ('recipes/?page_size=2', 'recipes/?page_size=20', f'tags/{tag_id}/recipes',
+                    f'ingredients/{ingredient_ids[0]}/recipes'):
+            queries.clear()
+            response = client.get(url)
+
+            assert response.status_code == 200
+            assert all(len(recipe['ingredients']) == 3 for recipe in response.json)
+            assert all(len(recipe['tags']) == 1 for recipe in response.json)
+            counts.append(len(queries))
+
+        assert counts[0] == counts[1]
+        assert max(counts) <= 5
+
+    def test_search(self, app):
+        client = app.test_client()
+
+        recipes = [
+            {
+                'name': 'Black Bean Pineapple Salsa',
+                'notes': 'Goes well with jerk chicken and rice',
+                'steps': 'put all ingredients in the bowl and stir',
+            },
+            {
+                'name': 'Jerk Chicken',
+                'notes': 'always use the grill',
+                'steps': 'marinate the chicken overnight, then grill the chicken',
+            },
+            {
+                'name': 'Fruit Salad',
+                'steps': 'put all the fruit in a bowl',
+            },
+        ]
+
+        recipe_info = dict()
+
+        for recipe in recipes:
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json=recipe,
+            )
+
+            assert response.status_code == 201
+
+            recipe_info[recipe['name']] = (response.json['id'], response.headers['ETag'])
+
+        query_resp = [
+            # the recipe mentioning chicken the most comes first
+            ({'q': 'chicken'}, ['Jerk Chicken', 'Black Bean Pineapple Salsa']),
+            # equally relevant, the shorter recipe ranks first
+            ({'q': 'bowl'}, ['Fruit Salad', 'Black Bean Pineapple Salsa']),
+            ({'q': 'pine*'}, ['Black Bean Pineapple Salsa']),
+            ({'q': '"jerk chicken"'}, ['Jerk Chicken', 'Black Bean Pineapple Salsa']),
+            ({'q': '"chicken jerk"'}, []),
+            ({'q': 'fruit bowl'}, ['Fruit Salad']),
+            ({'q': 'chicken AND OR ("'}, []),
+            ({'q': 'chicken', 'name': 'Salsa'}, ['Black Bean Pineapple Salsa']),
+            ({'q': 'chicken', 'canMake': True}, ['Jerk Chicken', 'Black Bean Pineapple Salsa']),
+            ({'q': ''}, None),
+        ]
+
+        for query, names in query_resp:
+            response = client.get('recipes/', query_string=query)
+
+            if names is None:
+                assert response.status_code == 422
+            else:
+                assert response.status_code == 200
+                assert [recipe['name'] for recipe in response.json] == names
+
+        # the index follows updates and deletes
+        recipe_id, etag = recipe_info['Fruit Salad']
+        response = client.put(
+            f'recipes/{recipe_id}',
+            headers={'If-Match': etag},
+            json={'name': 'Fruit Salad', 'steps': 'put all the fruit in a pineapple'},
+        )
+
+        assert response.status_code == 200
+
+        response = client.get('recipes/', query_string={'q': 'pineapple'})
+
+        assert sorted(recipe['name'] for recipe in response.json) == ['Black Bean Pineapple Salsa', 'Fruit Salad']
+
+        recipe_id, etag = recipe_info['Black Bean Pineapple Salsa']
+        response = client.delete(f'recipes/{recipe_id}', headers={'If-Match': etag})
+
+        assert response.status_code == 204
+
+        response = client.get('recipes/', query_string={'q': 'pineapple'})
+
+        assert [recipe['name'] for recipe in response.json] == ['Fruit Salad']
+
+    def test_post_ingredients(self, app, queries):
+        client = app.test_client()
+
+        ingredient_ids = []
+        for i in range(10):
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json={'name': f'ingredient {i}'},
+            )
+
+            ingredient_ids.append(response.json['id'])
+
+        recipe = {
+            'name': 'Everything Soup',
+            'steps': 'put everything in the pot',
+            'ingredients': [
+                {'ingredientId': ingredient_id, 'amount': 1, 'unit': 'cup'}
+                for ingredient_id in ingredient_ids + [998, 999]
+            ],
+        }
+
+        # all unknown ingredients are reported together, and nothing is written
+        response = client.post(
+            'recipes/',
+            headers={"Content-Type": "application/json"},
+            json=recipe,
+        )
+
+        assert response.status_code == 422
+        assert response.json['errors']['json']['ingredientId'] == [
+            'No such ingredient with id 998', 'No such ingredient with id 999'
+        ]
+
+        response = client.get('recipes/')
+
+        assert response.json == []
+
+        # ingredients are resolved with a single query
+        recipe['ingredients'] = recipe['ingredients'][:10]
+        queries.clear()
+        response = client.post(
+            'recipes/',
+            headers={"Content-Type": "application/json"},
+            json=recipe,
+        )
+
+        assert response.status_code == 201
+        assert len(response.json['ingredients']) == 10
+        assert len([query for query in queries if 'FROM ingredients' in query and 'recipe' not in query]) == 1
+
+        # PUT replaces the ingredients
+        recipe_id = response.json['id']
+        recipe['ingredients'] = [
+            {'ingredientId': ingredient_ids[0], 'amount': 2, 'unit': 'cups'},
+            {'ingredientId': ingredient_ids[1], 'amount': 1, 'unit': 'cup'},
+        ]
+        response = client.put(
+            f'recipes/{recipe_id}',
+            headers={'If-Match': response.headers['ETag']},
+            json=recipe,
+        )
+
+        assert response.status_code == 200
+        assert [ringredient['amount'] for ringredient in response.json['ingredients']] == [2, 1]
+
+        # duplicates are rejected
+        response = client.post(
+            f'recipes/{recipe_id}/ingredients',
+            headers={"Content-Type": "application/json"},
+            json=[{'ingredientId': ingredient_ids[2], 'amount': 1, 'unit': 'cup'}] * 2,
+        )
+
+        assert response.status_code == 422
+        assert response.json['errors']['json']['ingredientId'] == [
+            f'Ingredient with id {ingredient_ids[2]} is listed more than once'
+        ]
+
+    def test_search_cursor(self, app):
+        client = app.test_client()
+
+        for name in ('Jerk Chicken', 'Chicken Salad'):
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json={'name': name, 'steps': 'cook the chicken'},
+            )
+
+            assert response.status_code == 201
+
+        response = client.get('recipes/', query_string={'page_size': 1})
+        after = json.loads(response.headers['X-Pagination'])['next_after']
+
+        response = client.get('recipes/', query_string={'page_size': 1, 'after': after})
+
+        assert [recipe['name'] for recipe in response.json] == ['Chicken Salad']
+
+        # search results are ordered by rank, which a cursor can't express
+        response = client.get('recipes/', query_string={'q': 'chicken', 'after': after})
+
+        assert response.status_code == 422
+
+    def test_get_not_modified(self, app, queries):
+        client = app.test_client()
+
+        response = client.post(
+            'recipes/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Pancakes', 'steps': 'mix and fry'},
+        )
+
+        assert response.status_code == 201
+
+        recipe_id = response.json['id']
+
+        response = client.get('recipes/', query_string={'page_size': 5, 'name': 'Pan'})
+        etag = response.headers['ETag']
+
+        # unchanged tables answer without reading them, whatever the order of the args
+        queries.clear()
+        response = client.get('recipes/?name=Pan&page_size=5', headers={'If-None-Match': etag})
+
+        assert response.status_code == 304
+        assert not [query for query in queries if 'FROM recipes' in query]
+
+        # other args are another listing
+        response = client.get('recipes/', query_string={'page_size': 6, 'name': 'Pan'}, headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+
+        # so is the same listing after a write to one of the tables it reads
+        response = client.post(
+            'tags/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'breakfast'},
+        )
+        response = client.post(
+            f'recipes/{recipe_id}/tags',
+            headers={"Content-Type": "application/json"},
+            json={'tagIds': [response.json['id']]},
+        )
+
+        assert response.status_code == 204
+
+        response = client.get('recipes/', query_string={'page_size': 5, 'name': 'Pan'}, headers={'If-None-Match': etag})
+
+        assert response.status_code == 200
+        assert response.json[0]['tags'][0]['name'] == 'breakfast'
+
+    def test_response_cache(self, app, queries):
+        client = app.test_client()
+
+        response = client.post(
+            'ingredients/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Eggs'},
+        )
+        ingredient_id = response.json['id']
+
+        response = client.post(
+            'recipes/',
+            headers={"Content-Type": "application/json"},
+            json={
+                'name': 'Omelette',
+                'steps': 'whisk and fry',
+                'ingredients': [{'ingredientId': ingredient_id, 'amount': 3, 'unit': 'eggs'}],
+            },
+        )
+
+        assert response.status_code == 201
+
+        cache = app.extensions['response_cache']
+
+        response = client.get('recipes/', query_string={'canMake': True})
+
+        assert response.json == []
+        assert cache.stats()['misses'] == 1
+
+        # the second request is served from the cache, only checking the table versions
+        queries.clear()
+        response = client.get('recipes/', query_string={'canMake': True})
+
+        assert response.json == []
+        assert cache.stats()['hits'] == 1
+        assert not [query for query in queries if 'FROM recipes' in query]
+
+        # stocking the ingredient changes which recipes can be made
+        response = client.post(
+            'items/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Dozen Eggs', 'amount': 12, 'ingredientId': ingredient_id},
+        )
+
+        assert response.status_code == 201
+
+        response = client.get('recipes/', query_string={'canMake': True})
+
+        assert [recipe['name'] for recipe in response.json] == ['Omelette']
+        assert cache.stats()['hits'] == 1
+
+        # cached responses still answer conditional requests
+        response = client.get(
+            'recipes/', query_string={'canMake': True}, headers={'If-None-Match': response.headers['ETag']}
+        )
+
+        assert response.status_code == 304
+        assert cache.stats()['hits'] == 2
+
+    def test_get_stream(self, app):
+        client = app.test_client()
+
+        response = client.post(
+            'ingredients/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Flour'},
+        )
+        ingredient_id = response.json['id']
+
+        for i in range(3):
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json={
+                    'name': f'Bread {i}',
+                    'steps': 'knead and bake',
+                    'ingredients': [{'ingredientId': ingredient_id, 'amount': 500, 'unit': 'g'}],
+                },
+            )
+
+            assert response.status_code == 201
+
+        page = client.get('recipes/')
+        response = client.get('recipes/', headers={'Accept': 'application/x-ndjson'})
+
+        assert response.status_code == 200
+        assert [json.loads(line) for line in response.get_data(as_text=True).splitlines()] == page.json
+
+        # sub collections stream as well
+        response = client.get(f'ingredients/{ingredient_id}/recipes', headers={'Accept': 'application/x-ndjson'})
+
+        assert response.status_code == 200
+        assert len(response.get_data(as_text=True).splitlines()) == 3
+
+    def test_get_fields(self, app, queries):
+        client = app.test_client()
+
+        response = client.post(
+            'ingredients/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'Flour'},
+        )
+        ingredient_id = response.json['id']
+
+        response = client.post(
+            'recipes/',
+            headers={"Content-Type": "application/json"},
+            json={
+                'name': 'Bread',
+                'steps': 'knead and bake',
+                'rating': 4,
+                'ingredients': [{'ingredientId': ingredient_id, 'amount': 500, 'unit': 'g'}],
+            },
+        )
+        recipe_id = response.json['id']
+
+        queries.clear()
+        response = client.get('recipes/?fields=id,name,rating')
+
+        assert response.status_code == 200
+        assert response.json == [{'id': recipe_id, 'name': 'Bread', 'rating': 4}]
+        # only the requested columns are read, and the relationships not at all
+        statements = ' '.join(queries)
+        assert 'recipes.steps' not in statements
+        assert 'recipe_ingredients' not in statements
+        assert 'recipe_tags' not in statements
+
+        response = client.get(f'recipes/{recipe_id}?fields=name,ingredients,missingIngredientCount')
+
+        assert response.status_code == 200
+        assert response.json == {
+            'name': 'Bread',
+            'missingIngredientCount': 1,
+            'ingredients': [{
+                'amount': 500.0, 'unit': 'g', 'recipeId': recipe_id,
+                'ingredient': {'id': ingredient_id, 'name': 'Flour', 'inStock': False},
+            }],
+        }
+
+        # detail ETags don't depend on the fields
+        assert response.headers['ETag'] == client.get(f'recipes/{recipe_id}').headers['ETag']
+
+        response = client.get(f'ingredients/{ingredient_id}/recipes?fields=name', headers={
+            'Accept': 'application/x-ndjson'
+        })
+
+        assert response.status_code == 200
+        assert json.loads(response.get_data(as_text=True)) == {'name': 'Bread'}
+
+        response = client.get('recipes/?fields=name,steps_')
+
+        assert response.status_code == 422
+        assert response.json['errors'] == {'query': {'fields': ['Unknown field: steps_.']}}
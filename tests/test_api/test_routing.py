@@ -0,0 +1,60 @@
+import pytest
+from sqlalchemy import event, exc
+
+from myopenpantry import create_app
+from myopenpantry.config import TestingConfig
+from myopenpantry.extensions.database import db
+from myopenpantry.extensions.database.routing import READ_ENGINES
+from myopenpantry.models import Tag
+
+
+@pytest.fixture
+def replicated_app(monkeypatch, tmp_path):
+    # the database file again, as a separate pool of read only connections
+    url = f'sqlite:///{tmp_path / "pantry.db"}'
+    monkeypatch.setattr(TestingConfig, 'SQLALCHEMY_DATABASE_URI', url)
+    monkeypatch.setattr(TestingConfig, 'DATABASE_REPLICA_URLS', [url])
+    return create_app(config_name='testing')
+
+
+class TestRouting:
+    def test_reads_go_to_replica(self, replicated_app):
+        client = replicated_app.test_client()
+        read_engine, = replicated_app.extensions[READ_ENGINES]
+
+        replica_reads = []
+
+        @event.listens_for(read_engine, 'before_cursor_execute')
+        def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+            replica_reads.append(statement)
+
+        response = client.post('tags/', json={'name': 'breakfast'})
+
+        assert response.status_code == 201
+        assert replica_reads == []
+
+        response = client.get(f"tags/{response.json['id']}")
+
+        assert response.status_code == 200
+        assert response.json['name'] == 'breakfast'
+        assert any('FROM tags' in statement for statement in replica_reads)
+
+        # read engines refuse writes
+        with pytest.raises(exc.OperationalError):
+            read_engine.execute("INSERT INTO tags (name) VALUES ('lunch')")
+
+    def test_read_own_writes(self, replicated_app):
+        read_engine, = replicated_app.extensions[READ_ENGINES]
+
+        with replicated_app.test_request_context('tags/', method='GET'):
+            assert db.session.get_bind() is read_engine
+
+            db.session.add(Tag(name='dinner'))
+            db.session.commit()
+
+            # the session wrote, so it keeps reading from the primary
+            assert db.session.get_bind() is db.engine
+            assert Tag.query.filter_by(name='dinner').count() == 1
+
+        with replicated_app.test_request_context('tags/', method='POST'):
+            assert db.session.get_bind() is db.engine
@@ -0,0 +1,168 @@
+from datetime import date, datetime
+from decimal import Decimal
+import json
+
+from flask import json as flask_json
+import pytest
+
+from myopenpantry import create_app
+from myopenpantry.config import TestingConfig
+from myopenpantry.extensions import api
+from myopenpantry.extensions.api import AutoSchema, MARSHMALLOW_INTERNALS
+from myopenpantry.extensions.api.jsonlib import get_backend
+from myopenpantry.extensions.cache import LRUCache
+from myopenpantry.models import Ingredient, Item, Recipe
+from myopenpantry.views.ingredients.schemas import IngredientSchema
+from myopenpantry.views.items.schemas import ItemSchema, ITEM_LOADERS
+from myopenpantry.views.recipes.schemas import RecipeSchema, RECIPE_LOADERS
+
+
+class TestSchemas:
+    def test_compiled_dump(self, app, monkeypatch):
+        # a marshmallow upgrade changed the internals the dumpers are generated from, see compile_dumper
+        assert MARSHMALLOW_INTERNALS
+        assert ItemSchema()._get_dumper() is not None
+
+        client = app.test_client()
+
+        ingredient_ids = []
+        for ingredient in ({'name': 'Flour', 'density': 0.53}, {'name': 'Eggs', 'pieceWeight': 50}):
+            response = client.post(
+                'ingredients/',
+                headers={"Content-Type": "application/json"},
+                json=ingredient,
+            )
+
+            assert response.status_code == 201
+
+            ingredient_ids.append(response.json['id'])
+
+        for item in (
+            {'name': 'Bread Flour', 'amount': 2, 'unit': 'kg', 'productId': 123, 'ingredientId': ingredient_ids[0]},
+            {'name': 'Loose Eggs', 'amount': 0},
+        ):
+            response = client.post(
+                'items/',
+                headers={"Content-Type": "application/json"},
+                json=item,
+            )
+
+            assert response.status_code == 201
+
+        response = client.post(
+            'tags/',
+            headers={"Content-Type": "application/json"},
+            json={'name': 'baking'},
+        )
+        tag_id = response.json['id']
+
+        for recipe in (
+            {
+                'name': 'Pancakes',
+                'steps': 'mix and fry',
+                'notes': 'serve warm',
+                'rating': 5,
+                'ingredients': [
+                    {'ingredientId': ingredient_ids[0], 'amount': 1.5, 'unit': 'cup'},
+                    {'ingredientId': ingredient_ids[1], 'amount': 2, 'unit': 'eggs'},
+                ],
+            },
+            {'name': 'Water', 'steps': 'pour'},
+        ):
+            response = client.post(
+                'recipes/',
+                headers={"Content-Type": "application/json"},
+                json=recipe,
+            )
+
+            assert response.status_code == 201
+
+            client.post(
+                f"recipes/{response.json['id']}/tags",
+                headers={"Content-Type": "application/json"},
+                json={'tagIds': [tag_id]},
+            )
+
+        with app.app_context():
+            for schema, query in (
+                (RecipeSchema(many=True), Recipe.query.options(*RECIPE_LOADERS)),
+                (ItemSchema(many=True), Item.query.options(*ITEM_LOADERS)),
+                (IngredientSchema(many=True), Ingredient.query),
+                (RecipeSchema(only=('id', 'ingredients.ingredient.name'), many=True), Recipe.query),
+            ):
+                objs = query.order_by('id').all()
+
+                compiled = app.json_encoder().encode(schema.dump(objs))
+                monkeypatch.setattr(AutoSchema, 'COMPILED_DUMP', False)
+                generic = app.json_encoder().encode(schema.dump(objs))
+                monkeypatch.undo()
+
+                assert compiled == generic
+                assert json.loads(compiled)
+
+            # errors raised while reading an attribute aren't mistaken for a missing attribute
+            def broken(self):
+                raise AttributeError('broken')
+
+            monkeypatch.setattr(Item, 'name', property(broken))
+            with pytest.raises(AttributeError, match='broken'):
+                ItemSchema().dump(Item.query.first())
+
+            # anything else than model instances goes the generic way
+            assert ItemSchema(many=True).dump([{'id': 1, 'name': 'Flour', 'amount': 2}]) == [
+                {'id': 1, 'name': 'Flour', 'amount': 2}
+            ]
+
+    def test_sparse_schema_cache(self, app, monkeypatch):
+        # one schema per ?fields= selection, the least recently used are dropped
+        monkeypatch.setitem(app.extensions, 'schema_cache', LRUCache(2))
+        monkeypatch.setattr(api, 'DUMPER_CACHE_SIZE', 2)
+        monkeypatch.delattr(RecipeSchema, '_dumpers', raising=False)
+        client = app.test_client()
+
+        for fields in ('id', 'name', 'id,name', 'rating', 'name'):
+            response = client.get(f'recipes/?fields={fields}')
+            assert response.status_code == 200
+
+        cache = app.extensions['schema_cache']
+        assert len(cache) == 2
+        assert cache.stats()['evictions'] > 0
+        assert len(RecipeSchema._dumpers) <= 2
+
+        # apps don't share their schemas
+        other = create_app(config_name='testing')
+        assert len(other.extensions['schema_cache']) == 0
+
+    def test_json_backends(self, monkeypatch):
+        data = {'amount': Decimal('1.250'), 'at': datetime(2021, 3, 4, 5, 6, 7, 8), 'on': date(2021, 3, 4)}
+        bodies = []
+
+        for backend in ('stdlib', 'orjson'):
+            monkeypatch.setattr(TestingConfig, 'JSON_BACKEND', backend)
+            app = create_app(config_name='testing')
+
+            assert app.json_encoder is get_backend(backend)[0]
+
+            with app.app_context():
+                bodies.append(json.loads(flask_json.dumps(data)))
+
+            # request bodies are decoded with the backend as well
+            client = app.test_client()
+            response = client.post(
+                'tags/',
+                headers={"Content-Type": "application/json"},
+                data='{"name": "caf\\u00e9 %s"}' % backend,
+            )
+
+            assert response.status_code == 201
+            assert response.json['name'] == f'café {backend}'
+
+            response = client.post(
+                'tags/',
+                headers={"Content-Type": "application/json"},
+                data='{"name": ',
+            )
+
+            assert response.status_code == 400
+
+        assert bodies[0] == bodies[1] == {'amount': 1.25, 'at': '2021-03-04T05:06:07.000008', 'on': '2021-03-04'}
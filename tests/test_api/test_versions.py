@@ -0,0 +1,50 @@
+from sqlalchemy import event
+
+from myopenpantry.extensions.database import bump_versions, db, get_versions
+from myopenpantry.models import Tag
+
+
+class TestVersions:
+    def test_bumped_on_commit(self, app, queries):
+        with app.app_context():
+            (version, row_count), = get_versions(db.session, ['tags']).values()
+            db.session.commit()
+
+            queries.clear()
+            db.session.add(Tag(name='breakfast'))
+            db.session.flush()
+
+            # the transaction holds no lock on table_stats until it commits
+            assert not any('table_stats' in query for query in queries)
+            assert get_versions(db.session, ['tags']) == {}
+
+            db.session.commit()
+
+            assert get_versions(db.session, ['tags']) == {'tags': (version + 1, row_count + 1)}
+            db.session.commit()
+
+            # rolled back bumps are dropped
+            db.session.add(Tag(name='lunch'))
+            db.session.flush()
+            db.session.rollback()
+
+            assert get_versions(db.session, ['tags']) == {'tags': (version + 1, row_count + 1)}
+
+    def test_bumped_in_order(self, app):
+        with app.app_context():
+            bumped = []
+
+            @event.listens_for(db.engine, 'before_cursor_execute')
+            def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+                if statement.startswith('UPDATE table_stats'):
+                    bumped.append([params['table_name'] for params in context.compiled_parameters])
+
+            with db.engine.begin() as connection:
+                bump_versions(connection, {'tags': 0})
+                bump_versions(connection, {'recipes': 0, 'items': 1, 'tags': 1})
+
+                assert bumped == []
+
+            # a single statement, whatever order the tables were written in
+            assert bumped == [['items', 'recipes', 'tags']]
+            assert get_versions(db.session, ['items', 'tags']) == {'items': (1, 1), 'tags': (1, 1)}